@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""Measure scanning, backing up and restoring synthetic trees.
+
+Each tree is generated from a seed, so runs are comparable from one commit to
+the next, and backed up to the in-process bucket the tests use (tst/fake_s3.py)
+so only tardis itself is measured, not the network. Files are scanned and
+backed up the way archive backup does it, streaming the manifest with a
+checksum cache. Each phase reports wall time, files/s, MB/s, its peak RSS and
+the requests it made. The peak RSS is only the phase's own on Linux, elsewhere
+it's the process's peak so far and marked "(process)".
+
+Save a run with --save and compare later runs against it with --baseline, which
+flags phases slower than --tolerance, or making more requests, and exits
+non-zero if there are any.
+
+Usage: PYTHONPATH=. python bench/backup_bench.py [--tree NAME ...] [--scale N]
+                                                 [--save PATH] [--baseline PATH]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import resource
+import argparse
+import tempfile
+import functools
+from contextlib import closing
+from collections import OrderedDict, namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tst'))
+from fake_s3 import FakeBucket
+
+from tardis.manifest import Manifest
+from tardis.cache import StatCache
+from tardis.pack import Packer, PackCache
+from tardis import needs_put, put_archive, create_archive, put_manifest, latest_manifest, get_archive
+from tardis import restore_archive, backup, restore
+
+
+class Shape(namedtuple('Shape', ['files', 'size', 'depth', 'fanout'])):
+    """A tree of 'files' files of around 'size' bytes, in directories 'depth'
+    deep with 'fanout' subdirectories or files each. files scales with
+    --scale."""
+    __slots__ = ()
+
+
+TREES = OrderedDict([
+    ('tiny', Shape(files=5000, size=512, depth=2, fanout=100)),
+    ('deep', Shape(files=2000, size=4096, depth=12, fanout=2)),
+    ('huge', Shape(files=4, size=64 * 2**20, depth=1, fanout=4)),
+    ('mixed', None),
+])
+
+# Random content is incompressible, text-like content compresses around 3:1
+BLOCK_SIZE = 2**20
+
+
+class Result(namedtuple('Result', ['seconds', 'files', 'bytes', 'peak_rss', 'phase_rss', 'requests'])):
+    """A phase's measurements, phase_rss is whether peak_rss is the phase's
+    own peak rather than the process's"""
+    __slots__ = ()
+
+    def summary(self):
+        seconds = max(self.seconds, 1e-9)
+        return "{:8.3f}s {:10.1f} files/s {:8.1f} MB/s {:8.1f} MB peak RSS{} {:6d} requests".format(
+            self.seconds, self.files / seconds, self.bytes / 2.0**20 / seconds, self.peak_rss / 2.0**20,
+            "" if self.phase_rss else " (process)", sum(self.requests.itervalues()))
+
+
+def generate_tree(root, name, scale, seed):
+    """Write the tree called name into root, returning its (files, bytes)"""
+    rng = random.Random(seed)
+    random_block = ''.join(chr(rng.getrandbits(8)) for _ in xrange(BLOCK_SIZE))
+    words = ["tardis", "backup", "manifest", "object", "archive", "bucket", "chunk", "pack"]
+    text_block = ' '.join(rng.choice(words) + str(rng.randrange(1000)) for _ in xrange(BLOCK_SIZE / 8))[:BLOCK_SIZE]
+
+    shapes = [TREES[name]] if TREES[name] else [shape for shape in TREES.itervalues() if shape]
+    totals = [0, 0]
+
+    for n, shape in enumerate(shapes):
+        files = max(int(shape.files * scale), 1)
+        for i in xrange(files):
+            # Spread files over the tree, each path component picking one of fanout
+            components = []
+            index = i
+            for _ in xrange(shape.depth):
+                components.append("d{}".format(index % shape.fanout))
+                index /= shape.fanout
+
+            directory = os.path.join(root, "shape{}".format(n), *components)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            size = max(int(shape.size * rng.uniform(0.5, 1.5)), 1)
+            block = random_block if rng.random() < 0.5 else text_block
+            with open(os.path.join(directory, "file{}".format(i)), 'wb') as f:
+                # A unique header keeps every file's content distinct
+                f.write("{}:{}\n".format(n, i))
+                written = 0
+                while written < size:
+                    start = rng.randrange(BLOCK_SIZE)
+                    data = block[start:start + size - written]
+                    f.write(data)
+                    written += len(data)
+
+            totals[0] += 1
+            totals[1] += size
+
+    return tuple(totals)
+
+
+def reset_peak_rss():
+    """Start the peak RSS afresh from the current RSS, returning whether that
+    was possible (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """The peak RSS since reset_peak_rss, or of the whole process"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    # ru_maxrss is in KiB on Linux, bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(bucket, files, size, f, *args, **kwargs):
+    before = dict(bucket.requests)
+    phase_rss = reset_peak_rss()
+    start = time.time()
+    f(*args, **kwargs)
+    seconds = time.time() - start
+
+    requests = dict((method, count - before.get(method, 0)) for method, count in bucket.requests.iteritems())
+    return Result(seconds, files, size, peak_rss(), phase_rss, requests)
+
+
+def run(name, scale, seed, workers, pack):
+    temp_dir = tempfile.mkdtemp(prefix="tardis_bench")
+    try:
+        root = os.path.join(temp_dir, "tree")
+        files, size = generate_tree(root, name, scale, seed)
+
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+
+        put = functools.partial(put_archive, get_bucket, create_archive)
+        packer = Packer(get_bucket, put, create_archive) if pack else None
+
+        def scan():
+            with closing(StatCache(os.path.join(temp_dir, "scan-cache"))) as cache, \
+                 closing(Manifest.stream_filesystem('hostname', 'username', [root], cache=cache)) as manifest:
+                for _ in manifest.entries():
+                    pass
+
+        # As archive backup does it
+        def run_backup():
+            with closing(StatCache(os.path.join(temp_dir, "cache"))) as cache:
+                previous = latest_manifest(get_bucket, 'hostname', 'username')
+                backup([root], [],
+                       packer.put if packer else put,
+                       functools.partial(needs_put, get_bucket),
+                       functools.partial(put_manifest, get_bucket, packer=packer, backoff=0),
+                       lambda: previous,
+                       functools.partial(Manifest.stream_filesystem, 'hostname', 'username', cache=cache,
+                                         previous=previous),
+                       workers=workers, backoff=0)
+
+        def run_restore():
+            shutil.rmtree(root)
+            restore([root],
+                    functools.partial(get_archive, get_bucket, packs=PackCache(get_bucket)),
+                    restore_archive,
+                    functools.partial(latest_manifest, get_bucket, 'hostname', 'username'),
+                    workers=workers, backoff=0)
+
+        results = OrderedDict()
+        results['scan'] = measure(bucket, files, size, scan)
+        results['backup'] = measure(bucket, files, size, run_backup)
+        results['unchanged backup'] = measure(bucket, files, size, run_backup)
+        results['restore'] = measure(bucket, files, size, run_restore)
+        return results
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def compare(name, phase, result, baseline, tolerance):
+    """The regressions of result against baseline, a Result as saved"""
+    regressions = []
+    if result.seconds > baseline['seconds'] * (1 + tolerance):
+        regressions.append("{} {} took {:.3f}s, was {:.3f}s".format(name, phase, result.seconds, baseline['seconds']))
+
+    for method, count in sorted(result.requests.iteritems()):
+        if count > baseline['requests'].get(method, 0):
+            regressions.append("{} {} made {} {} requests, was {}".format(
+                               name, phase, count, method, baseline['requests'].get(method, 0)))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark backup and restore')
+    parser.add_argument('--tree', metavar='NAME', choices=TREES.keys(), action='append',
+                        help='trees to run, any of {}, defaults to all of them'.format(", ".join(TREES)))
+    parser.add_argument('--scale', metavar='N', type=float, default=1.0,
+                        help='multiplies the number of files in each tree')
+    parser.add_argument('--seed', metavar='N', type=int, default=0)
+    parser.add_argument('--workers', metavar='N', type=int, default=4)
+    parser.add_argument('--pack', action='store_true', help='pack small files, see tardis.pack')
+    parser.add_argument('--save', metavar='PATH', help='save the results as a baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare the results against a saved baseline')
+    parser.add_argument('--tolerance', metavar='FRACTION', type=float, default=0.2,
+                        help='how much slower than the baseline a phase can be, defaults to 0.2')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    saved = OrderedDict()
+    regressions = []
+    for name in args.tree or TREES.keys():
+        results = run(name, args.scale, args.seed, args.workers, args.pack)
+
+        print "{}:".format(name)
+        for phase, result in results.iteritems():
+            print "  {:>16}: {}".format(phase, result.summary())
+
+            if phase in baseline.get(name, {}):
+                regressions.extend(compare(name, phase, result, baseline[name][phase], args.tolerance))
+
+        saved[name] = OrderedDict((phase, result._asdict()) for phase, result in results.iteritems())
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(saved, f, indent=2)
+
+    if regressions:
+        print "Regressions against {}:".format(args.baseline)
+        for regression in regressions:
+            print "  {}".format(regression)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
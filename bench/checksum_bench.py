@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Measure the throughput of each checksum algorithm on this machine.
+
+Usage: PYTHONPATH=. python bench/checksum_bench.py [--size MB] [--repeat N]
+"""
+import os
+import time
+import argparse
+
+from tardis.util import ALGORITHMS, checksum
+from tardis.buffers import READ_SIZE
+
+
+def throughput(algorithm, data, repeat):
+    """MB/s checksumming data with algorithm, the best of repeat runs"""
+    parts = [data[i:i + READ_SIZE] for i in xrange(0, len(data), READ_SIZE)]
+
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        checksum(parts, algorithm)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return len(data) / 2.0**20 / max(best, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark checksum algorithms')
+    parser.add_argument('--size', metavar='MB', type=int, default=256)
+    parser.add_argument('--repeat', metavar='N', type=int, default=3)
+    args = parser.parse_args()
+
+    data = os.urandom(args.size * 2**20)
+
+    results = [(algorithm, throughput(algorithm, data, args.repeat)) for algorithm in ALGORITHMS]
+    for algorithm, rate in sorted(results, key=lambda result: -result[1]):
+        print "{:>8}: {:8.1f} MB/s".format(algorithm, rate)
+
+    print "Fastest: {}".format(max(results, key=lambda result: result[1])[0])
+
+
+if __name__ == '__main__':
+    main()
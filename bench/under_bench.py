@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Compare Manifest.under against a linear scan of the manifest's paths.
+
+Usage: PYTHONPATH=. python bench/under_bench.py [--entries N] [--roots N]
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+from tardis.manifest import StatInfo, FileEntry, Manifest
+
+
+def synthetic_manifest(entries):
+    """A manifest of entries files, 100 to a directory, 100 directories to a parent"""
+    logging.disable(logging.DEBUG)
+
+    stat_info = StatInfo('user', 'group', 0644, 1363621000, 1363620000, 1000)
+    paths = ("/home/user/{:04d}/{:03d}/{:03d}".format(i / 10000, i / 100 % 100, i % 100) for i in xrange(entries))
+
+    return Manifest('manifest/hostname/username/bench',
+                    ((path, FileEntry(path, "data/x/y", stat_info)) for path in paths))
+
+
+def scan(manifest, directory):
+    return [manifest[f] for f in manifest if f.startswith(directory)]
+
+
+def under(manifest, directory):
+    return list(manifest.under(directory))
+
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark restore selection')
+    parser.add_argument('--entries', metavar='N', type=int, default=10**6)
+    parser.add_argument('--roots', metavar='N', type=int, default=10)
+    args = parser.parse_args()
+
+    print "Building manifest of {} entries".format(args.entries)
+    manifest = synthetic_manifest(args.entries)
+    list(manifest) # sort once up front, both approaches iterate in order
+
+    fd, path = tempfile.mkstemp(prefix="tardis_bench")
+    with os.fdopen(fd, 'wb') as f:
+        manifest.to_binary(f)
+    mapped = Manifest.from_file(path)
+    os.unlink(path)
+
+    rng = random.Random(0)
+    directories = ["/home/user/{:04d}/{:03d}".format(rng.randrange(max(args.entries / 10000, 1)), rng.randrange(100))
+                   for _ in xrange(args.roots)]
+
+    totals = { 'scan': 0.0, 'under': 0.0, 'mapped under': 0.0 }
+    for directory in directories:
+        scan_time, expected = timed(scan, manifest, directory)
+        under_time, actual = timed(under, manifest, directory)
+        mapped_time, mapped_actual = timed(under, mapped, directory)
+
+        expected_paths = [e.path for e in expected]
+        if expected_paths != [e.path for e in actual] or expected_paths != [e.path for e in mapped_actual]:
+            sys.exit("Results differ for {}".format(directory))
+
+        totals['scan'] += scan_time
+        totals['under'] += under_time
+        totals['mapped under'] += mapped_time
+
+    for name in ('scan', 'under', 'mapped under'):
+        print "{:>14}: {:10.6f}s per root".format(name, totals[name] / args.roots)
+
+
+if __name__ == '__main__':
+    main()
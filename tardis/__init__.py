@@ -1,84 +1,252 @@
 import os
 import os.path
 import tempfile
+import shutil
 import logging
-import tarfile
-import gzip
+import itertools
+from collections import OrderedDict, namedtuple
 from contextlib import closing
-from cStringIO import StringIO
-
-from boto.s3.key import Key
 
 from .util import iso8601, makedirs
-from .manifest import Manifest
+from .manifest import Manifest, StreamingManifest
+from .pipeline import Pipeline, Stage, retrying
+from .progress import Progress
+from . import transfer, chunking, compression, manifest_format, pack, buffers, metrics
 
 
-__temp_archive_name = "/tmp/tardis_temp.gz" # this is awful
+def _codec_metadata(codec):
+    return { compression.CODEC_METADATA: codec }
 
 
 def key_from(bucket, manifest_entry):
-    key = Key(bucket)
-    key.key = manifest_entry.object_id
-    return key
+    return bucket.new_key(manifest_entry.object_id)
+
+
+def put_archive(bucket, create_archive, manifest_entry, **transfer_options):
+    """Stream the archive for manifest_entry straight into the bucket
+
+    transfer_options are passed on to tardis.transfer.upload
+    """
+    logging.debug("Putting archive for %s", manifest_entry)
+
+    archive = create_archive(manifest_entry.path)
+    transfer.upload(bucket, manifest_entry.object_id, archive.parts, metadata=_codec_metadata(archive.codec),
+                    **transfer_options)
+
+    logging.debug("%s put successfully", manifest_entry)
+
+
+def put_chunked_archive(bucket, create_archive, manifest_entry, threshold=chunking.MAX_CHUNK_SIZE,
+                        index=None, head_fallback=False, policy=compression.DEFAULT_POLICY,
+                        mmap_threshold=buffers.MMAP_THRESHOLD, **transfer_options):
+    """Put the content for manifest_entry as content-defined chunks
+
+    Only chunks that aren't already in the bucket are put, followed by the
+    recipe for reassembling them. Files no larger than threshold are put whole
+    with put_archive. index and head_fallback are as for is_archived, chunks
+    that are put are added to the index. Chunks are compressed as policy, a
+    tardis.compression.Policy, chooses for the file. Files of at least
+    mmap_threshold bytes are memory-mapped, see tardis.buffers.file_views.
+    """
+    if manifest_entry.stat_info.size <= threshold:
+        return put_archive(bucket, create_archive, manifest_entry, **transfer_options)
+
+    logging.debug("Putting chunked archive for %s", manifest_entry)
+
+    codec, level = policy.codec_for(manifest_entry.path)
+
+    chunk_ids = []
+    for chunk in chunking.chunks(buffers.file_views(manifest_entry.path, mmap_threshold=mmap_threshold)):
+        chunk_id = chunking.chunk_id(chunk)
+        chunk_ids.append(chunk_id)
+
+        if is_archived(bucket, chunk_id, index, head_fallback):
+            logging.debug("Chunk %s already archived", chunk_id)
+            continue
+
+        parts = metrics.timed_parts('compress', compression.compressed([chunk], codec, level))
+        transfer.upload(bucket, chunk_id, parts, metadata=_codec_metadata(codec), **transfer_options)
+        if index is not None:
+            index.add(chunk_id)
+
+    transfer.upload(bucket, manifest_entry.object_id, [chunking.to_recipe(chunk_ids)],
+                    metadata=_codec_metadata(chunking.RECIPE_CODEC), **transfer_options)
+
+    logging.debug("%s put successfully as %s chunks", manifest_entry, len(chunk_ids))
+
+
+def get_archive(bucket, manifest_entry, packs=None, **transfer_options):
+    """Stream the content of the archive for manifest_entry from the bucket
+
+    Archives are decompressed with the codec they were put with, chunked
+    archives are reassembled from their chunks. Packed content is read from
+    packs, a tardis.pack.PackCache, if given, otherwise it's fetched on its own
+    with a ranged request. transfer_options are passed on to
+    tardis.transfer.download
+    """
+    location = manifest_entry.location
+    if location:
+        member = packs.member(location) if packs else pack.get_member(bucket, location)
+        yield pack.read_member(member)
+        return
+
+    metadata = {}
+    parts = transfer.download(bucket, manifest_entry.object_id, metadata=metadata, **transfer_options)
+    first = next(parts, '')
+    parts = itertools.chain([first], parts)
 
+    # Recipes put before codecs were recorded can only be told apart by their
+    # content, gzip content never looks like a recipe
+    codec = metadata.get(compression.CODEC_METADATA) or \
+            (chunking.RECIPE_CODEC if chunking.is_recipe(first) else compression.LEGACY_CODEC)
 
-def put_archive(bucket, create_archive, manifest_entry):
-    archive_path = create_archive(manifest_entry.path)
+    if codec == chunking.RECIPE_CODEC:
+        for chunk_id in chunking.from_recipe(parts):
+            for part in _get_object(bucket, chunk_id, transfer_options):
+                yield part
+        return
 
-    logging.debug("created archive {} for {}".format(archive_path, manifest_entry))
+    for part in compression.decompressed(parts, codec):
+        yield part
 
-    with closing(key_from(bucket(), manifest_entry)) as key:
-        key.set_contents_from_filename(archive_path, encrypt_key=True)
 
-    logging.debug("{} put successfully".format(manifest_entry))
+def _get_object(bucket, object_id, transfer_options):
+    metadata = {}
+    parts = transfer.download(bucket, object_id, metadata=metadata, **transfer_options)
+    first = next(parts, '')
 
+    codec = metadata.get(compression.CODEC_METADATA) or compression.LEGACY_CODEC
+    return compression.decompressed(itertools.chain([first], parts), codec)
 
-def get_archive(bucket, manifest_entry):
-    key = key_from(bucket(), manifest_entry)
-    key.get_contents_to_filename(__temp_archive_name)   # eww
-    return __temp_archive_name                          # eww
 
+class Archive(namedtuple('Archive', ['codec', 'parts'])):
+    """The content of an archive, as an iterable of strings, compressed with
+    the codec called codec"""
+    __slots__ = ()
 
-def create_archive(path):
-    logging.debug("Creating gzip for {}".format(path))
 
-    with open(path, 'rb') as input_file:
-        with gzip.open(__temp_archive_name, 'wb') as gzip_file:
-            gzip_file.writelines(input_file)
+def create_archive(path, policy=compression.DEFAULT_POLICY, mmap_threshold=buffers.MMAP_THRESHOLD):
+    """The Archive of the file at path, compressed as policy, a
+    tardis.compression.Policy, chooses. Files of at least mmap_threshold
+    bytes are memory-mapped, see tardis.buffers.file_views."""
+    codec, level = policy.codec_for(path)
+    logging.debug("Creating %s archive for %s", codec, path)
 
-    return gzip_file.name
+    views = buffers.file_views(path, mmap_threshold=mmap_threshold)
+    return Archive(codec, metrics.timed_parts('compress', compression.compressed(views, codec, level)))
 
 
 def restore_archive(entry, archive):
-    path = entry.file_path
-    logging.debug("Restoring from gzip {}".format(path))
+    """Write archive, the iterable of strings from get_archive, into entry's file"""
+    path = entry.path
+    logging.debug("Restoring %s", path)
 
     makedirs(os.path.dirname(path))
 
-    with gzip.open(archive, 'rb') as gzip_file:
-        with open(path, 'wb') as output_file:
-            output_file.writelines(gzip_file)
+    # Written alongside and renamed into place so a failed restore doesn't
+    # leave a partial file behind
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".tardis", delete=False) as output_file:
+        try:
+            for part in archive:
+                output_file.write(part)
+        except:
+            os.unlink(output_file.name)
+            raise
 
+    os.rename(output_file.name, path)
+
+
+@metrics.timing('apply_metadata')
+def apply_metadata(entry):
+    """Set the owner, mode and times of entry's file
+
+    Failing to set the owner, e.g. when it doesn't exist on this machine, is
+    logged rather than raised, the mode and times are set regardless.
+    """
     # FIXME violates Law of Demeter
     try:
-        entry.stat_info.apply_to(path)
-    except OSError as e:
-        logging.warn("Unable to set filesystem metadata on {}: {}".format(path, e), exc_info=True)
+        entry.stat_info.apply_to(entry.path)
+    except (OSError, KeyError) as e:
+        logging.warn("Unable to set filesystem metadata on {}: {}".format(entry.path, e), exc_info=True)
+
+
+MAX_DELTA_DEPTH = 16
 
 
-def put_manifest(bucket, manifest):
-    logging.debug("Putting manifest {}".format(manifest._name))
+def put_manifest(bucket, manifest, previous=None, max_depth=MAX_DELTA_DEPTH, cache=None, packer=None, attempts=3,
+                 backoff=1.0):
+    """Put manifest, as a delta from previous if that's worthwhile
 
-    with tempfile.NamedTemporaryFile(prefix="tmpmanifest", delete=False) as csvfile:
-        manifest.to_csv(csvfile)
-        manifest_filename = csvfile.name
+    A delta is put when it's less than half the size of the full manifest,
+    unless there are already max_depth deltas since the last full manifest.
+    The manifest put is kept in cache, a tardis.cache.ManifestCache, if given.
 
+    packer is the tardis.pack.Packer that packed the backup's small files, if
+    any. Its last pack is put first, tried up to 'attempts' times with
+    exponential backoff as for the backup's other puts, and the manifest
+    records where the packed files are. Files that are unchanged since
+    previous keep their locations either way.
+    """
+    logging.debug("Putting manifest %s", manifest._name)
+
+    filenames = []
     try:
-        with closing(Key(bucket())) as key:
-            key.key = manifest._name
+        with tempfile.NamedTemporaryFile(prefix="tmpmanifest", delete=False) as manifest_file:
+            filenames.append(manifest_file.name)
+            manifest.to_binary(manifest_file)
+
+        manifest_filename = filenames[0]
+
+        if packer:
+            retrying(packer.flush, attempts, backoff)()
+
+        if packer or previous is not None:
+            with tempfile.NamedTemporaryFile(prefix="tmpmanifest", delete=False) as located_file:
+                filenames.append(located_file.name)
+                write_located(located_file, manifest_filename, packer.locations if packer else {}, previous)
+
+            manifest_filename = located_file.name
+
+        if previous is not None and previous._name and previous.depth < max_depth:
+            with tempfile.NamedTemporaryFile(prefix="tmpmanifest", delete=False) as delta_file:
+                filenames.append(delta_file.name)
+                write_delta(delta_file, manifest_filename, previous)
+
+            if os.path.getsize(delta_file.name) < os.path.getsize(manifest_filename) / 2:
+                logging.debug("Putting manifest as a delta from %s", previous._name)
+                manifest_filename = delta_file.name
+
+        with closing(bucket().new_key(manifest._name)) as key:
             key.set_contents_from_filename(manifest_filename, encrypt_key=True)
+
+        if cache:
+            cache.add(manifest._name, manifest_filename, key.etag)
     finally:
-        os.unlink(manifest_filename)
+        for filename in filenames:
+            os.unlink(filename)
+
+
+def write_located(stream, manifest_filename, locations, previous):
+    """Write the binary manifest in manifest_filename to stream with the
+    locations of the packed files, see tardis.pack.located"""
+    with open(manifest_filename, 'rb') as f:
+        header = manifest_format.read_header(f)
+        writer = manifest_format.ManifestWriter(stream, header.name, roots=header.roots)
+        for fields in manifest_format.iter_entries(f):
+            writer.write(pack.located(fields, locations, previous))
+        writer.close()
+
+
+def write_delta(stream, manifest_filename, previous):
+    """Write the delta from previous to the binary manifest in manifest_filename to stream"""
+    with open(manifest_filename, 'rb') as f:
+        header = manifest_format.read_header(f)
+        writer = manifest_format.ManifestWriter(stream, header.name, parent=previous._name,
+                                                depth=previous.depth + 1, roots=header.roots)
+        for fields in manifest_format.diff((entry.as_binary_fields() for entry in previous.entries()),
+                                           manifest_format.iter_entries(f)):
+            writer.write(fields)
+        writer.close()
 
 
 def list_manifest_keys(bucket, hostname, user):
@@ -86,72 +254,253 @@ def list_manifest_keys(bucket, hostname, user):
     return [key for key in bucket().list(prefix=key_prefix) if not key.name == key_prefix]
 
 
-def latest_manifest(bucket, hostname, user):
-    keys = list_manifest_keys(bucket, hostname, user)
+# Manifest names end in ISO8601 timestamps, which sort by year, month and day
+_TIMESTAMP_DELIMITERS = ('-', '-', 'T')
+
 
-    if not keys:
+def latest_manifest_key(bucket, hostname, user, after=None):
+    """The key of the most recent manifest, or None if there isn't one
+
+    Rather than listing every manifest this narrows down the latest year,
+    month and day first, or if after names a known manifest only lists those
+    that come after it.
+    """
+    key_prefix = Manifest.name_prefix_for(hostname, user)
+
+    if after:
+        keys = list(bucket().list(prefix=key_prefix, marker=after))
+        if keys:
+            return max(keys, key=lambda k: k.name)
+
+        key = bucket().get_key(after)
+        if key:
+            return key
+
+    prefix = key_prefix
+    for delimiter in _TIMESTAMP_DELIMITERS:
+        prefixes = [item.name for item in bucket().list(prefix=prefix, delimiter=delimiter)
+                    if item.name.endswith(delimiter)]
+        if not prefixes:
+            break
+        prefix = max(prefixes)
+
+    keys = [key for key in bucket().list(prefix=prefix) if key.name != key_prefix]
+    return max(keys, key=lambda k: k.name) if keys else None
+
+
+def latest_manifest(bucket, hostname, user, cache=None):
+    """The most recent manifest, deltas are applied to their parents
+
+    cache is a tardis.cache.ManifestCache, manifests in it aren't downloaded
+    again and the ones fetched are added to it.
+    """
+    key_prefix = Manifest.name_prefix_for(hostname, user)
+    cached_names = cache.names(key_prefix) if cache else []
+
+    key = latest_manifest_key(bucket, hostname, user, after=cached_names[-1] if cached_names else None)
+    if not key:
         return Manifest("", {})
 
-    most_recent_key = reversed(sorted(keys, key=lambda k: k.name)).next()
+    names = []
+    temporary_filenames = []
+    try:
+        filenames = []
+        name, etag = key.name, key.etag
+        while True:
+            names.append(name)
+
+            # Keys are never overwritten, the name is enough to trust a parent
+            manifest_filename = cache.path_for(name, etag) if cache else None
+            if manifest_filename:
+                logging.debug("Using cached manifest %s", name)
+            else:
+                if not key:
+                    key = bucket().get_key(name)
+                    if not key:
+                        raise LookupError("Manifest {} is missing".format(name))
+
+                fd, manifest_filename = tempfile.mkstemp(prefix="tmpmanifest")
+                temporary_filenames.append(manifest_filename)
+                with os.fdopen(fd, 'wb') as manifest_file:
+                    key.get_contents_to_file(manifest_file)
+
+                if cache:
+                    manifest_filename = cache.add(name, manifest_filename, key.etag)
+
+            filenames.append(manifest_filename)
+
+            with open(manifest_filename, 'rb') as manifest_file:
+                if not manifest_format.is_binary(manifest_file.read(len(manifest_format.MAGIC))):
+                    break
+
+                manifest_file.seek(0)
+                parent = manifest_format.read_header(manifest_file).parent
+
+            if not parent:
+                break
+
+            logging.debug("%s is a delta from %s", name, parent)
+            key, name, etag = None, parent, None
+
+        if len(filenames) == 1:
+            manifest = Manifest.from_file(filenames[0])
+        else:
+            manifest = Manifest.from_chain(reversed(filenames))
+    finally:
+        # A memory-mapped manifest can still be read once its file is unlinked
+        for filename in temporary_filenames:
+            os.unlink(filename)
 
-    with closing(StringIO(most_recent_key.get_contents_as_string())) as csvfile:
-        manifest = Manifest.from_csv(csvfile)
+    if cache:
+        cache.retain(key_prefix, names)
 
-    logging.debug("Latest manifest - {}".format(manifest._name))
+    logging.debug("Latest manifest - %s", manifest._name)
 
     return manifest
 
 
-def needs_put(bucket, entry, new_entry):
+def compact_manifest(bucket, hostname, user, cache=None):
+    """Put the latest manifest again in full, so later deltas don't need the
+    chain of deltas leading up to it"""
+    manifest = latest_manifest(bucket, hostname, user, cache)
+    if not manifest.depth:
+        logging.info("{} is already a full manifest".format(manifest._name or "No manifest"))
+        return
+
+    logging.info("Compacting {} deltas up to {}".format(manifest.depth, manifest._name))
+    with closing(StreamingManifest(Manifest.name_for(hostname, user), manifest.entries(),
+                                   manifest.roots)) as compacted:
+        put_manifest(bucket, compacted, cache=cache)
+
+
+def is_archived(bucket, object_id, index=None, head_fallback=False):
+    """Whether object_id is in the bucket
+
+    The index, a tardis.index.ObjectIndex, is consulted instead of the bucket.
+    Objects it doesn't know about are assumed missing, or looked up with a
+    HEAD request if head_fallback is set, e.g. in case another backup put
+    them since the index was loaded.
+    """
+    if index is not None:
+        if object_id in index:
+            return True
+
+        if not head_fallback:
+            return False
+
+    return bool(bucket().get_key(object_id))
+
+
+@metrics.timing('check')
+def needs_put(bucket, entry, new_entry, index=None, head_fallback=False):
     if entry.checksum_differs(new_entry) or new_entry.checksum_differs(entry): # eww
         logging.debug("Checksums differ")
 
-        if not bucket().get_key(entry.object_id):
+        if not is_archived(bucket, entry.object_id, index, head_fallback):
             logging.debug("Content not already archived")
             return True
 
     return False
 
 
-def backup(backup_roots, skip_directories, put_archive, needs_put, put_manifest, get_manifest, create_manifest):
+def backup(backup_roots, skip_directories, put_archive, needs_put, put_manifest, get_manifest, create_manifest,
+           workers=1, attempts=3, backoff=1.0):
+    """Back up the directories in backup_roots.
+
+    Changed entries are checked against the archive with needs_put and put with
+    put_archive by a pipeline running 'workers' of each concurrently, every
+    call is retried up to 'attempts' times with exponential backoff. The
+    manifest is only put once every changed entry has been put successfully,
+    otherwise a PipelineError is raised.
+
+    create_manifest can return a lazy manifest, e.g. a StreamingManifest, in
+    which case entries are checked and put as the filesystem is scanned. The
+    new manifest is closed once it's been put, or the backup has failed.
+    """
     latest_manifest = get_manifest()
 
-    new_manifest = create_manifest(backup_roots, skip_directories)
+    with closing(create_manifest(backup_roots, skip_directories)) as new_manifest:
+        check = retrying(needs_put, attempts, backoff)
+        put = retrying(put_archive, attempts, backoff)
 
-    # new_manifest can be a lazy data-structure, manifest_entry can be computed
-    # on-the-fly.
-    for path in new_manifest:
-        manifest_entry = new_manifest[path]
+        def changed_entry(manifest_entry):
+            if check(manifest_entry, latest_manifest[manifest_entry.path]):
+                logging.debug("%s needs an update, putting to S3 %s", manifest_entry.path, manifest_entry.object_id)
+                return manifest_entry
 
-        if needs_put(manifest_entry, latest_manifest[path]):
-            logging.debug("{} needs an update, putting to S3 {}".format(manifest_entry.path, manifest_entry.object_id))
-            put_archive(manifest_entry)
-        else:
-            logging.debug("{} has not changed, not putting to S3".format(manifest_entry.path))
+            logging.debug("%s has not changed, not putting to S3", manifest_entry.path)
+            return None
+
+        def put_entry(manifest_entry):
+            put(manifest_entry)
+
+        pipeline = Pipeline([ Stage('check', changed_entry, workers)
+                            , Stage('put', put_entry, workers)
+                            ])
+        pipeline.run(new_manifest.entries())
+
+        put_manifest(new_manifest, latest_manifest)
 
-    put_manifest(new_manifest)
 
+def restore(restore_roots, get_archive, restore_archive, get_manifest, apply_metadata=apply_metadata,
+            workers=1, attempts=3, backoff=1.0):
+    """Restore the directories in restore_roots.
 
-def restore(restore_roots, get_archive, restore_archive, get_manifest):
+    Each object is fetched with get_archive and restored with restore_archive
+    once, by 'workers' concurrently, with any other entries sharing the object
+    copied from the first one restored. Every fetch is retried up to
+    'attempts' times with exponential backoff. Metadata is applied by a single
+    later stage once an object's files are all written, so writing content
+    can't disturb it (e.g. reset mtimes). A PipelineError is raised at the end
+    if anything failed.
+    """
     # Here's where it gets a bit tricksy, get_manifest needs to be able to
     # create a Manifest instance from the CSV stored in S3.
     # At first glance this doesn't play well with the lazy data-structure used
     # by 'backup'.
     manifest = get_manifest()
 
+    entries_by_object = OrderedDict()
     for directory in restore_roots:
         path = os.path.abspath(directory)
 
-        logging.debug("Attempting to restore {}".format(path))
+        logging.debug("Attempting to restore %s", path)
         makedirs(path)
 
-        paths = (f for f in manifest if f.startswith(path))
+        for entry in manifest.under(path):
+            logging.debug("Manifest entry is %s", entry)
+            entries_by_object.setdefault(entry.object_id, []).append(entry)
 
-        for file_path in paths:
-            logging.debug("Found {} in manifest".format(file_path))
-            entry = manifest[file_path]
-            logging.debug("Manifest entry is {}".format(entry))
-            restore_archive(entry, get_archive(entry))
+    progress = Progress("Restored",
+                        sum(len(entries) for entries in entries_by_object.itervalues()),
+                        sum(entry.stat_info.size for entries in entries_by_object.itervalues() for entry in entries))
+
+    fetch = retrying(lambda entry: restore_archive(entry, get_archive(entry)), attempts, backoff)
+
+    def restore_content(entries):
+        first = entries[0]
+        fetch(first)
+
+        for entry in entries[1:]:
+            logging.debug("Copying %s to %s", first.path, entry.path)
+            makedirs(os.path.dirname(entry.path))
+            shutil.copyfile(first.path, entry.path)
+
+        return entries
+
+    def restore_metadata(entries):
+        for entry in entries:
+            apply_metadata(entry)
+
+        progress.update(len(entries), sum(entry.stat_info.size for entry in entries))
+
+    pipeline = Pipeline([ Stage('restore', restore_content, workers)
+                        , Stage('metadata', restore_metadata, 1)
+                        ])
+    try:
+        pipeline.run(entries_by_object.itervalues())
+    finally:
+        progress.report()
 
 
 def create_caches(roots, skip_directories, create_manifest):
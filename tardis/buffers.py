@@ -0,0 +1,56 @@
+"""Reading files through a reused buffer.
+
+f.read allocates a new string for every read. file_views instead reads into one
+preallocated bytearray with readinto and hands out views of it, so reading a
+file of any size allocates nothing beyond the buffer. Large files can be
+memory-mapped instead, their views then come straight from the page cache.
+
+A view is only good until the next one is produced. Whatever consumes the views
+(hashing, compressing, chunking, writing) has to be done with each before
+asking for the next, and must copy anything it keeps. Views are buffer objects
+on Python 2, as its zlib won't take memoryviews, and memoryviews otherwise.
+"""
+import os
+import mmap
+
+
+READ_SIZE = 2**16
+
+# A file that's truncated while it's mapped kills the process with SIGBUS, so
+# mapping files is opt-in (archive's --mmap-threshold), e.g. for trees nothing
+# else is writing to
+MMAP_THRESHOLD = None
+
+
+try:
+    view = buffer
+except NameError:
+    def view(data, offset=0, size=None):
+        data = memoryview(data)
+        return data[offset:] if size is None else data[offset:offset + size]
+
+
+def file_views(path, read_size=READ_SIZE, mmap_threshold=MMAP_THRESHOLD):
+    """Yield views of the content of the file at path, read_size bytes at a
+    time.
+
+    Files of at least mmap_threshold bytes are memory-mapped rather than read,
+    None means never.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold is not None and size and size >= mmap_threshold:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, len(mapped), read_size):
+                    yield view(mapped, offset, read_size)
+            finally:
+                mapped.close()
+            return
+
+        buf = bytearray(read_size)
+        while True:
+            length = f.readinto(buf)
+            if not length:
+                return
+            yield view(buf, 0, length)
@@ -0,0 +1,223 @@
+"""A central cache of file checksums, so unchanged files aren't read again.
+
+Object ids are cached against each file's path and its inode, size, mtime and
+ctime, if any of those change the file is checksummed again. The cache is a
+single SQLite database rather than a file in every directory backed up.
+
+Directory listings are cached too, against each directory's inode and mtime,
+see tardis.scan.
+
+Copies of the manifests last put or fetched are kept in a ManifestCache, so
+they don't have to be downloaded again.
+"""
+import os
+import os.path
+import shutil
+import sqlite3
+import logging
+import tempfile
+import threading
+import urllib
+
+from .util import makedirs
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'tardis', 'cache.db')
+DEFAULT_MANIFEST_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'tardis', 'manifests')
+
+
+class StatCache(object):
+    def __init__(self, path=DEFAULT_CACHE_PATH, batch_size=1000):
+        """Open (creating if needed) the cache at path.
+
+        Updates are written in a single transaction once batch_size files have
+        been updated, and when the cache is flushed or closed.
+        """
+        if path != ':memory:':
+            makedirs(os.path.dirname(path))
+
+        self._lock = threading.Lock()
+        self._batch_size = batch_size
+        self._pending = {}
+        self._pending_listings = {}
+        self._pending_count = 0
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.text_factory = str
+        with self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                                            path TEXT PRIMARY KEY,
+                                            directory TEXT NOT NULL,
+                                            inode INTEGER NOT NULL,
+                                            size INTEGER NOT NULL,
+                                            mtime REAL NOT NULL,
+                                            ctime REAL NOT NULL,
+                                            object_id TEXT NOT NULL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS directories (
+                                            path TEXT PRIMARY KEY,
+                                            inode INTEGER NOT NULL,
+                                            mtime REAL NOT NULL,
+                                            subdirectories BLOB NOT NULL,
+                                            files BLOB NOT NULL)""")
+
+    @staticmethod
+    def key_for(stat_struct):
+        """The values a cached object id is only valid for"""
+        return (stat_struct.st_ino, stat_struct.st_size, stat_struct.st_mtime, stat_struct.st_ctime)
+
+    @staticmethod
+    def directory_key_for(stat_struct):
+        """The values a cached directory listing is only valid for"""
+        return (stat_struct.st_ino, stat_struct.st_mtime)
+
+    def for_directory(self, directory):
+        """Cached (key, object id) pairs, by path, for the files in directory"""
+        with self._lock:
+            rows = self._pending.get(directory)
+            if rows is not None:
+                return { row[0]: (tuple(row[2:6]), row[6]) for row in rows }
+
+            rows = self._connection.execute("SELECT path, inode, size, mtime, ctime, object_id "
+                                            "FROM files WHERE directory = ?", (directory,)).fetchall()
+
+        return { row[0]: (tuple(row[1:5]), row[5]) for row in rows }
+
+    def update_directory(self, directory, entries):
+        """Replace the cached data for directory.
+
+        entries - (path, key, object id) tuples for every file in directory.
+        """
+        rows = [(path, directory) + tuple(key) + (object_id,) for path, key, object_id in entries]
+
+        with self._lock:
+            self._pending[directory] = rows
+            self._pending_count += len(rows)
+            if self._pending_count >= self._batch_size:
+                self._flush()
+
+    def listing_for(self, directory, key):
+        """The cached (subdirectory names, file names) for directory, or None if
+        it isn't cached or was cached with a different key"""
+        with self._lock:
+            row = self._pending_listings.get(directory)
+            if row is None:
+                row = self._connection.execute("SELECT path, inode, mtime, subdirectories, files "
+                                               "FROM directories WHERE path = ?", (directory,)).fetchone()
+
+        if row is None or tuple(row[1:3]) != tuple(key):
+            return None
+
+        return _split_names(row[3]), _split_names(row[4])
+
+    def update_listing(self, directory, key, subdirectories, files):
+        """Replace the cached listing for directory"""
+        row = (directory,) + tuple(key) + (_join_names(subdirectories), _join_names(files))
+
+        with self._lock:
+            self._pending_listings[directory] = row
+            self._pending_count += 1
+            if self._pending_count >= self._batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending and not self._pending_listings:
+            return
+
+        logging.debug("Writing %s cache entries", self._pending_count)
+
+        with self._connection:
+            for directory, rows in self._pending.iteritems():
+                self._connection.execute("DELETE FROM files WHERE directory = ?", (directory,))
+                self._connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+            self._connection.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)",
+                                         self._pending_listings.itervalues())
+
+        self._pending = {}
+        self._pending_listings = {}
+        self._pending_count = 0
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+
+# Names can contain anything but NUL and '/'
+def _join_names(names):
+    return sqlite3.Binary("\0".join(names))
+
+
+def _split_names(data):
+    data = str(data)
+    return data.split("\0") if data else []
+
+
+class ManifestCache(object):
+    """Local copies of manifests, by key name, along with their ETags.
+
+    Manifest keys are never overwritten, so a copy with the right name is
+    good, the ETag is there to check the latest one against a listing.
+    """
+    def __init__(self, directory=DEFAULT_MANIFEST_CACHE_PATH):
+        self._directory = directory
+        makedirs(directory)
+
+    def names(self, prefix=''):
+        """The names of the cached manifests starting with prefix, sorted"""
+        names = [urllib.unquote(filename) for filename in os.listdir(self._directory)
+                 if not filename.endswith('.etag') and not filename.startswith('.')]
+        return sorted(name for name in names if name.startswith(prefix))
+
+    def path_for(self, name, etag=None):
+        """The path of the copy of the manifest called name, or None if there
+        isn't one, or if etag is given and the copy's ETag doesn't match"""
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+
+        if etag is not None and self._etag(path) != etag:
+            logging.debug("Cached manifest %s is out of date", name)
+            return None
+
+        return path
+
+    def add(self, name, filename, etag):
+        """Keep a copy of the manifest called name, in filename"""
+        path = self._path(name)
+
+        with open(filename, 'rb') as source:
+            self._write(path, lambda f: shutil.copyfileobj(source, f))
+
+        # Written after the manifest so a copy is never taken for a newer one
+        self._write(path + '.etag', lambda f: f.write(etag))
+
+        return path
+
+    def retain(self, prefix, names):
+        """Remove the cached manifests starting with prefix other than names"""
+        for name in set(self.names(prefix)) - set(names):
+            logging.debug("Removing cached manifest %s", name)
+            for path in (self._path(name), self._path(name) + '.etag'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def _path(self, name):
+        return os.path.join(self._directory, urllib.quote(name, safe=''))
+
+    def _etag(self, path):
+        try:
+            with open(path + '.etag', 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, path, write):
+        # Written alongside and renamed into place so it's always complete
+        with tempfile.NamedTemporaryFile(dir=self._directory, prefix=".tardis", delete=False) as f:
+            write(f)
+        os.rename(f.name, path)
@@ -0,0 +1,218 @@
+"""A checkpoint of a backup in progress, so an interrupted backup can resume.
+
+The manifest is only put once everything else has been, so a backup that dies
+part way (the laptop sleeps, the network drops) leaves no record of what it
+did. The checkpoint records it as it goes: the object id of every file
+checksummed, along with the inode, size, mtime and ctime it was checksummed
+at, every object put, and the location of every object put in a pack. The
+next backup with the same checkpoint picks up where the last one stopped. It
+doesn't checksum files that haven't changed since, or check or put objects
+that were already put. It still scans everything, so the manifest it puts is
+as consistent as any other.
+
+Each record is a kind byte followed by fields separated by US (0x1f), path
+last, and a NUL:
+
+    r  the identity of the backup, a checkpoint for different directories,
+       host or user is started afresh
+    h  inode, size, mtime, ctime, object id, path
+    p  object id
+    l  object id, offset, length, pack
+
+Records are written through to the OS as they're made, and synced every
+sync_interval records and when the checkpoint is closed, so a crash only
+loses the last few. Losing them costs a checksum or a request, never
+correctness. The checkpoint is removed once a backup succeeds.
+"""
+import os
+import os.path
+import errno
+import logging
+import threading
+
+from .util import makedirs, sha1sum
+from .manifest import Location
+
+
+DEFAULT_CHECKPOINT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'tardis', 'checkpoint')
+
+IDENTITY = 'r'
+HASHED = 'h'
+PUT = 'p'
+PACKED = 'l'
+
+_SEPARATOR = '\x1f'
+
+
+class Checkpoint(object):
+    """A backup's checkpoint at path.
+
+    identity is a sequence of strings identifying the backup, e.g. the host,
+    user and directories, the checkpoint's only resumed if it matches.
+    Call clear() once the backup has succeeded, close() otherwise.
+    """
+    def __init__(self, path, identity, sync_interval=1000):
+        self._path = path
+        self._sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._unsynced = 0
+
+        # (key, object id) pairs by path, by directory, as StatCache has them
+        self.hashes = {}
+        self.put = set()
+        self.locations = {}
+
+        makedirs(os.path.dirname(path))
+
+        identity = sha1sum(['\0'.join(identity)])
+        records = self._read()
+        if records[:1] == [IDENTITY + identity]:
+            self._load(records[1:])
+            logging.info("Resuming from checkpoint {}, {} files checksummed and {} objects put".format(
+                         path, sum(len(files) for files in self.hashes.itervalues()), len(self.put)))
+            self._file = open(path, 'ab')
+        else:
+            self._file = open(path, 'wb')
+            with self._lock:
+                self._append([IDENTITY + identity])
+
+    def _read(self):
+        try:
+            with open(self._path, 'rb') as f:
+                # Anything after the last NUL was cut off mid-write
+                return f.read().split('\0')[:-1]
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def _load(self, records):
+        for record in records:
+            kind, fields = record[0], record[1:].split(_SEPARATOR)
+            if kind == HASHED:
+                inode, size, mtime, ctime, object_id = fields[:5]
+                path = _SEPARATOR.join(fields[5:])
+                key = (int(inode), int(size), float(mtime), float(ctime))
+                self.hashes.setdefault(os.path.dirname(path), {})[path] = (key, object_id)
+            elif kind == PUT:
+                self.put.add(fields[0])
+            elif kind == PACKED:
+                object_id, offset, length = fields[:3]
+                self.locations[object_id] = Location(_SEPARATOR.join(fields[3:]), int(offset), int(length))
+
+    def _append(self, records):
+        self._file.write(''.join(record + '\0' for record in records))
+        self._file.flush()
+
+        self._unsynced += len(records)
+        if self._unsynced >= self._sync_interval:
+            self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def hashes_for(self, directory):
+        """The checkpointed (key, object id) pairs by path for the files in
+        directory"""
+        with self._lock:
+            return dict(self.hashes.get(directory, {}))
+
+    def record_hashes(self, directory, entries):
+        """Record (path, key, object id) tuples for files in directory, keys as
+        from StatCache.key_for"""
+        records = [HASHED + _SEPARATOR.join([str(int(key[0])), str(int(key[1])), repr(float(key[2])),
+                                             repr(float(key[3])), object_id, path])
+                   for path, key, object_id in entries]
+        if not records:
+            return
+
+        with self._lock:
+            checkpointed = self.hashes.setdefault(directory, {})
+            checkpointed.update((path, (tuple(key), object_id)) for path, key, object_id in entries)
+            self._append(records)
+
+    def record_put(self, object_id):
+        with self._lock:
+            self.put.add(object_id)
+            self._append([PUT + object_id])
+
+    def record_locations(self, locations):
+        """Record the Locations of objects put in a pack, a dict by object id"""
+        with self._lock:
+            self.locations.update(locations)
+            self._append([PACKED + _SEPARATOR.join([object_id, str(location.offset), str(location.length),
+                                                    location.pack])
+                          for object_id, location in locations.iteritems()])
+
+    def checking(self, needs_put):
+        """Wrap needs_put, as for tardis.backup, so objects that were already
+        put don't need putting"""
+        def check(entry, previous_entry):
+            if entry.object_id in self.put or entry.object_id in self.locations:
+                return False
+            return needs_put(entry, previous_entry)
+
+        return check
+
+    def putting(self, put_archive):
+        """Wrap put_archive, as for tardis.backup, recording each object put"""
+        def put(entry):
+            put_archive(entry)
+            self.record_put(entry.object_id)
+
+        return put
+
+    def cache(self, cache=None):
+        """A cache to scan with, as for tardis.manifest.DirectoryEntry, that
+        uses and records the checkpoint's checksums, on top of cache, a
+        tardis.cache.StatCache"""
+        return CheckpointCache(self, cache)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def clear(self):
+        """Remove the checkpoint, once the backup it's for has succeeded"""
+        with self._lock:
+            self._file.close()
+        os.unlink(self._path)
+
+
+class CheckpointCache(object):
+    """The checkpoint's checksums on top of those in a StatCache.
+
+    Checksums are only recorded in the checkpoint if they weren't cached, so
+    scanning files that haven't changed adds nothing to it.
+    """
+    def __init__(self, checkpoint, cache=None):
+        self._checkpoint = checkpoint
+        self._cache = cache
+        self._lock = threading.Lock()
+        self._cached = {}
+
+    def for_directory(self, directory):
+        cached = self._cache.for_directory(directory) if self._cache else {}
+        cached.update(self._checkpoint.hashes_for(directory))
+
+        with self._lock:
+            self._cached[directory] = cached
+        return cached
+
+    def update_directory(self, directory, entries):
+        with self._lock:
+            cached = self._cached.pop(directory, {})
+
+        self._checkpoint.record_hashes(directory, [(path, key, object_id) for path, key, object_id in entries
+                                                   if cached.get(path) != (tuple(key), object_id)])
+        if self._cache:
+            self._cache.update_directory(directory, entries)
+
+    def listing_for(self, directory, key):
+        return self._cache.listing_for(directory, key) if self._cache else None
+
+    def update_listing(self, directory, key, subdirectories, files):
+        if self._cache:
+            self._cache.update_listing(directory, key, subdirectories, files)
@@ -0,0 +1,95 @@
+"""Content-defined chunking of file content.
+
+Files are split wherever a rolling "gear" hash of the preceding bytes matches a
+mask, so chunk boundaries depend on the content around them rather than on
+their offset in the file. Inserting or changing a few bytes only changes the
+chunks around the edit, everything else still produces identical chunks which
+are stored once, named by their checksum, however many files share them.
+
+A chunked file is stored as a recipe object, listing the ids of its chunks in
+order, under the file's usual object id.
+"""
+import hashlib
+
+from .util import sha1sum
+
+
+MIN_CHUNK_SIZE = 2**18
+AVERAGE_CHUNK_SIZE = 2**20
+MAX_CHUNK_SIZE = 2**22
+
+RECIPE_MAGIC = "TARDIS-CHUNKS 1\n"
+
+# Recorded as the codec of recipe objects, see tardis.compression
+RECIPE_CODEC = "recipe"
+
+# Random looking, but the same everywhere, so chunk boundaries are too
+_GEAR = [int(hashlib.sha1(chr(i)).hexdigest()[:8], 16) for i in xrange(256)]
+
+
+def chunk_id(chunk):
+    return "chunk/{}".format(sha1sum([chunk]))
+
+
+def chunks(parts, min_size=MIN_CHUNK_SIZE, average_size=AVERAGE_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """Split the content in parts into content-defined chunks.
+
+    Chunks are between min_size and max_size bytes (apart from the last one,
+    which may be smaller), average_size on average. The chunks don't depend on
+    how the content is split into parts.
+    """
+    if not 0 < min_size < average_size < max_size:
+        raise ValueError("Chunk sizes must satisfy 0 < min_size < average_size < max_size")
+
+    # The top bits of the hash depend on the most bytes
+    bits = (average_size - min_size).bit_length() - 1
+    mask = ((1 << bits) - 1) << (32 - bits)
+
+    pending = bytearray()
+    for part in parts:
+        pending.extend(part)
+
+        # Only look for a boundary once max_size bytes are available so the
+        # result is the same whatever the part sizes are.
+        while len(pending) >= max_size:
+            cut = _find_cut(pending, min_size, max_size, mask)
+            yield str(pending[:cut])
+            del pending[:cut]
+
+    while pending:
+        cut = _find_cut(pending, min_size, max_size, mask)
+        yield str(pending[:cut])
+        del pending[:cut]
+
+
+def _find_cut(data, min_size, max_size, mask):
+    # Each byte's hash depends on the last, so this can't be handed to C in
+    # one call, it scans at around 10MB/s
+    end = min(len(data), max_size)
+
+    h = 0
+    gear = _GEAR
+    for i in xrange(min_size, end):
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        if not h & mask:
+            return i + 1
+
+    return end
+
+
+def is_recipe(data):
+    return data.startswith(RECIPE_MAGIC)
+
+
+def to_recipe(chunk_ids):
+    """The recipe for a file made up of chunk_ids, in order"""
+    return RECIPE_MAGIC + "".join("{}\n".format(name) for name in chunk_ids)
+
+
+def from_recipe(parts):
+    """The chunk ids listed in the recipe in parts"""
+    recipe = "".join(parts)
+    if not is_recipe(recipe):
+        raise ValueError("Not a chunk recipe")
+
+    return recipe[len(RECIPE_MAGIC):].splitlines()
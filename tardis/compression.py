@@ -0,0 +1,236 @@
+"""Compression codecs for archive content, and the policy choosing between them.
+
+Each object records the name of the codec its content was compressed with (in
+its metadata, see tardis.transfer.upload) so it can be decompressed however it
+was put. Objects put before codecs were recorded are gzip.
+
+gzip, zlib, bz2 and none are always available. lzma, zstd and lz4 are used
+when their modules are installed (backports.lzma on Python 2, zstandard and
+lz4).
+
+Compressing content that's already compressed, e.g. JPEGs, videos or zip
+files, burns CPU for nothing. A Policy skips compression for files with those
+extensions, and for any other file whose first few KiB barely shrink when
+compressed quickly.
+"""
+import os.path
+import bz2
+import zlib
+import logging
+from collections import namedtuple, OrderedDict
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from . import transfer
+
+
+NONE = 'none'
+GZIP = 'gzip'
+
+# The codec of objects that don't record one
+LEGACY_CODEC = GZIP
+
+# The name of the object metadata recording the codec of its content
+CODEC_METADATA = 'codec'
+
+
+class Codec(namedtuple('Codec', ['name', 'default_level', 'compress', 'decompress'])):
+    """A way of compressing content.
+
+    compress(parts, level) and decompress(parts) both take and return
+    iterables of strings. compress also takes views from
+    tardis.buffers.file_views, it's done with each part before taking the next.
+    """
+    __slots__ = ()
+
+
+def _streaming(stream, parts, finish=None):
+    for part in parts:
+        data = stream(part)
+        if data:
+            yield data
+
+    if finish:
+        data = finish()
+        if data:
+            yield data
+
+
+def _identity(parts, level=None):
+    return (bytes(part) for part in parts if part)
+
+
+def _copied(parts):
+    # For the compressors that can't read the views of tardis.buffers
+    return (bytes(part) for part in parts)
+
+
+def _zlib_compressed(parts, level):
+    compressor = zlib.compressobj(level)
+    return _streaming(compressor.compress, parts, compressor.flush)
+
+
+def _zlib_decompressed(parts):
+    decompressor = zlib.decompressobj()
+    return _streaming(decompressor.decompress, parts, decompressor.flush)
+
+
+def _bz2_compressed(parts, level):
+    compressor = bz2.BZ2Compressor(level)
+    return _streaming(compressor.compress, parts, compressor.flush)
+
+
+def _bz2_decompressed(parts):
+    return _streaming(bz2.BZ2Decompressor().decompress, parts)
+
+
+def _lzma_compressed(parts, level):
+    compressor = lzma.LZMACompressor(preset=level)
+    return _streaming(compressor.compress, _copied(parts), compressor.flush)
+
+
+def _lzma_decompressed(parts):
+    return _streaming(lzma.LZMADecompressor().decompress, parts)
+
+
+def _zstd_compressed(parts, level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return _streaming(compressor.compress, _copied(parts), compressor.flush)
+
+
+def _zstd_decompressed(parts):
+    return _streaming(zstandard.ZstdDecompressor().decompressobj().decompress, parts)
+
+
+def _lz4_compressed(parts, level):
+    compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+    yield compressor.begin()
+    for data in _streaming(compressor.compress, _copied(parts), compressor.flush):
+        yield data
+
+
+def _lz4_decompressed(parts):
+    return _streaming(lz4.frame.LZ4FrameDecompressor().decompress, parts)
+
+
+CODECS = OrderedDict((codec.name, codec) for codec in [
+    Codec(NONE, None, _identity, _identity),
+    Codec(GZIP, 6, transfer.compressed, transfer.decompressed),
+    Codec('zlib', 6, _zlib_compressed, _zlib_decompressed),
+    Codec('bz2', 9, _bz2_compressed, _bz2_decompressed),
+] + ([Codec('lzma', 6, _lzma_compressed, _lzma_decompressed)] if lzma else [])
+  + ([Codec('zstd', 3, _zstd_compressed, _zstd_decompressed)] if zstandard else [])
+  + ([Codec('lz4', 0, _lz4_compressed, _lz4_decompressed)] if lz4 else []))
+
+
+def codec(name):
+    """The Codec called name, ValueError is raised if it isn't available"""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown or unavailable compression codec {}, available codecs are {}".format(
+                         name, ", ".join(CODECS)))
+
+
+def parse(spec):
+    """The (codec name, level) named by spec, e.g. 'gzip:9' or 'zstd'.
+
+    Without a level the codec's default level is used.
+    """
+    name, _, level = spec.partition(':')
+    selected = codec(name)
+
+    if not level:
+        return name, selected.default_level
+
+    try:
+        return name, int(level)
+    except ValueError:
+        raise ValueError("Invalid compression level in {}".format(spec))
+
+
+def compressed(parts, name, level=None):
+    """Compress parts with the codec called name, at its default level unless
+    level is given"""
+    selected = codec(name)
+    return selected.compress(parts, selected.default_level if level is None else level)
+
+
+def decompressed(parts, name):
+    """Decompress parts, compressed with the codec called name"""
+    return codec(name).decompress(parts)
+
+
+# Already compressed formats
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+    '.zip', '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', '.epub',
+    '.gz', '.tgz', '.bz2', '.xz', '.txz', '.lzma', '.zst', '.lz4', '.7z', '.rar',
+])
+
+SAMPLE_SIZE = 2**16
+
+# Samples have to shrink to at most this much of their size to be worth compressing
+MAX_SAMPLE_RATIO = 0.9
+
+
+class Policy(namedtuple('Policy', ['name', 'level', 'skip_extensions', 'sample_size', 'max_ratio'])):
+    """Compresses with the codec called name at level, unless the content
+    looks incompressible.
+
+    Files with INCOMPRESSIBLE_EXTENSIONS aren't compressed if skip_extensions
+    is set, nor are files whose first sample_size bytes don't compress quickly
+    to at most max_ratio of their size. A sample_size of zero skips sampling.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_spec(cls, spec, skip_extensions=True, sample_size=SAMPLE_SIZE, max_ratio=MAX_SAMPLE_RATIO):
+        name, level = parse(spec)
+        return cls(name, level, skip_extensions, sample_size, max_ratio)
+
+    def codec_for(self, path):
+        """The (codec name, level) to compress the file at path with"""
+        if self.name == NONE:
+            return NONE, None
+
+        if self.skip_extensions and os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            logging.debug("Not compressing %s, its extension says it's already compressed", path)
+            return NONE, None
+
+        if self.sample_size and not self._sample_compresses(path):
+            logging.debug("Not compressing %s, a sample of it didn't compress", path)
+            return NONE, None
+
+        return self.name, self.level
+
+    def _sample_compresses(self, path):
+        with open(path, 'rb') as f:
+            sample = f.read(self.sample_size)
+
+        # Anything too small to sample properly costs little either way
+        if len(sample) < 512:
+            return True
+
+        return len(zlib.compress(sample, 1)) <= len(sample) * self.max_ratio
+
+
+DEFAULT_POLICY = Policy.from_spec(GZIP)
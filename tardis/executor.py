@@ -0,0 +1,98 @@
+"""Executors for fanning work out across threads or processes.
+
+An executor is anything with a map(f, iterable) method that returns results in
+the same order as the input, plus close() and join() to release its workers.
+The multiprocessing pools already have this shape so they're used as-is.
+"""
+import sys
+import itertools
+import multiprocessing
+import multiprocessing.pool
+from collections import deque
+from contextlib import contextmanager
+
+
+EXECUTOR_KINDS = ('thread', 'process')
+
+
+class _SerialResult(object):
+    def __init__(self, f, args):
+        try:
+            self._value, self._exc_info = f(*args), None
+        except Exception:
+            self._value, self._exc_info = None, sys.exc_info()
+
+    def get(self):
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class SerialExecutor(object):
+    """Runs everything in the calling thread, no workers to release."""
+    def map(self, f, iterable):
+        return map(f, iterable)
+
+    def imap(self, f, iterable):
+        return itertools.imap(f, iterable)
+
+    def apply_async(self, f, args=()):
+        return _SerialResult(f, args)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def create_executor(kind='thread', jobs=1):
+    """Create an executor running up to 'jobs' tasks at once.
+
+    kind - 'thread' for I/O bound work (e.g. slow or network disks), 'process'
+           for CPU bound work, functions passed to a process executor must be
+           picklable (i.e. defined at module level).
+    jobs - number of workers, a single job always runs serially.
+    """
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1, got {}".format(jobs))
+
+    if kind not in EXECUTOR_KINDS:
+        raise ValueError("Unknown executor kind {}".format(kind))
+
+    if jobs == 1:
+        return SerialExecutor()
+
+    if kind == 'thread':
+        return multiprocessing.pool.ThreadPool(jobs)
+
+    return multiprocessing.Pool(jobs)
+
+
+def imap_bounded(executor, f, iterable, window):
+    """Like executor.imap but only 'window' items are in flight at once.
+
+    The pools' imap consumes its whole input up front, this keeps memory
+    bounded when the items are large (e.g. parts of a file).
+    """
+    if window < 1:
+        raise ValueError("window must be at least 1, got {}".format(window))
+
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.apply_async(f, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+@contextmanager
+def running(executor):
+    """Shut the executor down, waiting for its workers, once the block exits"""
+    try:
+        yield executor
+    finally:
+        executor.close()
+        executor.join()
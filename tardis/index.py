@@ -0,0 +1,58 @@
+"""An in-memory index of the objects already in the bucket.
+
+Loading the index takes one paginated listing per key prefix, i.e. one request
+per thousand objects, rather than one HEAD request per changed file.
+"""
+import re
+import logging
+import binascii
+import threading
+
+
+OBJECT_PREFIXES = ('data/', 'chunk/')
+
+_HEX_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+
+
+class ObjectIndex(object):
+    """The set of object ids known to be in the bucket.
+
+    Ids made of hex sha1sums, i.e. all of the ones tardis creates with the
+    default checksum algorithm, are held as their binary digests to keep the
+    set compact.
+    """
+    def __init__(self, object_ids=()):
+        self._lock = threading.Lock()
+        self._objects = set(self._compact(object_id) for object_id in object_ids)
+
+    def __contains__(self, object_id):
+        return self._compact(object_id) in self._objects
+
+    def __len__(self):
+        return len(self._objects)
+
+    def add(self, object_id):
+        with self._lock:
+            self._objects.add(self._compact(object_id))
+
+    @staticmethod
+    def _compact(object_id):
+        prefix, _, rest = object_id.partition('/')
+        digests = rest.split('/')
+
+        if not all(_HEX_SHA1.match(digest) for digest in digests):
+            return object_id
+
+        return prefix + '/' + ''.join(binascii.unhexlify(digest) for digest in digests)
+
+    @classmethod
+    def from_bucket(cls, bucket, prefixes=OBJECT_PREFIXES):
+        """Index every object in the bucket under prefixes"""
+        index = cls()
+        for prefix in prefixes:
+            for key in bucket().list(prefix=prefix):
+                index.add(key.name)
+
+        logging.debug("Indexed %s objects", len(index))
+
+        return index
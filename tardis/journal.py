@@ -0,0 +1,274 @@
+"""A durable journal of the directories that have changed since the last backup.
+
+The journal is written by a watcher (see tardis.watch) and read by backups,
+which then only need to scan and checksum the directories it lists, merging
+the results into the previous manifest.
+
+Each record is a kind byte followed by a path and a NUL:
+
+    d  the files directly in a directory changed
+    t  a directory was created, moved or removed, its whole subtree changed
+    !  changes were missed, the next backup has to scan everything
+
+A backup claims the journal by moving its records aside. They're released
+once the backup has succeeded, a failed backup leaves them to be claimed again
+along with anything recorded since.
+
+The watcher also records the roots it's watching, changes anywhere else are
+never recorded.
+"""
+import os
+import os.path
+import fcntl
+import errno
+import logging
+import heapq
+import bisect
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .util import makedirs, DEFAULT_ALGORITHM
+from .manifest import Manifest, StreamingManifest, _DirectoryHashing, _checksummed, _subtree_bounds
+from . import scan, buffers
+
+
+DEFAULT_JOURNAL_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'tardis', 'journal')
+
+DIRECTORY = 'd'
+TREE = 't'
+OVERFLOW = '!'
+
+
+class Changes(namedtuple('Changes', ['overflowed', 'directories', 'trees', 'roots'])):
+    """The changes claimed from a journal.
+
+    overflowed - whether changes may have been missed.
+    directories - the directories whose files changed.
+    trees - the directories whose whole subtrees changed.
+    roots - the directories being watched, changes outside them are missed.
+    """
+    __slots__ = ()
+
+
+class Journal(object):
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self._path = path
+        self._claimed_path = path + '.claimed'
+        self._lock_path = path + '.lock'
+        self._watcher_path = path + '.watcher'
+
+        makedirs(os.path.dirname(path))
+
+    def record(self, directories=(), trees=(), overflow=False):
+        """Durably append changes to the journal"""
+        records = [OVERFLOW + '\0'] if overflow else []
+        records.extend(DIRECTORY + path + '\0' for path in directories)
+        records.extend(TREE + path + '\0' for path in trees)
+
+        with self._locked():
+            with open(self._path, 'ab') as f:
+                f.write(''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+
+    @contextmanager
+    def watching(self, roots=()):
+        """Mark the journal as being watched, with changes to the directories
+        in roots being recorded, for as long as the context lasts.
+
+        Only one watcher can record into a journal at once, ValueError is
+        raised if there's already one.
+        """
+        with open(self._watcher_path, 'ab') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                raise ValueError("{} is already being watched".format(self._path))
+
+            f.truncate(0)
+            f.write(''.join(root + '\0' for root in roots))
+            f.flush()
+            os.fsync(f.fileno())
+
+            yield self
+
+    def is_watched(self):
+        with open(self._watcher_path, 'ab') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return True
+
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+
+    def claim(self):
+        """The Changes recorded since the last backup.
+
+        The changes count as overflowed if nothing is watching the journal,
+        if there's no journal, i.e. no watcher has ever written to it, or if
+        the watcher recorded that it missed changes. An empty journal that's
+        being watched means nothing has changed under the watched roots.
+        """
+        with self._locked():
+            watched = self.is_watched()
+            roots = self._watched_roots() if watched else set()
+
+            if os.path.exists(self._path):
+                with open(self._path, 'rb') as journal, open(self._claimed_path, 'ab') as claimed:
+                    claimed.write(journal.read())
+                    claimed.flush()
+                    os.fsync(claimed.fileno())
+
+                # Keep an empty journal so it's clear the watcher's been recording
+                open(self._path, 'wb').close()
+            else:
+                watched = False
+
+            with open(self._claimed_path, 'ab+') as claimed:
+                claimed.seek(0)
+                records = claimed.read().split('\0')[:-1]
+
+        directories = set(record[1:] for record in records if record[0] == DIRECTORY)
+        trees = set(record[1:] for record in records if record[0] == TREE)
+        overflowed = not watched or any(record[0] == OVERFLOW for record in records)
+
+        logging.debug("Claimed %s changed directories and %s changed trees from %s, overflowed: %s",
+                      len(directories), len(trees), self._path, overflowed)
+
+        return Changes(overflowed, directories, trees, roots)
+
+    def release(self):
+        """Forget the claimed changes, once they've been backed up"""
+        try:
+            os.unlink(self._claimed_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _watched_roots(self):
+        with open(self._watcher_path, 'rb') as f:
+            return set(f.read().split('\0')[:-1])
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def stream_changes(previous, changes, hostname, user, paths, ignored_directories=None, executor=None, cache=None,
+                   algorithm=DEFAULT_ALGORITHM, mmap_threshold=buffers.MMAP_THRESHOLD):
+    """A StreamingManifest for paths made by applying changes to the previous
+    manifest.
+
+    Only the changed directories are scanned, every other entry comes from
+    previous. Files in them that haven't changed since previous aren't
+    checksummed again, see tardis.manifest.previous_object_id. Everything is
+    scanned, as for Manifest.stream_filesystem, if the changes overflowed or
+    there's no previous manifest. So is any root that isn't within one of the
+    watched roots, whose changes weren't recorded, or isn't within one of
+    previous's roots, whose entries for it may be incomplete.
+    """
+    if changes.overflowed or next(iter(previous), None) is None:
+        logging.info("Changes may have been missed, scanning everything")
+        return Manifest.stream_filesystem(hostname, user, paths, ignored_directories, executor, cache, algorithm,
+                                          previous, mmap_threshold)
+
+    # Named before anything's scanned, as previous_object_id expects
+    name = Manifest.name_for(hostname, user)
+
+    roots = scan.roots(paths)
+    root_starts = [root + os.sep for root in roots]
+
+    def is_walked(path):
+        i = bisect.bisect_right(root_starts, path + os.sep) - 1
+        return i >= 0 and (path + os.sep).startswith(root_starts[i]) \
+                      and scan.is_walked(path, roots[i], ignored_directories)
+
+    trees = set(path for path in changes.trees if is_walked(path))
+
+    unknown = [root for root in roots if not _is_within(root, changes.roots) or not _is_within(root, previous.roots)]
+    if unknown:
+        logging.info("Scanning all of %s, changes to them weren't all recorded", ", ".join(unknown))
+    trees.update(unknown)
+    directories = set(path for path in changes.directories if is_walked(path))
+
+    # Trees are rescanned whole, or dropped if they've gone, as are any of the
+    # changed directories that have gone
+    replaced = scan.outermost(trees | set(directory for directory in directories if not os.path.isdir(directory)))
+    bounds = [_subtree_bounds(path) for path in replaced]
+    starts = [start for start, _ in bounds]
+
+    def is_replaced(path):
+        i = bisect.bisect_right(starts, path) - 1
+        return i >= 0 and path < bounds[i][1]
+
+    directories = [directory for directory in directories if not is_replaced(directory + os.sep)]
+    rescanned = set(directories)
+
+    def unchanged_entries():
+        for root in roots:
+            for entry in previous.under(root):
+                if not is_replaced(entry.path) and os.path.dirname(entry.path) not in rescanned:
+                    yield entry
+
+    changed = [Manifest.iter_filesystem([tree], ignored_directories, executor, cache, algorithm, previous,
+                                        mmap_threshold)
+               for tree in replaced if os.path.isdir(tree)]
+
+    # A changed directory that's gone by the time it's scanned is dropped along
+    # with its subtree, as if it had been replaced. Nothing in the subtree is
+    # merged in before the directory's been scanned.
+    gone = []
+    changed.append(_iter_directories(directories, gone, executor, cache, algorithm, previous, mmap_threshold))
+
+    logging.debug("Rescanning %s directories and %s trees", len(directories), len(changed) - 1)
+
+    # None of the streams share a path, so entries are never compared
+    streams = [((entry.path, entry) for entry in stream) for stream in [unchanged_entries()] + changed]
+    entries = (entry for _, entry in heapq.merge(*streams)
+               if not gone or not _is_within(os.path.dirname(entry.path), gone))
+
+    return StreamingManifest(name, entries, roots)
+
+
+def _iter_directories(directories, gone, executor, cache, algorithm, previous, mmap_threshold):
+    """The FileEntry for every file directly within directories, in path order.
+
+    Each directory is only scanned once its files could be the next ones, and
+    files are checksummed across directories as for Manifest.iter_filesystem.
+    Any directory that's gone when it comes to be scanned is added to gone.
+    """
+    def items(directory):
+        # Nothing in the directory sorts before this, so it isn't scanned until
+        # everything before it has been merged
+        yield directory + os.sep, None
+
+        try:
+            directory_scan = scan.scan_directory(directory, cache)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            logging.info("%s has gone, dropping everything under it", directory)
+            gone.append(directory)
+            return
+
+        hashing = _DirectoryHashing(directory_scan, cache, algorithm, previous)
+        for i, (path, _) in enumerate(hashing.files):
+            yield path, (hashing, i)
+
+    merged = heapq.merge(*[items(directory) for directory in directories])
+    return _checksummed((item for _, item in merged if item is not None), executor, algorithm, mmap_threshold)
+
+
+def _is_within(path, directories):
+    """Whether path is one of directories, or in one of their subtrees"""
+    return any(path == directory or path.startswith(directory + os.sep) for directory in directories)
@@ -2,14 +2,23 @@ import os
 import os.path
 import pwd, grp, stat
 
+import mmap
+import shutil
+import tempfile
+import bisect
 import logging
 import csv
+import calendar
+import datetime
 import itertools
 import functools
-from collections import namedtuple, defaultdict
+import threading
+from collections import namedtuple, defaultdict, OrderedDict, deque
 
-from tardis.util import sha1sum, iso8601
-from tardis.tree import Tree
+from tardis.util import sha1sum, iso8601, checksum, checksum_algorithm, DEFAULT_ALGORITHM
+from tardis.executor import SerialExecutor
+from tardis.cache import StatCache
+from tardis import manifest_format, scan, buffers, metrics
 
 
 class StatInfo(namedtuple('StatInfo', [ 'owner' , 'group' , 'mode' , 'ctime' , 'mtime' , 'size' ])):
@@ -19,33 +28,44 @@ class StatInfo(namedtuple('StatInfo', [ 'owner' , 'group' , 'mode' , 'ctime' , '
         if not path or not os.path.isfile(path):
             raise ValueError("Must specify a file path")
 
-        uid = pwd.getpwdnam(self.owner).pw_uid
-        gid = grp.getgrnam(self.group).gr_gid
-        os.chown(path, uid, gid)
+        # The mode and times are set even if the owner can't be, e.g. when
+        # restoring someone else's files without being root (OSError) or the
+        # owner or group doesn't exist here (KeyError)
+        try:
+            uid = pwd.getpwnam(self.owner).pw_uid
+            gid = grp.getgrnam(self.group).gr_gid
+            os.chown(path, uid, gid)
+        finally:
+            os.chmod(path, self.mode)
 
-        os.chmod(path, self.mode)
-
-        os.utime(path, (self.mtime, self.mtime))
+            os.utime(path, (self.mtime, self.mtime))
 
     @classmethod
     def for_file(cls, path):
         if not path:
             raise ValueError("Must specify a file path")
 
-        stat_struct = os.stat(path)
+        return cls.from_stat(os.stat(path))
 
+    @classmethod
+    def from_stat(cls, stat_struct):
         owner = pwd.getpwuid(stat_struct.st_uid).pw_name
         group = grp.getgrgid(stat_struct.st_gid).gr_name
         mode  = stat.S_IMODE(stat_struct.st_mode)
 
-        ctime = os.path.getctime(path)
-        mtime = os.path.getmtime(path)
-        size  = os.path.getsize(path)
+        ctime = stat_struct.st_ctime
+        mtime = stat_struct.st_mtime
+        size  = stat_struct.st_size
 
         return cls(owner, group, mode, int(ctime), int(mtime), size)
 
 
 
+class Location(namedtuple('Location', ['pack', 'offset', 'length'])):
+    """Where a file's content is in a pack object, see tardis.pack"""
+    __slots__ = ()
+
+
 class FileEntry(object):
     """An entry in the backup manifest
 
@@ -56,16 +76,15 @@ class FileEntry(object):
 
     Note that the content may not exist in S3 yet.
     """
-    def __init__(self, file_path, object_id, stat_info=None):
+    def __init__(self, file_path, object_id, stat_info=None, location=None):
         """Create a FileEntry.
 
         file_path - file name
         checksum - checksum of the file's content.
         object_id - S3 object id for the content tarball.
         stat_info - a StatInfo instance for this file, will be calculated from the file if not specified.
+        location - a Location if the content is in a pack object rather than its own object.
         """
-        logging.debug("Creating file entry for {}".format(file_path))
-
         if not file_path:
             raise ValueError("Must specify a file path")
 
@@ -78,9 +97,11 @@ class FileEntry(object):
         self.path = file_path
         self.object_id = object_id
         self.stat_info = stat_info
+        self.location = location
 
     def __repr__(self):
-        return "<FileEntry({!r}, {!r}, {!r})>".format(self.path, self.object_id, self.stat_info)
+        location = ", {!r}".format(self.location) if self.location else ""
+        return "<FileEntry({!r}, {!r}, {!r}{})>".format(self.path, self.object_id, self.stat_info, location)
 
     @property
     def checksum(self):
@@ -91,13 +112,25 @@ class FileEntry(object):
 
     @classmethod
     def from_fields(cls, fields):
-        logging.debug("Creating FileEntry from: {}".format(fields))
+        """The FileEntry for fields, as returned by as_fields or
+        as_binary_fields. Entries from csv manifests don't have the location
+        fields."""
         stat_info = StatInfo(fields[2], fields[3], int(fields[4]), int(fields[5]), int(fields[6]), long(fields[7]))
-        return cls(fields[0], fields[1], stat_info)
+
+        location = None
+        if len(fields) > 8 and fields[8]:
+            location = Location(fields[8], long(fields[9]), long(fields[10]))
+
+        return cls(fields[0], fields[1], stat_info, location)
 
     def as_fields(self):
         return (self.path, self.object_id) + self.stat_info
 
+    def as_binary_fields(self):
+        """as_fields followed by the location fields, as tardis.manifest_format
+        stores them"""
+        return self.as_fields() + (self.location or manifest_format.NOT_PACKED)
+
     def __eq__(self, other):
         if isinstance(other, FileEntry):
             return self.__dict__ == other.__dict__
@@ -124,8 +157,6 @@ class NullFileEntry(object):
 class DirectoryEntry(object):
     """
     """
-    _CACHE_IGNORE_LIMIT = 2**16
-
     def __init__(self, path, entries=None):
         self.path = path
         self.entries = entries
@@ -147,78 +178,192 @@ class DirectoryEntry(object):
     def __repr__(self):
         return "<DirectoryEntry({!r}, {!r})>".format(self.path, self.entries)
 
-    def write_cache(self):
-        """Write this directory entry to an on-disk cache"""
-        # I don't like this being here, feels impure and out-of-place
-        with open(os.path.join(self.path, '.tardis_manifest'), 'w') as f:
-            writer = csv.writer(f, delimiter=':', lineterminator='\n')
-            writer.writerows(entry.as_fields() for entry in self.entries)
+    @classmethod
+    def for_directory(cls, path, executor=None, cache=None, algorithm=DEFAULT_ALGORITHM, previous=None,
+                      mmap_threshold=buffers.MMAP_THRESHOLD):
+        """Create a DirectoryEntry for the files directly within path.
+
+        executor - checksums files that aren't cached, see tardis.executor.
+                   Files are checksummed serially if not specified.
+        cache - a tardis.cache.StatCache, files whose inode, size, mtime and
+                ctime match their cached values aren't checksummed again. The
+                cache is updated with this directory's files.
+        algorithm - the checksum algorithm, see tardis.util.checksum. Cached
+                    checksums made with another algorithm aren't used.
+        previous - the previous manifest, files that aren't cached but whose
+                   size, mtime and ctime match their entries in it aren't
+                   checksummed again either, see previous_object_id.
+        mmap_threshold - files of at least this many bytes are memory-mapped
+                         to checksum them, see tardis.buffers.file_views.
+        """
+        if not os.path.isdir(path):
+            raise ValueError("{} does not name a directory".format(path))
+
+        return cls.from_scan(scan.scan_directory(path, cache), executor, cache, algorithm, previous, mmap_threshold)
 
     @classmethod
-    def from_cache(cls, path):
-        """Read this directory entry from an on-disk cache"""
-        with open(os.path.join(path, '.tardis_manifest')) as f:
-            reader = csv.reader(f, delimiter=':', lineterminator='\n')
-            entries = [FileEntry.from_fields(row) for row in reader]
+    def from_scan(cls, directory_scan, executor=None, cache=None, algorithm=DEFAULT_ALGORITHM, previous=None,
+                  mmap_threshold=buffers.MMAP_THRESHOLD):
+        """Create a DirectoryEntry for the files in a tardis.scan.DirectoryScan,
+        as for for_directory"""
+        logging.debug("Creating directory entry for %s", directory_scan.path)
+
+        hashing = _DirectoryHashing(directory_scan, cache, algorithm, previous)
+        entries = list(_checksummed(((hashing, i) for i in xrange(len(hashing.files))), executor, algorithm,
+                                    mmap_threshold))
 
-        return cls(path, entries)
+        return cls(hashing.path, entries)
 
     @classmethod
-    def for_directory(cls, path):
-        if not os.path.isdir(path):
-            raise ValueError("{} does not name a directory".format(path))
+    def _object_id(cls, path, algorithm=DEFAULT_ALGORITHM, mmap_threshold=buffers.MMAP_THRESHOLD):
+        content_checksum = cls._checksum_for_file(path, algorithm, mmap_threshold)
+        return "data/{}/{}".format(sha1sum(os.path.basename(path)), content_checksum)
 
-        def create_cache(cache_path):
-            try:
-                with open(os.path.join(cache_path, '.tardis_manifest')) as f:
-                    reader = csv.reader(f, delimiter=':', lineterminator='\n')
-                    entries = (FileEntry.from_fields(row) for row in reader)
+    @classmethod
+    def _checksum_for_file(cls, path, algorithm=DEFAULT_ALGORITHM, mmap_threshold=buffers.MMAP_THRESHOLD):
+        if not os.path.isfile(path):
+            raise ValueError("{} does not name a file".format(path))
 
-                    return { entry.path: entry for entry in entries }
-            except (OSError, IOError):
-                logging.debug("Unable to create cache", exc_info=True)
-                return {}
+        with metrics.timed('hash'):
+            views = buffers.file_views(path, mmap_threshold=mmap_threshold)
+            content_checksum = checksum(metrics.counted('hash_bytes', views), algorithm)
+        logging.debug("%s --> %s", path, content_checksum)
 
-        def get_file_entry(cache, file_path):
-            stat_info = StatInfo.for_file(file_path)
+        return content_checksum
 
-            if stat_info.size > cls._CACHE_IGNORE_LIMIT:
-                cached_entry = cache.get(file_path, NullFileEntry())
-                if cached_entry.stat_info == stat_info:
-                    logging.debug("Using cached data for {}".format(file_path))
-                    return cached_entry
-            return FileEntry(file_path, cls._object_id(file_path), stat_info)
 
-        path = os.path.abspath(path)
+# The most files checksummed ahead of the one being consumed, see _checksummed
+HASH_WINDOW = 1024
 
-        logging.debug("Creating directory entry for {}".format(path))
 
-        make_entry = functools.partial(get_file_entry, create_cache(path))
+class _DirectoryHashing(object):
+    """The files of a tardis.scan.DirectoryScan while they're checksummed.
 
-        paths = [os.path.join(path, e) for e in sorted(os.listdir(path)) if e != '.tardis_manifest']
-        entries = [make_entry(f) for f in paths if os.path.isfile(f)]
+    The object ids of files in cache, or unchanged since previous, are known
+    up front, the rest are filled in by entry(). The directory's cached data
+    is updated once every file has an object id.
+    """
+    def __init__(self, directory_scan, cache, algorithm, previous):
+        self.path = directory_scan.path
+        self.files = directory_scan.files
+        self._cache = cache
+        self._keys = [StatCache.key_for(stat_struct) for _, stat_struct in self.files]
+        self._remaining = len(self.files)
+
+        cached = cache.for_directory(self.path) if cache else {}
+
+        def known_object_id(file_path, key, stat_struct):
+            cached_key, object_id = cached.get(file_path, (None, None))
+            if cached_key == key and checksum_algorithm(os.path.basename(object_id)) == algorithm:
+                logging.debug("Using cached data for %s", file_path)
+                return object_id
+
+            if previous is not None:
+                return previous_object_id(previous, file_path, stat_struct, algorithm)
+            return None
+
+        self.object_ids = [known_object_id(f, key, stat_struct)
+                           for (f, stat_struct), key in zip(self.files, self._keys)]
+
+        if not self.files:
+            self._update_cache()
+
+    def entry(self, i, object_id):
+        """The FileEntry for the i'th file, whose object id is object_id"""
+        self.object_ids[i] = object_id
+        self._remaining -= 1
+        if not self._remaining:
+            self._update_cache()
+
+        path, stat_struct = self.files[i]
+        return FileEntry(path, object_id, StatInfo.from_stat(stat_struct))
+
+    def _update_cache(self):
+        if self._cache:
+            self._cache.update_directory(self.path, [(f, key, object_id) for (f, _), key, object_id
+                                                     in zip(self.files, self._keys, self.object_ids)])
+
+
+def _checksummed(items, executor=None, algorithm=DEFAULT_ALGORITHM, mmap_threshold=buffers.MMAP_THRESHOLD,
+                 window=HASH_WINDOW):
+    """The FileEntry for each (_DirectoryHashing, index) pair in items, in order.
+
+    Files whose object ids aren't known are checksummed by executor as they're
+    reached, up to window files ahead of the one being consumed, no matter
+    which directories they're in. Files with known object ids skip the
+    executor.
+    """
+    if not executor:
+        executor = SerialExecutor()
 
-        return cls(path, entries)
+    object_id = functools.partial(object_id_for, algorithm=algorithm, mmap_threshold=mmap_threshold)
 
-    @classmethod
-    def _object_id(cls, path):
-        checksum = cls._checksum_for_file(path)
-        return "data/{}/{}".format(sha1sum(os.path.basename(path)), checksum)
+    pending = deque()
+    for hashing, i in items:
+        result = None
+        if not hashing.object_ids[i]:
+            result = executor.apply_async(object_id, (hashing.files[i][0],))
+        pending.append((hashing, i, result))
 
-    @classmethod
-    def _checksum_for_file(cls, path):
-        if not os.path.isfile(path):
-            raise ValueError("{} does not name a file".format(path))
+        while pending and (pending[0][2] is None or len(pending) >= window):
+            yield _resolved(*pending.popleft())
 
-        with open(path, 'rb') as f:
-            parts = iter(functools.partial(f.read, 32768), '')
-            checksum = sha1sum(parts)
+    while pending:
+        yield _resolved(*pending.popleft())
+
+
+def _resolved(hashing, i, result):
+    return hashing.entry(i, result.get() if result is not None else hashing.object_ids[i])
+
+
+def previous_object_id(previous, path, stat_struct, algorithm=DEFAULT_ALGORITHM):
+    """The object id of path's entry in previous, a manifest, if stat_struct
+    shows the file hasn't changed since, otherwise None.
+
+    Manifests only keep times to the second, so a file changed within the same
+    second it was scanned looks unchanged. Entries changed in or after the
+    second the manifest was named, before anything was scanned, aren't
+    trusted.
+    """
+    cutoff = manifest_time(getattr(previous, '_name', ''))
+    if cutoff is None:
+        return None
 
-            logging.debug("{} --> {}".format(path, checksum))
+    entry = previous[path]
+    stat_info = entry.stat_info
+    if not stat_info or stat_info.ctime >= cutoff:
+        return None
 
-        logging.debug("Content checksum: {}".format(checksum))
+    if (stat_info.size, stat_info.mtime, stat_info.ctime) != (stat_struct.st_size, int(stat_struct.st_mtime),
+                                                              int(stat_struct.st_ctime)):
+        return None
 
-        return checksum
+    if checksum_algorithm(entry.checksum) != algorithm:
+        return None
+
+    logging.debug("Using the previous manifest's checksum for %s", path)
+    return entry.object_id
+
+
+def manifest_time(name):
+    """The time a manifest called name was named at, see Manifest.name_for, in
+    whole seconds since the epoch, or None if the name doesn't say"""
+    timestamp = name.rpartition('/')[2]
+    for time_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(timestamp, time_format).timetuple())
+        except ValueError:
+            pass
+
+    return None
+
+
+def object_id_for(path, algorithm=DEFAULT_ALGORITHM, mmap_threshold=buffers.MMAP_THRESHOLD):
+    """The S3 object id for the file at path.
+
+    This lives at module level so it can be pickled and sent to a process pool.
+    """
+    return DirectoryEntry._object_id(path, algorithm, mmap_threshold)
 
 
 
@@ -230,13 +375,37 @@ class Manifest(object):
     Manifest keys are named in the following format:
 
     manifest/{hostname}/{user}/{timestamp}
+
+    The key may hold a full manifest or a delta from an earlier one, depth is
+    the number of deltas between this manifest and the last full one. roots
+    are the directories that were backed up, empty if that isn't known (e.g.
+    for legacy csv manifests).
     """
-    def __init__(self, name, manifest):
+    depth = 0
+
+    def __init__(self, name, manifest, roots=()):
         self._name = name
         self._manifest = dict(manifest)
+        self._paths = None
+        self.roots = tuple(roots)
 
     def __iter__(self):
-        return iter(self._manifest)
+        """Paths in sorted order"""
+        return iter(self._sorted_paths())
+
+    def under(self, directory):
+        """The entries for files in directory or any of its subdirectories, in
+        path order"""
+        paths = self._sorted_paths()
+        start, end = _subtree_bounds(directory)
+
+        for i in xrange(bisect.bisect_left(paths, start), bisect.bisect_left(paths, end)):
+            yield self._manifest[paths[i]]
+
+    def _sorted_paths(self):
+        if self._paths is None:
+            self._paths = sorted(self._manifest)
+        return self._paths
 
     def __getitem__(self, item):
         return self._manifest.get(item, NullFileEntry())
@@ -246,7 +415,7 @@ class Manifest(object):
 
     def __eq__(self, other):
         if isinstance(other, Manifest):
-            return self.__dict__ == other.__dict__
+            return (self._name, self._manifest) == (other._name, other._manifest)
         return NotImplemented
 
     def __ne__(self, other):
@@ -256,7 +425,7 @@ class Manifest(object):
         return not result
 
     def to_csv(self, stream):
-        logging.debug("Writing {} to csv, entries: {}".format(self.__class__, self._manifest))
+        logging.debug("Writing %s to csv, entries: %s", self.__class__, self._manifest)
 
         writer = csv.writer(stream, delimiter=':', lineterminator='\n')
         writer.writerow([self._name])
@@ -264,6 +433,107 @@ class Manifest(object):
             entry = self._manifest[path]
             writer.writerow(entry.as_fields())
 
+    def entries(self):
+        """The FileEntry objects in this manifest, in path order"""
+        return (self._manifest[path] for path in self._sorted_paths())
+
+    def to_binary(self, stream):
+        """Write this manifest to stream in the binary format, see tardis.manifest_format"""
+        writer = manifest_format.ManifestWriter(stream, self._name, roots=self.roots)
+        for path in sorted(self._manifest):
+            writer.write(self._manifest[path].as_binary_fields())
+        writer.close()
+
+    def close(self):
+        """Nothing to release, as for the other manifests' close()"""
+        pass
+
+    @classmethod
+    def load(cls, stream):
+        """Read a manifest in either the binary or the legacy csv format"""
+        header, entries = cls.iter_stream(stream)
+        return cls(header.name, ((entry.path, entry) for entry in entries), header.roots)
+
+    @classmethod
+    def from_file(cls, path):
+        """Read the manifest in the file at path.
+
+        Binary manifests are memory-mapped rather than read into memory, see
+        MappedManifest.
+        """
+        with open(path, 'rb') as f:
+            if not manifest_format.is_binary(f.read(len(manifest_format.MAGIC))):
+                f.seek(0)
+                return cls.load(f)
+
+        return MappedManifest(path)
+
+    @classmethod
+    def from_chain(cls, paths):
+        """The manifest made by applying the deltas in the files at paths, in
+        order, to the full manifest in the first file.
+
+        The result is written to a temporary file and memory-mapped, see
+        MappedManifest.
+        """
+        streams = []
+        try:
+            for path in paths:
+                streams.append(open(path, 'rb'))
+
+            # The full manifest may be in the legacy csv format, which isn't sorted
+            binary = manifest_format.is_binary(streams[0].read(len(manifest_format.MAGIC)))
+            streams[0].seek(0)
+
+            header, base = cls.iter_stream(streams[0])
+            if not binary:
+                base = sorted(base, key=lambda entry: entry.path)
+            headers = [header]
+            headers.extend(manifest_format.read_header(stream) for stream in streams[1:])
+
+            for header, parent in zip(headers[1:], headers):
+                if header.parent != parent.name:
+                    raise manifest_format.ManifestFormatError("{} is not the parent of {}".format(parent.name,
+                                                                                              header.name))
+
+            fields = manifest_format.patch((entry.as_binary_fields() for entry in base),
+                                           [manifest_format.iter_entries(stream) for stream in streams[1:]])
+
+            with tempfile.NamedTemporaryFile(prefix="tmpmanifest") as f:
+                writer = manifest_format.ManifestWriter(f, headers[-1].name, depth=headers[-1].depth,
+                                                        roots=headers[-1].roots)
+                for entry_fields in fields:
+                    writer.write(entry_fields)
+                writer.close()
+                f.flush()
+
+                # The map outlives the file
+                return MappedManifest(f.name)
+        finally:
+            for stream in streams:
+                stream.close()
+
+    @classmethod
+    def iter_stream(cls, stream):
+        """The manifest_format.Header of the manifest in stream and an iterator
+        over its entries.
+
+        Entries are read from stream as the iterator is consumed, the format
+        (binary or legacy csv) is detected from the start of the stream.
+        """
+        prefix = stream.read(len(manifest_format.MAGIC))
+        stream = _Unread(prefix, stream)
+
+        if manifest_format.is_binary(prefix):
+            header = manifest_format.read_header(stream)
+            _check_not_delta(header)
+            entries = (_entry_for(fields) for fields in manifest_format.iter_entries(stream))
+            return header, entries
+
+        reader = csv.reader(stream, delimiter=':', lineterminator='\n')
+        name = next(reader)[0]
+        return manifest_format.Header(name, "", 0), (FileEntry.from_fields(row) for row in reader)
+
     @classmethod
     def from_csv(cls, stream):
         reader = csv.reader(stream, delimiter=':', lineterminator='\n')
@@ -277,7 +547,8 @@ class Manifest(object):
         return cls(manifest_name, file_entries)
 
     @classmethod
-    def from_filesystem(cls, hostname, user, paths, ignored_directories=None):
+    def from_filesystem(cls, hostname, user, paths, ignored_directories=None, executor=None, cache=None,
+                        algorithm=DEFAULT_ALGORITHM, previous=None, mmap_threshold=buffers.MMAP_THRESHOLD):
         if not hostname:
             raise ValueError("hostname must be a non-empty string")
 
@@ -287,40 +558,46 @@ class Manifest(object):
         if not paths:
             raise ValueError("paths must be an iterable of paths to back up")
 
-        def to_directory_entry(directory_path):
-            entry = DirectoryEntry.for_directory(directory_path)
-            entry.write_cache()
-            return entry
-
-        file_entries = {}
-        for path in paths:
-            file_entries.update(cls._build_manifest(path, to_directory_entry, ignored_directories))
-
-        return cls(cls.name_for(hostname, user), file_entries)
+        roots = scan.roots(paths)
+        return cls(cls.name_for(hostname, user), ((entry.path, entry) for entry
+                                                   in cls.iter_filesystem(roots, ignored_directories, executor, cache,
+                                                                         algorithm, previous, mmap_threshold)),
+                   roots)
 
     @classmethod
-    def _build_manifest(cls, path, f, ignored_directories=None):
-        if not path:
-            raise ValueError("path must be a non-empty string")
-
-        if not f:
-            raise ValueError("transform function must be specified")
-
-        path = os.path.abspath(path)
-        if not os.path.isdir(path):
-            raise ValueError("{} does not name a directory".format(path))
+    def stream_filesystem(cls, hostname, user, paths, ignored_directories=None, executor=None, cache=None,
+                          algorithm=DEFAULT_ALGORITHM, previous=None, mmap_threshold=buffers.MMAP_THRESHOLD):
+        """As from_filesystem, but returns a StreamingManifest that scans and
+        checksums files as its entries are consumed"""
+        if not hostname:
+            raise ValueError("hostname must be a non-empty string")
 
-        if not ignored_directories:
-            ignored_directories = []
+        if not user:
+            raise ValueError("user must be a non-empty string")
 
-        def child_directories(dirname):
-            names = [os.path.join(dirname, name) for name in os.listdir(dirname) if not name.startswith(".")]
-            return [name for name in names if os.path.isdir(name) and not name in ignored_directories]
+        if not paths:
+            raise ValueError("paths must be an iterable of paths to back up")
 
-        directory_tree = Tree.build_tree(path, child_directories)
-        manifest_tree = directory_tree.fmap(f)
+        roots = scan.roots(paths)
+        return StreamingManifest(cls.name_for(hostname, user),
+                                 cls.iter_filesystem(roots, ignored_directories, executor, cache, algorithm, previous,
+                                                     mmap_threshold),
+                                 roots)
 
-        return { entry.path: entry for entry in itertools.chain.from_iterable(manifest_tree) }
+    @classmethod
+    def iter_filesystem(cls, paths, ignored_directories=None, executor=None, cache=None, algorithm=DEFAULT_ALGORITHM,
+                        previous=None, mmap_threshold=buffers.MMAP_THRESHOLD):
+        """An iterator over the FileEntry for every file in paths, in path
+        order. Directories are scanned and checksummed as it's consumed, see
+        tardis.scan.walk. executor checksums files from any number of
+        directories at once, up to HASH_WINDOW files ahead."""
+        def hashing(directory_scan):
+            directory_hashing = _DirectoryHashing(directory_scan, cache, algorithm, previous)
+            return [(directory_hashing, i) for i in xrange(len(directory_hashing.files))]
+
+        items = itertools.chain.from_iterable(scan.walk(root, hashing, ignored_directories, cache)
+                                              for root in scan.roots(paths))
+        return _checksummed(items, executor, algorithm, mmap_threshold)
 
     @classmethod
     def name_prefix_for(cls, hostname, user):
@@ -329,3 +606,178 @@ class Manifest(object):
     @classmethod
     def name_for(cls, hostname, user):
         return cls.name_prefix_for(hostname, user) + iso8601()
+
+
+
+class StreamingManifest(object):
+    """A manifest made from a stream of FileEntry objects, in path order, e.g.
+    from Manifest.iter_filesystem.
+
+    The entries are spooled to a temporary file in the binary format as they're
+    consumed with entries(), so only the entries in flight are held in memory.
+    to_binary writes out the complete manifest, consuming any entries left.
+    Call close() to remove the spooled entries once done with it. roots are
+    as for Manifest.
+    """
+    depth = 0
+
+    def __init__(self, name, entries, roots=()):
+        self._name = name
+        self.roots = tuple(roots)
+        self._entries = iter(entries)
+        self._spool = tempfile.TemporaryFile(prefix="tmpmanifest")
+        self._writer = manifest_format.ManifestWriter(self._spool, name, roots=self.roots)
+        self._complete = False
+
+    def entries(self):
+        """Yield the entries not yet consumed"""
+        for entry in self._entries:
+            self._writer.write(entry.as_binary_fields())
+            yield entry
+
+        if not self._complete:
+            self._writer.close()
+            self._complete = True
+
+    def to_binary(self, stream):
+        for _ in self.entries():
+            pass
+
+        self._spool.seek(0)
+        shutil.copyfileobj(self._spool, stream)
+
+    def close(self):
+        self._spool.close()
+
+
+
+class MappedManifest(object):
+    """A read-only binary manifest, memory-mapped from a file.
+
+    Lookups binary search the block index for the block that could hold a path
+    and only decode that block, so only the pages of the file actually used
+    are read. Recently decoded blocks are kept, looking paths up in order only
+    decodes each block once.
+
+    Behaves like a Manifest for reading.
+    """
+    _CACHED_BLOCKS = 4
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header, index = manifest_format.read_index(self._map)
+        _check_not_delta(header)
+
+        self._name = header.name
+        self.depth = header.depth
+        self.roots = header.roots
+        self._offsets = [offset for offset, _ in index]
+        self._first_paths = [first_path for _, first_path in index]
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        for i in xrange(len(self._offsets)):
+            for path in self._block(i):
+                yield path
+
+    def entries(self):
+        """The FileEntry objects in this manifest, in path order"""
+        for i in xrange(len(self._offsets)):
+            for fields in self._block(i).itervalues():
+                yield _entry_for(fields)
+
+    def __getitem__(self, item):
+        block = self._block_for(item)
+        if block is None or item not in block:
+            return NullFileEntry()
+
+        fields = block[item]
+        return _entry_for(fields)
+
+    def __contains__(self, item):
+        block = self._block_for(item)
+        return block is not None and item in block
+
+    def under(self, directory):
+        """The entries for files in directory or any of its subdirectories, in
+        path order"""
+        start, end = _subtree_bounds(directory)
+
+        for i in xrange(max(bisect.bisect_right(self._first_paths, start) - 1, 0), len(self._offsets)):
+            if self._first_paths[i] >= end:
+                return
+
+            for path, fields in self._block(i).iteritems():
+                if start <= path < end:
+                    yield _entry_for(fields)
+
+    def close(self):
+        self._map.close()
+
+    def _block_for(self, path):
+        i = bisect.bisect_right(self._first_paths, path) - 1
+        if i < 0:
+            return None
+        return self._block(i)
+
+    def _block(self, i):
+        with self._lock:
+            block = self._blocks.pop(i, None)
+            if block is None:
+                fields = manifest_format.read_block(self._map, self._offsets[i])
+                block = OrderedDict((entry_fields[0], entry_fields) for entry_fields in fields)
+                if len(self._blocks) >= self._CACHED_BLOCKS:
+                    self._blocks.popitem(last=False)
+
+            self._blocks[i] = block
+            return block
+
+
+def _entry_for(fields):
+    """The FileEntry for fields read from a binary manifest"""
+    location = Location(*fields[8:]) if fields[8] else None
+    return FileEntry(fields[0], fields[1], StatInfo(*fields[2:8]), location)
+
+
+def _check_not_delta(header):
+    if header.parent:
+        raise manifest_format.ManifestFormatError("{} is a delta from {}, it can only be read along with its "
+                                                  "parents".format(header.name, header.parent))
+
+
+def _subtree_bounds(directory):
+    """Paths in directory's subtree sort between these bounds.
+
+    i.e. from directory + '/' up to, but not including, directory + '0', '0'
+    being the character after '/'. Sibling directories sharing a prefix, like
+    /home/a and /home/ab, fall outside the bounds.
+    """
+    directory = directory.rstrip(os.sep)
+    return directory + os.sep, directory + chr(ord(os.sep) + 1)
+
+
+class _Unread(object):
+    """A stream with data that's already been read from it pushed back on"""
+    def __init__(self, data, stream):
+        self._data = data
+        self._stream = stream
+
+    def read(self, size):
+        data, self._data = self._data[:size], self._data[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+        return data
+
+    def readline(self):
+        if '\n' in self._data:
+            line, _, self._data = self._data.partition('\n')
+            return line + '\n'
+
+        data, self._data = self._data, ''
+        return data + self._stream.readline()
+
+    def __iter__(self):
+        return iter(self.readline, '')
@@ -0,0 +1,369 @@
+"""A compact, versioned binary format for manifests.
+
+Entries are written sorted by path in zlib compressed blocks. Within a block
+each path only stores the suffix it doesn't share with the previous path, the
+stat fields are fixed width. Blocks are self-contained so they can be decoded
+independently, an index of each block's offset and first path follows the last
+block.
+
+    header  MAGIC, version (uint16), name length (uint32), name,
+            parent length (uint32), parent, depth (uint32),
+            root count (uint32), per root: length (uint32), root
+    blocks  compressed length (uint32), compressed block
+            ... terminated by a zero length
+    index   per block: offset (uint64), first path length (uint32), first path
+    footer  index offset (uint64), block count (uint32), END_MAGIC
+
+Each block decompresses to an entry count (uint32) followed by the entries:
+
+    shared path prefix length, path suffix length, path suffix,
+    object id length, object id, owner length, owner, group length, group,
+    mode (uint32), ctime (int64), mtime (int64), size (uint64),
+    pack length, pack, offset, length
+
+with lengths, offset and length as unsigned LEB128 varints. All other integers
+are big-endian. pack is empty unless the content is packed, see tardis.pack,
+in which case offset and length locate it within the pack object.
+
+A manifest with a parent is a delta, it only holds the entries that were added
+or changed since its parent, plus an entry with an empty object id for each
+path that was removed. depth is the number of deltas between the manifest and
+the full manifest at the root of its chain.
+
+roots are the directories that were backed up, see
+tardis.journal.stream_changes. Every manifest records its own, deltas
+included.
+
+The reader only ever reads forwards so manifests can be streamed from anywhere,
+e.g. straight from S3.
+
+Entries are handled as field tuples, as returned by FileEntry.as_binary_fields:
+
+    (path, object id, owner, group, mode, ctime, mtime, size, pack, offset, length)
+"""
+import zlib
+import heapq
+import struct
+from collections import namedtuple
+
+
+MAGIC = "TARDISMF"
+END_MAGIC = "TARDISMX"
+VERSION = 3
+
+BLOCK_ENTRIES = 4096
+
+_HEADER = struct.Struct(">HI")
+_LENGTH = struct.Struct(">I")
+_STAT = struct.Struct(">IqqQ")
+_INDEX_ENTRY = struct.Struct(">QI")
+_FOOTER = struct.Struct(">QI")
+
+
+class ManifestFormatError(ValueError):
+    pass
+
+
+class Header(namedtuple('Header', ['name', 'parent', 'depth', 'roots'])):
+    """A manifest's name, for deltas the name of its parent and its depth, and
+    the directories that were backed up.
+
+    Full manifests have an empty parent and a depth of zero.
+    """
+    __slots__ = ()
+
+Header.__new__.__defaults__ = ((),)
+
+# The pack fields of entries whose content isn't packed
+NOT_PACKED = ("", 0, 0)
+
+
+def is_binary(prefix):
+    """Whether prefix, the start of a manifest, is in the binary format"""
+    return prefix.startswith(MAGIC)
+
+
+class ManifestWriter(object):
+    """Writes a binary manifest to a stream.
+
+    Entries' fields must be written in order of path, call close() once all
+    the entries have been written. Only as many entries as fit in a block are
+    held in memory at once. Deltas are written with the name of their parent
+    and their depth, see diff. roots are the directories that were backed up.
+    """
+    def __init__(self, stream, name, block_entries=BLOCK_ENTRIES, parent="", depth=0, roots=()):
+        self._stream = stream
+        self._block_entries = block_entries
+        self._block = []
+        self._index = []
+        self._offset = 0
+        self._last_path = None
+
+        self._write(MAGIC + _HEADER.pack(VERSION, len(name)) + name +
+                    _LENGTH.pack(len(parent)) + parent + _LENGTH.pack(depth) +
+                    _LENGTH.pack(len(roots)) + ''.join(_LENGTH.pack(len(root)) + root for root in roots))
+
+    def write(self, fields):
+        path = fields[0]
+        if self._last_path is not None and path <= self._last_path:
+            raise ValueError("Entries must be written in order, {} follows {}".format(path, self._last_path))
+
+        self._last_path = path
+        self._block.append(fields)
+        if len(self._block) >= self._block_entries:
+            self._write_block()
+
+    def close(self):
+        if self._block:
+            self._write_block()
+
+        self._write(_LENGTH.pack(0))
+
+        index_offset = self._offset
+        for offset, first_path in self._index:
+            self._write(_INDEX_ENTRY.pack(offset, len(first_path)) + first_path)
+
+        self._write(_FOOTER.pack(index_offset, len(self._index)) + END_MAGIC)
+
+    def _write(self, data):
+        self._stream.write(data)
+        self._offset += len(data)
+
+    def _write_block(self):
+        parts = [_LENGTH.pack(len(self._block))]
+
+        previous = ""
+        for path, object_id, owner, group, mode, ctime, mtime, size, pack, offset, length in self._block:
+            shared = _shared_prefix_length(previous, path)
+
+            parts.append(_varint(shared))
+            parts.append(_string(path[shared:]))
+            parts.append(_string(object_id))
+            parts.append(_string(owner))
+            parts.append(_string(group))
+            parts.append(_STAT.pack(mode, ctime, mtime, size))
+            parts.append(_string(pack))
+            parts.append(_varint(offset))
+            parts.append(_varint(length))
+
+            previous = path
+
+        data = zlib.compress("".join(parts))
+
+        self._index.append((self._offset, self._block[0][0]))
+        self._write(_LENGTH.pack(len(data)) + data)
+        self._block = []
+
+
+def read_header(stream):
+    """Read the Header from the start of stream"""
+    magic = _read_exactly(stream, len(MAGIC))
+    if magic != MAGIC:
+        raise ManifestFormatError("Not a binary manifest")
+
+    version, name_length = _HEADER.unpack(_read_exactly(stream, _HEADER.size))
+    _check_version(version)
+
+    name = _read_exactly(stream, name_length)
+    parent_length, = _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))
+    parent = _read_exactly(stream, parent_length)
+    depth, = _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))
+
+    root_count, = _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))
+    roots = []
+    for _ in xrange(root_count):
+        root_length, = _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))
+        roots.append(_read_exactly(stream, root_length))
+
+    return Header(name, parent, depth, tuple(roots))
+
+
+def read_index(data):
+    """The Header and block index of the manifest in data, a str or mmap.
+
+    The index is a list of (offset, first path) pairs, one per block, sorted by
+    path.
+    """
+    if data[:len(MAGIC)] != MAGIC or data[-len(END_MAGIC):] != END_MAGIC:
+        raise ManifestFormatError("Not a complete binary manifest")
+
+    version, name_length = _HEADER.unpack_from(data, len(MAGIC))
+    _check_version(version)
+
+    offset = len(MAGIC) + _HEADER.size
+    name = data[offset:offset + name_length]
+    offset += name_length
+    parent_length, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    parent = data[offset:offset + parent_length]
+    offset += parent_length
+    depth, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+
+    root_count, = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    roots = []
+    for _ in xrange(root_count):
+        root_length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        roots.append(data[offset:offset + root_length])
+        offset += root_length
+
+    header = Header(name, parent, depth, tuple(roots))
+
+    offset, block_count = _FOOTER.unpack_from(data, len(data) - len(END_MAGIC) - _FOOTER.size)
+
+    index = []
+    for _ in xrange(block_count):
+        block_offset, path_length = _INDEX_ENTRY.unpack_from(data, offset)
+        offset += _INDEX_ENTRY.size
+        index.append((block_offset, data[offset:offset + path_length]))
+        offset += path_length
+
+    return header, index
+
+
+def _check_version(version):
+    if version != VERSION:
+        raise ManifestFormatError("Unsupported manifest version {}".format(version))
+
+
+def read_block(data, offset):
+    """The fields of the entries in the block at offset in data, a str or mmap"""
+    length, = _LENGTH.unpack_from(data, offset)
+    start = offset + _LENGTH.size
+    return decode_block(data[start:start + length])
+
+
+def iter_entries(stream):
+    """Yield the fields of the entries in stream, which must be positioned
+    just after the header"""
+    while True:
+        length, = _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))
+        if not length:
+            return
+
+        for fields in decode_block(_read_exactly(stream, length)):
+            yield fields
+
+
+def decode_block(data):
+    """The fields of the entries in a compressed block"""
+    block = zlib.decompress(data)
+
+    count, = _LENGTH.unpack_from(block, 0)
+    offset = _LENGTH.size
+
+    path = ""
+    for _ in xrange(count):
+        shared, offset = _read_varint(block, offset)
+        suffix, offset = _read_string(block, offset)
+        object_id, offset = _read_string(block, offset)
+        owner, offset = _read_string(block, offset)
+        group, offset = _read_string(block, offset)
+        mode, ctime, mtime, size = _STAT.unpack_from(block, offset)
+        offset += _STAT.size
+        pack, offset = _read_string(block, offset)
+        pack_offset, offset = _read_varint(block, offset)
+        pack_length, offset = _read_varint(block, offset)
+
+        path = path[:shared] + suffix
+        yield (path, object_id, owner, group, mode, ctime, mtime, size, pack, pack_offset, pack_length)
+
+
+def removed(path):
+    """The fields recording that path was removed, in a delta"""
+    return (path, "", "", "", 0, 0, 0, 0) + NOT_PACKED
+
+
+def is_removed(fields):
+    return not fields[1]
+
+
+def diff(old, new):
+    """The fields of the delta from old to new, both iterables of entries'
+    fields in path order"""
+    old = iter(old)
+    new = iter(new)
+    old_fields = next(old, None)
+    new_fields = next(new, None)
+
+    while old_fields is not None or new_fields is not None:
+        if new_fields is None or (old_fields is not None and old_fields[0] < new_fields[0]):
+            yield removed(old_fields[0])
+            old_fields = next(old, None)
+        elif old_fields is None or new_fields[0] < old_fields[0]:
+            yield new_fields
+            new_fields = next(new, None)
+        else:
+            if tuple(old_fields) != tuple(new_fields):
+                yield new_fields
+            old_fields = next(old, None)
+            new_fields = next(new, None)
+
+
+def patch(base, deltas):
+    """The fields of the entries in base, a full manifest's entries, with
+    deltas, oldest first, applied in turn. Everything is in path order."""
+    def keyed(stream, age):
+        return ((fields[0], age, fields) for fields in stream)
+
+    streams = [keyed(stream, -i) for i, stream in enumerate([base] + list(deltas))]
+
+    last_path = None
+    for path, _, fields in heapq.merge(*streams):
+        # The newest version of each path comes first
+        if path == last_path:
+            continue
+        last_path = path
+
+        if not is_removed(fields):
+            yield fields
+
+
+def _shared_prefix_length(a, b):
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return str(data)
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _string(value):
+    return _varint(len(value)) + value
+
+
+def _read_string(data, offset):
+    length, offset = _read_varint(data, offset)
+    return data[offset:offset + length], offset + length
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ManifestFormatError("Manifest is truncated")
+    return data
@@ -0,0 +1,260 @@
+"""Counters and timings of the stages of backups and restores.
+
+Stages record how long each call took in a histogram, and how many bytes they
+handled in a counter named after the stage with '_bytes' added:
+
+    scan            reading a directory, including stat'ing its files
+    stat            stat'ing a file
+    hash            checksumming a file, including reading it
+    compress        producing an archive's compressed parts, including reading
+                    the file
+    check           checking whether an entry's content needs putting
+    upload          a put request, for an object or a part of one
+    download        waiting on the parts of an object being fetched
+    apply_metadata  setting a restored file's owner, mode and times
+
+Everything is recorded in METRICS unless another Metrics is passed, e.g. in
+tests. Stages run by a process executor (see tardis.executor) are recorded in
+the worker processes, not here.
+
+An end of run summary comes from summary(), write() saves everything as JSON or
+as a Prometheus textfile. profiling() runs cProfile over every thread started
+within it.
+"""
+import os
+import json
+import time
+import bisect
+import cProfile
+import pstats
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+
+
+# The upper bounds of the histograms' buckets, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, float('inf'))
+
+PROMETHEUS_PREFIX = 'tardis_'
+
+
+class _Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the q quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+class Metrics(object):
+    """A thread-safe set of named counters and timing histograms"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._timings.get(name)
+            if histogram is None:
+                histogram = self._timings[name] = _Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, name):
+        """Record how long the with block takes under name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def timing(self, name):
+        """Decorator recording how long each call of a function takes"""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timed(name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def counted(self, name, parts):
+        """Yield parts, counting their bytes under name"""
+        for part in parts:
+            self.count(name, len(part))
+            yield part
+
+    def timed_parts(self, name, parts):
+        """Yield parts, recording the time spent producing them, but not
+        consuming them, as one timing of name once they're exhausted. Their
+        bytes are counted under name + '_bytes'."""
+        elapsed = 0.0
+        size = 0
+        parts = iter(parts)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    part = next(parts)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.time() - start
+
+                size += len(part)
+                yield part
+        finally:
+            self.observe(name, elapsed)
+            self.count(name + '_bytes', size)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._timings = {}
+
+    def snapshot(self):
+        """Everything recorded so far, as a dict of counters and a dict of
+        timings, each timing a dict of its count, sum and bucket counts (see
+        BUCKETS)"""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timings': dict((name, { 'count': histogram.count
+                                       , 'sum': histogram.sum
+                                       , 'buckets': list(histogram.buckets)
+                                       })
+                                for name, histogram in self._timings.iteritems())
+            }
+
+    def summary(self):
+        """A table of each stage's calls, time and throughput"""
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        with self._lock:
+            p95s = dict((name, histogram.quantile(0.95)) for name, histogram in self._timings.iteritems())
+
+        lines = ["{:<16} {:>9} {:>10} {:>10} {:>10} {:>10}".format("stage", "calls", "total s", "mean ms",
+                                                                   "p95 ms <", "MB/s")]
+        for name, timing in sorted(snapshot['timings'].iteritems()):
+            mean = timing['sum'] / timing['count'] if timing['count'] else 0.0
+            size = counters.get(name + '_bytes')
+            rate = "{:10.1f}".format(size / 2.0**20 / timing['sum']) if size and timing['sum'] else " " * 10
+            lines.append("{:<16} {:>9} {:>10.3f} {:>10.3f} {:>10} {}".format(
+                         name, timing['count'], timing['sum'], mean * 1000, _milliseconds(p95s[name]), rate))
+
+        for name, value in sorted(counters.iteritems()):
+            if not (name.endswith('_bytes') and name[:-len('_bytes')] in snapshot['timings']):
+                lines.append("{:<16} {:>9}".format(name, value))
+
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Save everything to path, as JSON if it ends with .json, otherwise in
+        the Prometheus text format. The file is replaced atomically, as
+        Prometheus' textfile collector requires."""
+        if path.endswith('.json'):
+            content = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        else:
+            content = self.prometheus()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tardis_metrics")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+
+        lines = []
+        for name, value in sorted(snapshot['counters'].iteritems()):
+            metric = PROMETHEUS_PREFIX + name + '_total'
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+
+        for name, timing in sorted(snapshot['timings'].iteritems()):
+            metric = PROMETHEUS_PREFIX + name + '_seconds'
+            lines.append("# TYPE {} histogram".format(metric))
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS, timing['buckets']):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, le, cumulative))
+
+            lines.append("{}_sum {!r}".format(metric, timing['sum']))
+            lines.append("{}_count {}".format(metric, timing['count']))
+
+        return "\n".join(lines) + "\n"
+
+
+def _milliseconds(bound):
+    return "inf" if bound == float('inf') else "{:g}".format(bound * 1000)
+
+
+METRICS = Metrics()
+
+count = METRICS.count
+timed = METRICS.timed
+timing = METRICS.timing
+counted = METRICS.counted
+timed_parts = METRICS.timed_parts
+
+
+@contextmanager
+def profiling(path, sort='cumulative'):
+    """Profile the with block, and every thread started within it, saving the
+    combined pstats to path, e.g. for python -m pstats"""
+    profiles = []
+    lock = threading.Lock()
+
+    def start_thread_profile(*args):
+        # Called for the first event in each new thread, enabling the
+        # thread's own profiler replaces this hook
+        profile = cProfile.Profile()
+        with lock:
+            profiles.append(profile)
+        profile.enable()
+
+    main = cProfile.Profile()
+    threading.setprofile(start_thread_profile)
+    main.enable()
+    try:
+        yield
+    finally:
+        main.disable()
+        threading.setprofile(None)
+
+        stats = pstats.Stats(main)
+        with lock:
+            for profile in profiles:
+                # Stats won't take a thread that never got as far as a call
+                profile.create_stats()
+                if profile.stats:
+                    stats.add(profile)
+
+        stats.sort_stats(sort).dump_stats(path)
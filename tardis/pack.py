@@ -0,0 +1,255 @@
+"""Packing small files into larger pack objects.
+
+Putting every small file as its own object means a tree of many tiny files,
+e.g. a source checkout, costs a request per file to back up and another to
+restore, and the per-request cost and latency dominate. Files smaller than a
+threshold are instead gathered into pack objects of a few MiB, the manifest
+entry of each file recording the pack and where its content is within it (a
+tardis.manifest.Location).
+
+A pack is its members one after the other, followed by an index of them:
+
+    members  per member: codec length (uint8), codec, compressed content
+    index    per member: object id length (uint16), object id,
+             offset (uint64), length (uint64)
+    footer   index offset (uint64), member count (uint32), MAGIC
+
+A Location covers a whole member, codec included, so each member can be
+fetched with a ranged request and decompressed on its own. Packs are named by
+the checksum of their content. All integers are big-endian.
+"""
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+from .util import sha1sum
+from .manifest import Location
+from . import transfer, compression
+
+
+# Files smaller than this are packed
+PACK_THRESHOLD = 2**16
+
+PACK_SIZE = 8 * 2**20
+
+MAGIC = "TARDISPK"
+
+# Recorded as the codec of pack objects, see tardis.compression
+PACK_CODEC = "pack"
+
+_CODEC_LENGTH = struct.Struct(">B")
+_INDEX_ENTRY = struct.Struct(">HQQ")
+_FOOTER = struct.Struct(">QI")
+
+
+def pack_id(content):
+    return "pack/{}".format(sha1sum([content]))
+
+
+def read_member(data):
+    """The decompressed content of the pack member in data"""
+    codec_length, = _CODEC_LENGTH.unpack_from(data, 0)
+    start = _CODEC_LENGTH.size + codec_length
+    return ''.join(compression.decompressed([data[start:]], data[_CODEC_LENGTH.size:start]))
+
+
+def read_index(data):
+    """The (object id, offset, length) of each member of the pack in data"""
+    if not data.endswith(MAGIC):
+        raise ValueError("Not a complete pack")
+
+    offset, count = _FOOTER.unpack_from(data, len(data) - len(MAGIC) - _FOOTER.size)
+
+    index = []
+    for _ in xrange(count):
+        id_length, member_offset, member_length = _INDEX_ENTRY.unpack_from(data, offset)
+        offset += _INDEX_ENTRY.size
+        index.append((data[offset:offset + id_length], member_offset, member_length))
+        offset += id_length
+
+    return index
+
+
+class _Pack(object):
+    """A pack being filled"""
+    def __init__(self):
+        self._parts = []
+        self._index = []
+        self._content = None
+        self.size = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def add(self, object_id, codec, content):
+        data = _CODEC_LENGTH.pack(len(codec)) + codec + content
+        self._parts.append(data)
+        self._index.append((object_id, self.size, len(data)))
+        self.size += len(data)
+
+    @property
+    def index(self):
+        return self._index
+
+    def content(self):
+        if self._content is None:
+            parts = self._parts
+            parts.extend(_INDEX_ENTRY.pack(len(object_id), offset, length) + object_id
+                         for object_id, offset, length in self._index)
+            parts.append(_FOOTER.pack(self.size, len(self._index)) + MAGIC)
+
+            self._content = ''.join(parts)
+            self._parts = None
+
+        return self._content
+
+
+class Packer(object):
+    """Puts files smaller than threshold into packs of around pack_size bytes,
+    and anything else with put_archive.
+
+    put() is thread-safe and takes the place of put_archive in a backup. Packs
+    are put by whichever call to put() fills them, call flush() to put the last
+    one. A pack that fails to put is tried again by the next put() or flush().
+    create_archive is as for tardis.put_archive, transfer_options are passed on
+    to tardis.transfer.upload.
+
+    locations has the Location of the content of every object id that's been
+    put in a pack, starting with those in known_locations, e.g. from a
+    checkpoint. on_pack is called with the locations of the objects in each
+    pack once it's been put.
+    """
+    def __init__(self, bucket, put_archive, create_archive, threshold=PACK_THRESHOLD, pack_size=PACK_SIZE,
+                 known_locations=None, on_pack=None, **transfer_options):
+        self._bucket = bucket
+        self._put_archive = put_archive
+        self._create_archive = create_archive
+        self._threshold = threshold
+        self._pack_size = pack_size
+        self._on_pack = on_pack
+        self._transfer_options = transfer_options
+
+        self._lock = threading.Lock()
+        self._pack = _Pack()
+        self._full = []
+        self.locations = dict(known_locations or {})
+        self._packed = set(self.locations)
+
+    def put(self, manifest_entry):
+        if manifest_entry.stat_info.size >= self._threshold:
+            return self._put_archive(manifest_entry)
+
+        object_id = manifest_entry.object_id
+        if object_id not in self._packed:
+            archive = self._create_archive(manifest_entry.path)
+            content = ''.join(archive.parts)
+
+            with self._lock:
+                if object_id not in self._packed:
+                    self._packed.add(object_id)
+                    self._pack.add(object_id, archive.codec, content)
+
+                    if self._pack.size >= self._pack_size:
+                        self._full.append(self._pack)
+                        self._pack = _Pack()
+
+        self._put_full()
+
+    def flush(self):
+        """Put the pack that's being filled, and any waiting to be put"""
+        with self._lock:
+            if len(self._pack):
+                self._full.append(self._pack)
+                self._pack = _Pack()
+
+        self._put_full()
+
+    def _put_full(self):
+        while True:
+            with self._lock:
+                if not self._full:
+                    return
+                pack = self._full.pop(0)
+
+            try:
+                self._put_pack(pack)
+            except:
+                with self._lock:
+                    self._full.append(pack)
+                raise
+
+    def _put_pack(self, pack):
+        content = pack.content()
+        name = pack_id(content)
+
+        transfer.upload(self._bucket, name, [content], metadata={ compression.CODEC_METADATA: PACK_CODEC },
+                        **self._transfer_options)
+        logging.debug("Put pack %s of %s files", name, len(pack))
+
+        locations = dict((object_id, Location(name, offset, length)) for object_id, offset, length in pack.index)
+        with self._lock:
+            self.locations.update(locations)
+
+        if self._on_pack:
+            self._on_pack(locations)
+
+
+def located(fields, locations, previous):
+    """fields, an entry's fields, with the location of its content if it's in
+    locations, by object id. Entries that weren't put keep the location they
+    had in previous, the manifest they were checked against, whether or not
+    anything was packed this time."""
+    if fields[8]:
+        return fields
+
+    path, object_id = fields[:2]
+
+    location = locations.get(object_id)
+    if location is None and previous is not None:
+        previous_entry = previous[path]
+        if getattr(previous_entry, 'object_id', None) == object_id:
+            location = previous_entry.location
+
+    return fields[:8] + tuple(location) if location else fields
+
+
+class PackCache(object):
+    """Fetches whole packs so that restoring the files in them only takes one
+    request per pack. The last 'packs' packs used are kept in memory."""
+    def __init__(self, bucket, packs=4, **transfer_options):
+        self._bucket = bucket
+        self._size = packs
+        self._transfer_options = transfer_options
+        self._packs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def member(self, location):
+        """The member of a pack at location, as read by read_member"""
+        with self._lock:
+            pack = self._packs.pop(location.pack, None)
+            if pack is None:
+                pack = _CachedPack()
+                if len(self._packs) >= self._size:
+                    self._packs.popitem(last=False)
+
+            self._packs[location.pack] = pack
+
+        # Only one thread fetches each pack, any others wait for it
+        with pack.lock:
+            if pack.content is None:
+                logging.debug("Fetching pack %s", location.pack)
+                pack.content = ''.join(transfer.download(self._bucket, location.pack, **self._transfer_options))
+
+        return pack.content[location.offset:location.offset + location.length]
+
+
+class _CachedPack(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.content = None
+
+
+def get_member(bucket, location):
+    """The member of a pack at location, fetched with a ranged request"""
+    return transfer.get_range(bucket, location.pack, (location.offset, location.offset + location.length - 1))
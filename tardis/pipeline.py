@@ -0,0 +1,140 @@
+"""A bounded producer/consumer pipeline.
+
+Items are fed through a series of stages, each stage runs its function in its
+own pool of worker threads and hands the results to the next stage through a
+bounded queue. A full queue blocks the stage feeding it so a slow stage (e.g.
+uploading) holds back the stages before it rather than letting work pile up in
+memory.
+
+A stage function returning None drops the item, so stages double as filters.
+"""
+import sys
+import time
+import logging
+import threading
+from Queue import Queue
+from collections import namedtuple
+
+
+class Stage(namedtuple('Stage', ['name', 'function', 'workers'])):
+    __slots__ = () # avoid creating an instance __dict__
+
+
+class PipelineError(Exception):
+    """Raised once a pipeline has drained if any item failed in any stage.
+
+    failures - a list of (stage name, item, exc_info) tuples.
+    """
+    def __init__(self, failures):
+        super(PipelineError, self).__init__("{} item(s) failed".format(len(failures)))
+        self.failures = failures
+
+
+_DONE = object()
+
+
+def retrying(f, attempts=3, backoff=1.0, sleep=time.sleep):
+    """Wrap f so that it's retried with exponential backoff.
+
+    f is called up to 'attempts' times, waiting backoff, 2*backoff, 4*backoff...
+    seconds between attempts. The last exception is re-raised if every attempt
+    fails.
+    """
+    if attempts < 1:
+        raise ValueError("attempts must be at least 1, got {}".format(attempts))
+
+    def wrapper(*args, **kwargs):
+        for attempt in xrange(1, attempts + 1):
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                if attempt == attempts:
+                    raise
+
+                delay = backoff * 2 ** (attempt - 1)
+                logging.warn("Attempt {} of {} failed, retrying in {}s".format(attempt, attempts, delay), exc_info=True)
+                sleep(delay)
+
+    return wrapper
+
+
+class Pipeline(object):
+    def __init__(self, stages, queue_size=None):
+        """Create a Pipeline.
+
+        stages - a sequence of Stage instances, run in order.
+        queue_size - maximum number of items waiting in front of each stage,
+                     defaults to twice the number of workers in that stage.
+        """
+        if not stages:
+            raise ValueError("Must specify at least one stage")
+
+        for stage in stages:
+            if stage.workers < 1:
+                raise ValueError("Stage {} needs at least one worker".format(stage.name))
+
+        self._stages = list(stages)
+        self._queue_size = queue_size
+
+    def run(self, items):
+        """Feed items through every stage, blocking until all are processed.
+
+        Failing items are logged and dropped so the rest of the pipeline can
+        carry on, a PipelineError listing them is raised at the end.
+        """
+        queues = [Queue(self._queue_size or 2 * stage.workers) for stage in self._stages]
+        queues.append(None)
+
+        failures = []
+        failures_lock = threading.Lock()
+
+        def worker(stage, inbox, outbox, remaining):
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    break
+
+                try:
+                    result = stage.function(item)
+                except Exception:
+                    logging.error("Stage {} failed for {}".format(stage.name, item), exc_info=True)
+                    with failures_lock:
+                        failures.append((stage.name, item, sys.exc_info()))
+                    continue
+
+                if result is not None and outbox is not None:
+                    outbox.put(result)
+
+            # The last worker out tells the next stage there's nothing more
+            with remaining['lock']:
+                remaining['count'] -= 1
+                last = remaining['count'] == 0
+
+            if last and outbox is not None:
+                for _ in xrange(remaining['next_workers']):
+                    outbox.put(_DONE)
+
+        threads = []
+        for i, stage in enumerate(self._stages):
+            next_workers = self._stages[i + 1].workers if i + 1 < len(self._stages) else 0
+            remaining = { 'lock': threading.Lock(), 'count': stage.workers, 'next_workers': next_workers }
+
+            for _ in xrange(stage.workers):
+                thread = threading.Thread(target=worker, args=(stage, queues[i], queues[i + 1], remaining),
+                                          name="{}-worker".format(stage.name))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for _ in xrange(self._stages[0].workers):
+                queues[0].put(_DONE)
+
+            for thread in threads:
+                thread.join()
+
+        if failures:
+            raise PipelineError(failures)
@@ -0,0 +1,163 @@
+"""A pool of S3 connections shared by worker threads.
+
+boto's connections can't be used from several threads at once, so each thread
+calling the pool gets a connection and bucket of its own, kept alive from one
+request to the next rather than paying for a new TLS handshake each time. The
+pool is called like any other bucket function, e.g. put_archive's bucket.
+
+S3 closes a connection once it's been used for 100 requests (see
+http://aws.amazon.com/articles/1904) so connections are replaced after
+max_requests uses, and after anything fails while using one, in case it was
+the connection that broke. The connections of threads that have finished go
+back to the pool for other threads to take over, up to max_idle idle
+connections are kept.
+
+The number of connections open at once isn't capped. Each thread keeps its
+connection until it finishes, and worker pool threads only finish when the
+pool is shut down, so a thread waiting for a free connection could wait
+forever.
+"""
+import logging
+import threading
+import weakref
+from collections import namedtuple
+
+
+MAX_REQUESTS = 40
+
+
+class PoolStats(namedtuple('PoolStats', ['requests', 'created', 'recycled', 'discarded', 'open', 'peak_open'])):
+    """How a BucketPool has been used.
+
+    requests - the number of times a bucket was handed out.
+    created - the number of connections made.
+    recycled - the number replaced after max_requests uses.
+    discarded - the number replaced after something failed.
+    open, peak_open - the number of connections open now, and at most.
+    """
+    __slots__ = ()
+
+    def summary(self):
+        return ("{} requests over {} connections, {} recycled, {} discarded after errors, "
+                "{} open at most").format(self.requests, self.created, self.recycled, self.discarded,
+                                          self.peak_open)
+
+
+class _Lease(object):
+    def __init__(self, connection, bucket):
+        self.connection = connection
+        self.bucket = bucket
+        self.uses = 0
+
+
+class BucketPool(object):
+    """Hands each calling thread a bucket on a connection of its own.
+
+    connect() makes a new connection, returning a (connection, bucket) pair.
+    Call close() once finished to close every connection.
+    """
+    def __init__(self, connect, max_idle=4, max_requests=MAX_REQUESTS):
+        self._connect = connect
+        self._max_idle = max_idle
+        self._max_requests = max_requests
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._idle = []
+        self._leases = {}
+        self._stats = { 'requests': 0, 'created': 0, 'recycled': 0, 'discarded': 0, 'peak_open': 0 }
+
+    def __call__(self):
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None and lease.uses >= self._max_requests:
+            self._retire(lease, 'recycled')
+            lease = None
+
+        if lease is None:
+            lease = self._take()
+
+        lease.uses += 1
+        with self._lock:
+            self._stats['requests'] += 1
+
+        return lease.bucket
+
+    def discard(self):
+        """Close the calling thread's connection, it'll get a new one next time"""
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None:
+            self._retire(lease, 'discarded')
+
+    def recycling(self, f):
+        """Wrap f so the calling thread's connection is discarded if f fails"""
+        def wrapper(*args, **kwargs):
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                self.discard()
+                raise
+
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return PoolStats(open=self._open(), **self._stats)
+
+    def close(self):
+        with self._lock:
+            leases = self._idle + [lease for _, lease in self._leases.itervalues()]
+            self._idle = []
+            self._leases = {}
+
+        for lease in leases:
+            _close(lease)
+
+    def _take(self):
+        thread = threading.current_thread()
+
+        with self._lock:
+            self._reclaim()
+            lease = self._idle.pop() if self._idle else None
+
+        if lease is None:
+            connection, bucket = self._connect()
+            logging.debug("Connected to bucket %s", bucket)
+            lease = _Lease(connection, bucket)
+
+            with self._lock:
+                self._stats['created'] += 1
+
+        with self._lock:
+            self._leases[thread.ident] = (weakref.ref(thread), lease)
+            self._stats['peak_open'] = max(self._stats['peak_open'], self._open())
+
+        self._local.lease = lease
+        return lease
+
+    def _retire(self, lease, reason):
+        self._local.lease = None
+        with self._lock:
+            self._leases.pop(threading.current_thread().ident, None)
+            self._stats[reason] += 1
+
+        _close(lease)
+
+    def _reclaim(self):
+        # Threads that have finished don't need their connections any more
+        for ident, (thread, lease) in self._leases.items():
+            if thread() is None or not thread().is_alive():
+                del self._leases[ident]
+                if len(self._idle) < self._max_idle and lease.uses < self._max_requests:
+                    self._idle.append(lease)
+                else:
+                    _close(lease)
+
+    def _open(self):
+        return len(self._idle) + len(self._leases)
+
+
+def _close(lease):
+    try:
+        lease.connection.close()
+    except Exception:
+        logging.warn("Unable to close connection", exc_info=True)
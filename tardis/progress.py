@@ -0,0 +1,60 @@
+"""Progress and throughput reporting for long running operations."""
+import time
+import logging
+import threading
+
+
+class Progress(object):
+    """Thread-safe counts of the files and bytes processed so far.
+
+    A progress line is logged at most every 'interval' seconds as updates come
+    in, and by report().
+    """
+    def __init__(self, description, total_files=None, total_bytes=None, interval=10.0, clock=time.time):
+        self._description = description
+        self._total_files = total_files
+        self._total_bytes = total_bytes
+        self._interval = interval
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._files = 0
+        self._bytes = 0
+        self._start = clock()
+        self._last_report = self._start
+
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def update(self, files=1, bytes=0):
+        with self._lock:
+            self._files += files
+            self._bytes += bytes
+
+            now = self._clock()
+            due = now - self._last_report >= self._interval
+            if due:
+                self._last_report = now
+
+        if due:
+            self.report()
+
+    def summary(self):
+        with self._lock:
+            elapsed = max(self._clock() - self._start, 1e-6)
+            files, size = self._files, self._bytes
+
+        of_files = " of {}".format(self._total_files) if self._total_files is not None else ""
+        of_bytes = " of {:.1f}".format(self._total_bytes / 2.0**20) if self._total_bytes is not None else ""
+
+        return "{} {}{} files, {:.1f}{} MiB in {:.1f}s ({:.1f} files/s, {:.2f} MiB/s)".format(
+                    self._description, files, of_files, size / 2.0**20, of_bytes, elapsed,
+                    files / elapsed, size / 2.0**20 / elapsed)
+
+    def report(self):
+        logging.info(self.summary())
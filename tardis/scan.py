@@ -0,0 +1,223 @@
+"""Walking the directories to back up.
+
+Directories are read with scandir, from the standard library on Python 3.5+ or
+the scandir package otherwise, when it's available. scandir returns each
+entry's type along with its name so only files need to be stat'd, without it
+every entry is stat'd once.
+
+Listings can be kept in a StatCache. A directory whose inode and mtime haven't
+changed since it was last read still has the same entries, so it isn't read
+again. Its files are still stat'd, writing to a file in place doesn't change
+the mtime of its directory.
+
+As with files, see tardis.manifest.previous_object_id, a directory changed in
+the same second a scan starts, or later, could change again within that
+second without its mtime moving on, so its listing is neither cached nor taken
+from the cache.
+"""
+import os
+import os.path
+import stat
+import time
+import errno
+import logging
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from .cache import StatCache
+from . import metrics
+
+
+# Old versions of tardis left caches in every directory, don't back them up
+IGNORED_FILES = frozenset(['.tardis_manifest'])
+
+
+class DirectoryScan(namedtuple('DirectoryScan', ['path', 'subdirectories', 'files'])):
+    """A directory, the names of its subdirectories and (path, stat) pairs for
+    the files directly within it, both sorted"""
+    __slots__ = ()
+
+
+def roots(paths):
+    """The directories in paths, absolute and in path order, without any that
+    are within another of them. ValueError is raised if any of them isn't a
+    directory."""
+    paths = set(os.path.abspath(path) for path in paths)
+    for path in paths:
+        if not os.path.isdir(path):
+            raise ValueError("{} does not name a directory".format(path))
+
+    return outermost(paths)
+
+
+def outermost(paths):
+    """paths in path order, without any that are within another of them"""
+    result = []
+    for path in sorted(paths, key=lambda path: path + os.sep):
+        if result and path.startswith(result[-1] + os.sep):
+            continue
+        result.append(path)
+
+    return result
+
+
+def is_walked(path, root, ignored_directories=None):
+    """Whether walking root reaches the directory at path"""
+    ignored_directories = ignored_directories or []
+
+    while path != root:
+        if path in ignored_directories or os.path.basename(path).startswith("."):
+            return False
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False # not in root at all
+        path = parent
+
+    return True
+
+
+def walk(root, f, ignored_directories=None, cache=None):
+    """Yield the results of f for every file in root and the directories beneath
+    it, in path order.
+
+    f is called with the DirectoryScan for each directory in turn and returns a
+    sequence with one item per file in the scan, e.g. the FileEntry for each
+    file. A directory's items are interleaved with those of its subdirectories
+    so that the result is in the order of the files' paths, only the items for
+    the directories on the way down to the current one are held at once.
+
+    Hidden directories and any in ignored_directories aren't walked. cache is
+    a tardis.cache.StatCache to keep directory listings in.
+    """
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        raise ValueError("{} does not name a directory".format(root))
+
+    return _walk(root, f, set(ignored_directories or []), cache, time.time())
+
+
+def _walk(directory, f, ignored_directories, cache, started):
+    directory_scan = scan_directory(directory, cache, started)
+    items = f(directory_scan)
+    paths = [path for path, _ in directory_scan.files]
+
+    # A subdirectory's files sort after any sibling file it's a prefix of,
+    # e.g. a.txt < a/b, so compare names as they appear in paths
+    children = [os.path.join(directory, name) for name in sorted(directory_scan.subdirectories,
+                                                                 key=lambda name: name + os.sep)
+                if not name.startswith(".")]
+
+    i = 0
+    for child in children:
+        if child in ignored_directories:
+            continue
+
+        while i < len(paths) and paths[i] < child + os.sep:
+            yield items[i]
+            i += 1
+
+        for item in _walk(child, f, ignored_directories, cache, started):
+            yield item
+
+    for item in items[i:]:
+        yield item
+
+
+@metrics.timing('scan')
+def scan_directory(path, cache=None, started=None):
+    """The DirectoryScan for the directory at path.
+
+    cache - a tardis.cache.StatCache, the listing cached for the directory is
+            used if the directory hasn't changed, otherwise the directory is
+            read and its listing cached.
+    started - the time the scan started, in seconds since the epoch, now if
+              not given. Listings of directories changed since aren't cached.
+    """
+    path = os.path.abspath(path)
+    if started is None:
+        started = time.time()
+
+    if not cache:
+        subdirectories, files = _read_directory(path)
+        return DirectoryScan(path, subdirectories, files)
+
+    stat_struct = os.stat(path)
+    if int(stat_struct.st_mtime) >= int(started):
+        logging.debug("%s changed since the scan started, not caching its listing", path)
+        subdirectories, files = _read_directory(path)
+        return DirectoryScan(path, subdirectories, files)
+
+    key = StatCache.directory_key_for(stat_struct)
+
+    listing = cache.listing_for(path, key)
+    if listing is not None:
+        logging.debug("Using cached listing for %s", path)
+        subdirectories, names = listing
+        return DirectoryScan(path, subdirectories, _stat_files(path, names))
+
+    subdirectories, files = _read_directory(path)
+    cache.update_listing(path, key, subdirectories, [os.path.basename(f) for f, _ in files])
+
+    return DirectoryScan(path, subdirectories, files)
+
+
+def _read_directory(path):
+    """The sorted names of the subdirectories and (path, stat) pairs of the
+    files in the directory at path. Symlinks are followed."""
+    subdirectories = []
+    files = []
+
+    if scandir:
+        for entry in scandir(path):
+            if entry.is_dir():
+                subdirectories.append(entry.name)
+            elif entry.is_file() and entry.name not in IGNORED_FILES:
+                with metrics.timed('stat'):
+                    stat_struct = entry.stat()
+                files.append((entry.path, stat_struct))
+    else:
+        for name in os.listdir(path):
+            stat_struct = _stat(os.path.join(path, name))
+            if not stat_struct:
+                continue
+
+            if stat.S_ISDIR(stat_struct.st_mode):
+                subdirectories.append(name)
+            elif stat.S_ISREG(stat_struct.st_mode) and name not in IGNORED_FILES:
+                files.append((os.path.join(path, name), stat_struct))
+
+    subdirectories.sort()
+    files.sort()
+
+    return subdirectories, files
+
+
+def _stat_files(path, names):
+    files = []
+    for name in names:
+        file_path = os.path.join(path, name)
+        stat_struct = _stat(file_path)
+        if stat_struct and stat.S_ISREG(stat_struct.st_mode):
+            files.append((file_path, stat_struct))
+
+    return files
+
+
+@metrics.timing('stat')
+def _stat(path):
+    """os.stat(path), or None if there's nothing there (e.g. a broken symlink)"""
+    try:
+        return os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        logging.debug("%s has gone away", path)
+        return None
@@ -0,0 +1,238 @@
+"""Streaming compression and transfer of archive content.
+
+Content is handled as iterables of byte strings ("parts") so that only a
+bounded amount of any file is held in memory at once, no matter how large the
+file is. compressed and decompressed handle gzip, the format objects written
+by older versions of tardis (with gzip.open) are in, tardis.compression has
+the other codecs.
+"""
+import copy
+import zlib
+import hashlib
+import logging
+import functools
+import itertools
+from contextlib import closing
+from cStringIO import StringIO
+
+from .executor import SerialExecutor, imap_bounded
+from . import metrics
+
+
+READ_SIZE = 2**16
+
+# S3 won't accept multipart parts smaller than 5MiB (apart from the last one)
+MIN_PART_SIZE = 5 * 2**20
+PART_SIZE = 8 * 2**20
+
+MULTIPART_THRESHOLD = 16 * 2**20
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compressed(parts, level=6):
+    """gzip compress parts"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def decompressed(parts, max_length=READ_SIZE):
+    """Decompress gzipped parts, yielding at most max_length bytes at a time
+
+    The content may be several gzip members one after the other, e.g. the
+    compressed chunks of a chunked file.
+    """
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    for part in parts:
+        while part:
+            data = decompressor.decompress(part, max_length)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail, max_length)
+
+            # Anything after the end of a member is the start of the next one
+            part = decompressor.unused_data
+            if part:
+                decompressor = zlib.decompressobj(_GZIP_WBITS)
+
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def buffered(parts, size):
+    """Regroup parts into strings of exactly size bytes, apart from the last"""
+    buf = StringIO()
+    for part in parts:
+        buf.write(part)
+        if buf.tell() >= size:
+            data = buf.getvalue()
+            buf = StringIO()
+
+            offset = 0
+            while len(data) - offset >= size:
+                yield data[offset:offset + size]
+                offset += size
+
+            buf.write(data[offset:])
+
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def upload(bucket, key_name, parts, part_size=PART_SIZE, threshold=MULTIPART_THRESHOLD, executor=None, window=4,
+           metadata=None):
+    """Put parts to key_name in the bucket, along with the metadata dict.
+
+    bucket is a function returning the bucket, e.g. a tardis.pool.BucketPool,
+    each part put by the executor gets its own from the thread putting it.
+
+    Content up to threshold bytes is put in one request, anything larger is
+    put as a multipart upload, part_size bytes at a time, with up to 'window'
+    parts being put by the executor at once. An interrupted multipart upload
+    is left in place and resumed by the next attempt to put the same key,
+    skipping parts that were already put, or started again if the content
+    has changed since.
+    """
+    chunks = buffered(parts, part_size)
+
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size > threshold:
+            break
+    else:
+        with closing(bucket().new_key(key_name)) as key:
+            for name, value in (metadata or {}).iteritems():
+                key.set_metadata(name, value)
+            content = ''.join(head)
+            with metrics.timed('upload'):
+                key.set_contents_from_string(content, encrypt_key=True)
+            metrics.count('upload_bytes', len(content))
+        return
+
+    _multipart_upload(bucket, key_name, itertools.chain(head, chunks), executor or SerialExecutor(), window,
+                      metadata)
+
+
+def download(bucket, key_name, read_size=READ_SIZE, part_size=PART_SIZE, threshold=MULTIPART_THRESHOLD,
+             executor=None, window=4, metadata=None):
+    """Stream the content of key_name in the bucket, bucket being a function
+    returning it, as for upload.
+
+    The content is streamed read_size bytes at a time, in a single request,
+    unless the executor can fetch parts in parallel, i.e. it isn't a
+    SerialExecutor and window is more than one. Then objects larger than
+    threshold are fetched as ranged requests of part_size bytes, up to
+    'window' at once, and yielded in order. Finding the size takes a HEAD
+    request, which isn't worth it if the parts are fetched one at a time.
+
+    If metadata is a dict it's updated with the object's metadata before the
+    first part is yielded.
+    """
+    return metrics.timed_parts('download', _download(bucket, key_name, read_size, part_size, threshold, executor,
+                                                     window, metadata))
+
+
+def _download(bucket, key_name, read_size, part_size, threshold, executor, window, metadata):
+    if executor and window > 1 and not isinstance(executor, SerialExecutor):
+        key = bucket().get_key(key_name)
+        if key is None:
+            raise LookupError("{} does not exist".format(key_name))
+
+        if metadata is not None:
+            metadata.update(key.metadata)
+
+        if key.size > threshold:
+            ranges = ((start, min(start + part_size, key.size) - 1) for start in xrange(0, key.size, part_size))
+            get = functools.partial(get_range, bucket, key_name)
+
+            for part in imap_bounded(executor, get, ranges, window):
+                yield part
+            return
+
+    with closing(bucket().new_key(key_name)) as key:
+        # The metadata comes with the response to the first read
+        part = key.read(read_size)
+        if metadata is not None:
+            metadata.update(key.metadata)
+
+        while part:
+            yield part
+            part = key.read(read_size)
+
+
+def get_range(bucket, key_name, byte_range):
+    """The bytes of key_name in the bucket within byte_range, an inclusive
+    (first, last) pair, bucket being a function returning it"""
+    with closing(bucket().new_key(key_name)) as key:
+        return key.get_contents_as_string(headers={ 'Range': 'bytes={}-{}'.format(*byte_range) })
+
+
+def _resumable_upload(bucket, key_name, metadata):
+    for upload in bucket.get_all_multipart_uploads(prefix=key_name):
+        if upload.key_name == key_name:
+            logging.debug("Resuming multipart upload %s of %s", upload.id, key_name)
+            return upload
+
+    logging.debug("Starting multipart upload of %s", key_name)
+    return bucket.initiate_multipart_upload(key_name, metadata=metadata or {}, encrypt_key=True)
+
+
+def _etag(chunk):
+    return '"{}"'.format(hashlib.md5(chunk).hexdigest())
+
+
+def _multipart_upload(bucket, key_name, chunks, executor, window, metadata=None):
+    upload = _resumable_upload(bucket(), key_name, metadata)
+    already_put = { part.part_number: part.etag for part in upload }
+
+    if already_put:
+        # If the content's changed since the upload started, its parts are no
+        # use and the metadata fixed when it started may no longer hold, e.g.
+        # a different codec
+        first = next(chunks, '')
+        if already_put.get(1) != _etag(first):
+            logging.debug("Multipart upload %s of %s was for different content, starting again", upload.id,
+                          key_name)
+            upload.cancel_upload()
+            upload = bucket().initiate_multipart_upload(key_name, metadata=metadata or {}, encrypt_key=True)
+            already_put = {}
+        chunks = itertools.chain([first], chunks)
+
+    def put_part(numbered_chunk):
+        part_number, chunk = numbered_chunk
+
+        etag = _etag(chunk)
+        if already_put.get(part_number) == etag:
+            logging.debug("Part %s of %s already put", part_number, key_name)
+        else:
+            # The upload is bound to the bucket it was started with, each
+            # thread puts its parts with the bucket it's been given
+            part_upload = copy.copy(upload)
+            part_upload.bucket = bucket()
+            with metrics.timed('upload'):
+                part_upload.upload_part_from_file(StringIO(chunk), part_number)
+            metrics.count('upload_bytes', len(chunk))
+            logging.debug("Put part %s of %s", part_number, key_name)
+
+        return part_number, etag
+
+    parts = list(imap_bounded(executor, put_part, enumerate(chunks, 1), window))
+
+    # Only this content's parts are listed, so any left over from a longer
+    # version of it are dropped rather than tacked on the end
+    bucket().complete_multipart_upload(key_name, upload.id, _completion_xml(parts))
+
+
+def _completion_xml(parts):
+    return "<CompleteMultipartUpload>\n{}</CompleteMultipartUpload>".format("".join(
+        "  <Part>\n    <PartNumber>{}</PartNumber>\n    <ETag>{}</ETag>\n  </Part>\n".format(part_number, etag)
+        for part_number, etag in parts))
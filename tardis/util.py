@@ -2,6 +2,16 @@ import os
 import errno
 import hashlib
 import datetime
+from collections import OrderedDict
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
 
 def sha1sum(parts):
     """Create a sha1sum of each element in parts"""
@@ -11,6 +21,43 @@ def sha1sum(parts):
     return m.hexdigest()
 
 
+DEFAULT_ALGORITHM = 'sha1'
+
+# Content checksum algorithms, blake2b is in hashlib on Python 3.6+ or the
+# pyblake2 package otherwise
+ALGORITHMS = OrderedDict([ ('sha1', hashlib.sha1)
+                         , ('sha256', hashlib.sha256)
+                         , ('sha512', hashlib.sha512)
+                         ] + ([('blake2b', blake2b)] if blake2b else []))
+
+
+def checksum(parts, algorithm=DEFAULT_ALGORITHM):
+    """A checksum of the content in parts.
+
+    Checksums other than sha1 are prefixed with their algorithm, e.g.
+    'blake2b-9f3c...', so checksums made with different algorithms never
+    match, and older sha1 checksums stay as they were.
+    """
+    try:
+        m = ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError("Unknown or unavailable checksum algorithm {}, available algorithms are {}".format(
+                         algorithm, ", ".join(ALGORITHMS)))
+
+    for part in parts:
+        m.update(part)
+
+    if algorithm == DEFAULT_ALGORITHM:
+        return m.hexdigest()
+    return "{}-{}".format(algorithm, m.hexdigest())
+
+
+def checksum_algorithm(checksum):
+    """The algorithm checksum, as returned by checksum(), was made with"""
+    algorithm, separator, _ = checksum.rpartition('-')
+    return algorithm if separator else DEFAULT_ALGORITHM
+
+
 def iso8601():
     """Get the current time as a string in ISO8601 format"""
     return datetime.datetime.utcnow().isoformat()
@@ -0,0 +1,216 @@
+"""Watching directories for changes with Linux's inotify, recording them in a
+tardis.journal.Journal so backups only need to scan what's changed.
+
+Every directory that would be backed up is watched. Changes to files are
+recorded against their directory, directories being created, moved or
+removed are recorded as changed trees. Anything that means changes could
+have been missed, the kernel's event queue overflowing or running out of
+watches, is recorded as an overflow so the next backup scans everything.
+"""
+import os
+import os.path
+import errno
+import select
+import struct
+import logging
+import time
+import ctypes
+import ctypes.util
+
+from . import scan
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def _inotify():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+        _libc = libc
+    return _libc
+
+
+class Watcher(object):
+    """Watches the directories under roots.
+
+    Call changes() to wait for changes, close() when done.
+    """
+    def __init__(self, roots, ignored_directories=None):
+        self._libc = _inotify()
+        self._ignored_directories = set(ignored_directories or [])
+        self._roots = scan.roots(roots)
+        self._paths = {}
+        self._watches = {}
+        self.overflowed = False
+
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        for root in self._roots:
+            self._watch_tree(root)
+
+        logging.debug("Watching %s directories", len(self._watches))
+
+    def changes(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes.
+
+        Returns the sets of directories whose files changed and of directories
+        whose trees changed. overflowed is set once any changes may have been
+        missed.
+        """
+        directories = set()
+        trees = set()
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return directories, trees
+
+        data = os.read(self._fd, 2**16)
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warn("inotify queue overflowed, changes have been missed")
+                self.overflowed = True
+                continue
+
+            directory = self._paths.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                self._forget(directory)
+                continue
+
+            if mask & IN_DELETE_SELF:
+                trees.add(directory)
+                continue
+
+            path = os.path.join(directory, name)
+
+            if not mask & IN_ISDIR:
+                directories.add(directory)
+            elif mask & (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM) and self._is_watched(path):
+                trees.add(path)
+
+                if mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+
+        return directories, trees
+
+    def close(self):
+        os.close(self._fd)
+
+    def _is_watched(self, path):
+        return any(scan.is_walked(path, root, self._ignored_directories) for root in self._roots
+                   if path.startswith(root + os.sep))
+
+    def _watch_tree(self, path):
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+
+            wd = self._libc.inotify_add_watch(self._fd, directory, WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in (errno.ENOENT, errno.ENOTDIR):
+                    continue # gone already, its parent will have noticed
+                if e == errno.ENOSPC:
+                    logging.warn("Out of inotify watches, see /proc/sys/fs/inotify/max_user_watches")
+                    self.overflowed = True
+                    continue
+                raise OSError(e, "Unable to watch {}: {}".format(directory, os.strerror(e)))
+
+            self._paths[wd] = directory
+            self._watches[directory] = wd
+
+            try:
+                subdirectories = scan.scan_directory(directory).subdirectories
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+
+            pending.extend(child for child in (os.path.join(directory, name) for name in subdirectories
+                                               if not name.startswith("."))
+                           if child not in self._ignored_directories)
+
+    def _unwatch_tree(self, path):
+        start = path + os.sep
+        for directory in [d for d in self._watches if d == path or d.startswith(start)]:
+            self._libc.inotify_rm_watch(self._fd, self._watches[directory])
+            self._forget(directory)
+
+    def _forget(self, directory):
+        wd = self._watches.pop(directory, None)
+        if self._paths.get(wd) == directory:
+            del self._paths[wd]
+
+
+def watch(roots, journal, ignored_directories=None, interval=1.0, clock=time.time):
+    """Record changes to roots in journal until interrupted.
+
+    Changes are recorded in batches, at most every 'interval' seconds.
+    """
+    roots = scan.roots(roots)
+    with journal.watching(roots):
+        watcher = Watcher(roots, ignored_directories)
+        try:
+            # Changes before the watches were in place were missed
+            journal.record(overflow=True)
+
+            directories = set()
+            trees = set()
+            deadline = None
+            while True:
+                timeout = max(deadline - clock(), 0) if deadline is not None else None
+                changed_directories, changed_trees = watcher.changes(timeout)
+                directories.update(changed_directories)
+                trees.update(changed_trees)
+
+                if deadline is None and (directories or trees):
+                    deadline = clock() + interval
+
+                if watcher.overflowed or (deadline is not None and clock() >= deadline):
+                    logging.debug("Recording %s changed directories and %s changed trees",
+                                  len(directories), len(trees))
+                    journal.record(directories, trees, watcher.overflowed)
+
+                    watcher.overflowed = False
+                    directories = set()
+                    trees = set()
+                    deadline = None
+        finally:
+            watcher.close()
@@ -0,0 +1,39 @@
+import os
+import tempfile
+
+from nose.tools import *
+
+from tardis.buffers import file_views
+
+
+def test_file_views():
+    content = os.urandom(1000)
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(content)
+        f.flush()
+
+        for mmap_threshold in (None, 1, 2000):
+            # Views are only good until the next one, so copy each
+            parts = [str(view) for view in file_views(f.name, 300, mmap_threshold)]
+
+            assert_equals([300, 300, 300, 100], [len(p) for p in parts])
+            assert_equals(content, ''.join(parts))
+
+
+def test_file_views_reuse_buffer():
+    with tempfile.NamedTemporaryFile() as f:
+        f.write("a" * 300 + "b" * 300)
+        f.flush()
+
+        views = file_views(f.name, 300)
+        first = next(views)
+        assert_equals("a" * 300, str(first))
+
+        next(views)
+        assert_equals("b" * 300, str(first))
+
+
+def test_file_views_empty():
+    with tempfile.NamedTemporaryFile() as f:
+        assert_equals([], list(file_views(f.name)))
+        assert_equals([], list(file_views(f.name, mmap_threshold=0)))
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import shutil
+from collections import namedtuple
+
+from nose.tools import *
+
+from tardis.cache import StatCache, ManifestCache
+
+
+FakeStat = namedtuple('FakeStat', ['st_ino', 'st_size', 'st_mtime', 'st_ctime'])
+
+
+def test_key_for():
+    assert_equals((1, 2, 3.5, 4.25), StatCache.key_for(FakeStat(1, 2, 3.5, 4.25)))
+
+
+def test_cache_round_trip():
+    cache = StatCache(':memory:')
+    cache.update_directory('/a', [('/a/1', (1, 10, 1.5, 2.5), 'data/x/1'),
+                                  ('/a/2', (2, 20, 1.5, 2.5), 'data/x/2')])
+    cache.update_directory('/b', [('/b/1', (3, 30, 1.5, 2.5), 'data/x/3')])
+
+    assert_equals({ '/a/1': ((1, 10, 1.5, 2.5), 'data/x/1')
+                  , '/a/2': ((2, 20, 1.5, 2.5), 'data/x/2')
+                  }, cache.for_directory('/a'))
+    assert_equals({}, cache.for_directory('/c'))
+
+
+def test_cache_update_replaces_directory():
+    cache = StatCache(':memory:')
+    cache.update_directory('/a', [('/a/1', (1, 10, 1.5, 2.5), 'data/x/1'),
+                                  ('/a/2', (2, 20, 1.5, 2.5), 'data/x/2')])
+    cache.update_directory('/a', [('/a/2', (2, 21, 1.5, 2.5), 'data/x/4')])
+
+    assert_equals({ '/a/2': ((2, 21, 1.5, 2.5), 'data/x/4') }, cache.for_directory('/a'))
+
+
+def test_cache_batches_writes():
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        path = os.path.join(temp_dir, 'nested', 'cache.db')
+
+        cache = StatCache(path, batch_size=3)
+        cache.update_directory('/a', [('/a/1', (1, 10, 1.5, 2.5), 'data/x/1')])
+        assert_equals({}, StatCache(path).for_directory('/a'))
+
+        cache.update_directory('/b', [('/b/1', (1, 10, 1.5, 2.5), 'data/x/1'),
+                                      ('/b/2', (1, 10, 1.5, 2.5), 'data/x/2')])
+        assert_equals(1, len(StatCache(path).for_directory('/a')))
+
+        cache.update_directory('/c', [('/c/1', (1, 10, 1.5, 2.5), 'data/x/1')])
+        cache.close()
+        assert_equals(1, len(StatCache(path).for_directory('/c')))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_listing_round_trip():
+    cache = StatCache(':memory:')
+    cache.update_listing('/a', (1, 1.5), ['b', 'c'], ['1', 'odd\nname'])
+    cache.update_listing('/e', (2, 1.5), [], [])
+    cache.flush()
+
+    assert_equals((['b', 'c'], ['1', 'odd\nname']), cache.listing_for('/a', (1, 1.5)))
+    assert_equals(([], []), cache.listing_for('/e', (2, 1.5)))
+    assert_is_none(cache.listing_for('/a', (1, 2.5)))
+    assert_is_none(cache.listing_for('/c', (1, 1.5)))
+
+
+def test_pending_listing_is_read():
+    cache = StatCache(':memory:')
+    cache.update_listing('/a', (1, 1.5), ['b'], ['1'])
+
+    assert_equals((['b'], ['1']), cache.listing_for('/a', (1, 1.5)))
+
+
+def test_manifest_cache():
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        source = os.path.join(temp_dir, 'source')
+        with open(source, 'wb') as f:
+            f.write("manifest contents")
+
+        cache = ManifestCache(os.path.join(temp_dir, 'manifests'))
+        assert_is_none(cache.path_for('manifest/h/u/1'))
+
+        for name in ['manifest/h/u/1', 'manifest/h/u/2', 'manifest/h/other/1']:
+            cache.add(name, source, '"etag"')
+
+        path = cache.path_for('manifest/h/u/1', '"etag"')
+        with open(path, 'rb') as f:
+            assert_equals("manifest contents", f.read())
+
+        assert_equals(path, cache.path_for('manifest/h/u/1'))
+        assert_is_none(cache.path_for('manifest/h/u/1', '"other"'))
+        assert_equals(['manifest/h/u/1', 'manifest/h/u/2'], cache.names('manifest/h/u/'))
+
+        cache.retain('manifest/h/u/', ['manifest/h/u/2'])
+        assert_equals(['manifest/h/other/1', 'manifest/h/u/2'], cache.names())
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import functools
+
+from nose.tools import *
+from mock import patch, Mock
+
+from fake_s3 import FakeBucket
+
+from tardis import backup, put_archive, create_archive, needs_put, put_manifest, latest_manifest
+from tardis.checkpoint import Checkpoint
+from tardis.cache import StatCache
+from tardis.manifest import Manifest, Location, object_id_for
+from tardis.pipeline import PipelineError
+
+
+IDENTITY = ['hostname', 'username', '/some/dir']
+
+
+temp_dir = None
+checkpoint_path = None
+tree = None
+def setup_func():
+    global temp_dir, checkpoint_path, tree
+
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    checkpoint_path = os.path.join(temp_dir, "checkpoint")
+    tree = os.path.join(temp_dir, "tree")
+    os.mkdir(tree)
+
+    for i in range(10):
+        with open(os.path.join(tree, str(i)), 'wb') as f:
+            f.write("This is content number {}".format(i))
+
+
+def teardown_func():
+    global temp_dir, checkpoint_path, tree
+    shutil.rmtree(temp_dir)
+    temp_dir = checkpoint_path = tree = None
+
+
+@with_setup(setup_func, teardown_func)
+def test_resumes_records():
+    checkpoint = Checkpoint(checkpoint_path, IDENTITY)
+    checkpoint.record_hashes('/a', [('/a/b', (1, 2, 3.5, 4.25), 'data/x/y')])
+    checkpoint.record_put('data/x/y')
+    checkpoint.record_locations({ 'data/z/w': Location('pack/p', 10, 20) })
+    checkpoint.close()
+
+    resumed = Checkpoint(checkpoint_path, IDENTITY)
+    assert_equals({ '/a': { '/a/b': ((1, 2, 3.5, 4.25), 'data/x/y') } }, resumed.hashes)
+    assert_equals(set(['data/x/y']), resumed.put)
+    assert_equals({ 'data/z/w': Location('pack/p', 10, 20) }, resumed.locations)
+    resumed.close()
+
+    different = Checkpoint(checkpoint_path, IDENTITY + ['/another/dir'])
+    assert_equals(({}, set(), {}), (different.hashes, different.put, different.locations))
+    different.close()
+
+
+@with_setup(setup_func, teardown_func)
+def test_ignores_partial_record():
+    checkpoint = Checkpoint(checkpoint_path, IDENTITY)
+    checkpoint.record_put('data/x/y')
+    checkpoint.close()
+
+    with open(checkpoint_path, 'ab') as f:
+        f.write('pdata/cut/of')
+
+    assert_equals(set(['data/x/y']), Checkpoint(checkpoint_path, IDENTITY).put)
+
+
+@with_setup(setup_func, teardown_func)
+def test_clear():
+    Checkpoint(checkpoint_path, IDENTITY).clear()
+    assert_false(os.path.exists(checkpoint_path))
+
+
+@with_setup(setup_func, teardown_func)
+def test_checking_and_putting():
+    checkpoint = Checkpoint(checkpoint_path, IDENTITY)
+    entry = Mock(object_id='data/x/y')
+
+    needs_put = Mock(return_value=True)
+    check = checkpoint.checking(needs_put)
+    assert_true(check(entry, None))
+
+    put_archive = Mock()
+    checkpoint.putting(put_archive)(entry)
+    put_archive.assert_called_once_with(entry)
+
+    assert_false(check(entry, None))
+    assert_equals(1, needs_put.call_count)
+
+    # Nothing's recorded if the put fails
+    put_archive.side_effect = IOError()
+    assert_raises(IOError, checkpoint.putting(put_archive), Mock(object_id='data/a/b'))
+    assert_equals(set(['data/x/y']), checkpoint.put)
+
+
+@with_setup(setup_func, teardown_func)
+def test_cache_records_only_checksums_computed():
+    stat_cache = StatCache(':memory:')
+    Manifest.from_filesystem('hostname', 'username', [tree], [], cache=stat_cache)
+
+    os.utime(os.path.join(tree, '3'), (1363620000, 1363620000))
+
+    checkpoint = Checkpoint(checkpoint_path, IDENTITY)
+    Manifest.from_filesystem('hostname', 'username', [tree], [], cache=checkpoint.cache(stat_cache))
+    assert_equals([os.path.join(tree, '3')], checkpoint.hashes[tree].keys())
+    checkpoint.close()
+
+    # Without the stat cache, the checkpoint's checksums are still used
+    with patch('tardis.manifest.object_id_for') as patched:
+        patched.side_effect = object_id_for
+        resumed = Checkpoint(checkpoint_path, IDENTITY)
+        Manifest.from_filesystem('hostname', 'username', [tree], [], cache=resumed.cache())
+
+        assert_equals(9, patched.call_count)
+        assert_not_in(os.path.join(tree, '3'), [args[0][0] for args in patched.call_args_list])
+
+
+@with_setup(setup_func, teardown_func)
+def test_interrupted_backup_resumes():
+    bucket = FakeBucket()
+    get_bucket = lambda: bucket
+
+    def run_backup():
+        checkpoint = Checkpoint(checkpoint_path, IDENTITY)
+        try:
+            backup([tree],
+                   [],
+                   checkpoint.putting(functools.partial(put_archive, get_bucket, create_archive)),
+                   checkpoint.checking(functools.partial(needs_put, get_bucket)),
+                   functools.partial(put_manifest, get_bucket),
+                   functools.partial(latest_manifest, get_bucket, 'hostname', 'username'),
+                   functools.partial(Manifest.from_filesystem, 'hostname', 'username',
+                                     cache=checkpoint.cache()),
+                   backoff=0)
+        except:
+            checkpoint.close()
+            raise
+        checkpoint.clear()
+
+    bucket.fail('PUT', times=100, after=4)
+    assert_raises(PipelineError, run_backup)
+    assert_equals([], bucket.list('manifest/'))
+
+    bucket.failures.clear()
+    bucket.requests.clear()
+    run_backup()
+
+    # Only the objects that weren't put are checked and put, then the manifest
+    assert_equals(6 + 1, bucket.requests['PUT'])
+    assert_equals(6, bucket.requests['HEAD'])
+
+    manifest = latest_manifest(get_bucket, 'hostname', 'username')
+    assert_equals(10, len(list(manifest)))
+    for file_path in manifest:
+        assert_in(manifest[file_path].object_id, bucket.objects)
+
+    assert_false(os.path.exists(checkpoint_path))
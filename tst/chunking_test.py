@@ -0,0 +1,68 @@
+import random
+
+from nose.tools import *
+
+from tardis.util import sha1sum
+from tardis.chunking import chunks, chunk_id, is_recipe, to_recipe, from_recipe
+
+
+def random_content(size, seed=0):
+    rng = random.Random(seed)
+    return ''.join(chr(rng.randint(0, 255)) for _ in xrange(size))
+
+
+SIZES = { 'min_size': 256, 'average_size': 1024, 'max_size': 4096 }
+
+
+def test_chunks_reassemble():
+    content = random_content(50000)
+    result = list(chunks([content], **SIZES))
+
+    assert_equals(content, ''.join(result))
+    assert_true(all(256 <= len(c) <= 4096 for c in result[:-1]))
+    assert_true(len(result[-1]) <= 4096)
+
+
+def test_chunks_independent_of_parts():
+    content = random_content(50000)
+    expected = list(chunks([content], **SIZES))
+
+    for size in (1, 100, 4096, 10000):
+        parts = [content[i:i + size] for i in xrange(0, len(content), size)]
+        assert_equals(expected, list(chunks(parts, **SIZES)))
+
+
+def test_chunks_survive_insertion():
+    content = random_content(50000)
+    edited = content[:25000] + "an insertion" + content[25000:]
+
+    original = set(chunks([content], **SIZES))
+    changed = [c for c in chunks([edited], **SIZES) if c not in original]
+
+    assert_true(len(changed) <= 2)
+
+
+def test_chunks_empty():
+    assert_equals([], list(chunks([], **SIZES)))
+
+
+@raises(ValueError)
+def test_chunks_bad_sizes():
+    list(chunks([], min_size=10, average_size=5, max_size=20))
+
+
+def test_chunk_id():
+    assert_equals("chunk/{}".format(sha1sum(["abc"])), chunk_id("abc"))
+
+
+def test_recipe_round_trip():
+    ids = [chunk_id(c) for c in ("a", "b", "a")]
+    recipe = to_recipe(ids)
+
+    assert_true(is_recipe(recipe))
+    assert_equals(ids, from_recipe([recipe[:5], recipe[5:]]))
+
+
+@raises(ValueError)
+def test_from_recipe_not_recipe():
+    from_recipe(["\x1f\x8b not a recipe"])
@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+from nose.tools import *
+
+from tardis.buffers import file_views
+from tardis.compression import CODECS, NONE, GZIP, Policy, parse, compressed, decompressed
+
+
+TEXT = ''.join("Line {} of some very compressible text\n".format(i) for i in xrange(5000))
+
+
+def test_codecs_round_trip():
+    for name in CODECS:
+        yield check_round_trip, name
+
+
+def check_round_trip(name):
+    data = ''.join(compressed([TEXT[:1000], TEXT[1000:], ''], name))
+    parts = [data[i:i + 100] for i in xrange(0, len(data), 100)]
+
+    assert_equals(TEXT, ''.join(decompressed(parts, name)))
+    if name != NONE:
+        assert_less(len(data), len(TEXT) / 2)
+
+
+def test_codecs_compress_file_views():
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(TEXT)
+        f.flush()
+
+        for name in CODECS:
+            data = ''.join(compressed(file_views(f.name, 1000), name))
+            assert_equals(TEXT, ''.join(decompressed([data], name)))
+
+
+def test_gzip_is_gzip():
+    import gzip
+    from cStringIO import StringIO
+
+    data = ''.join(compressed([TEXT], GZIP, 9))
+    assert_equals(TEXT, gzip.GzipFile(fileobj=StringIO(data)).read())
+
+
+def test_parse():
+    assert_equals((GZIP, 6), parse('gzip'))
+    assert_equals((GZIP, 9), parse('gzip:9'))
+    assert_equals((NONE, None), parse('none'))
+
+
+@raises(ValueError)
+def test_parse_unknown_codec():
+    parse('rot13')
+
+
+@raises(ValueError)
+def test_parse_invalid_level():
+    parse('gzip:best')
+
+
+def test_policy():
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        def write(name, content):
+            path = os.path.join(temp_dir, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            return path
+
+        text = write('notes.txt', TEXT)
+        random = write('random.bin', os.urandom(2**17))
+        photo = write('photo.JPG', TEXT)
+        small = write('small.bin', os.urandom(100))
+
+        policy = Policy.from_spec('gzip:9')
+        assert_equals((GZIP, 9), policy.codec_for(text))
+        assert_equals((NONE, None), policy.codec_for(random))
+        assert_equals((NONE, None), policy.codec_for(photo))
+        assert_equals((GZIP, 9), policy.codec_for(small))
+
+        everything = policy._replace(skip_extensions=False, sample_size=0)
+        assert_equals((GZIP, 9), everything.codec_for(random))
+        assert_equals((GZIP, 9), everything.codec_for(photo))
+
+        assert_equals((NONE, None), Policy.from_spec('none').codec_for(text))
+    finally:
+        for name in os.listdir(temp_dir):
+            os.unlink(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
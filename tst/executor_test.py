@@ -0,0 +1,61 @@
+from nose.tools import *
+
+from tardis.executor import SerialExecutor, create_executor, imap_bounded, running
+
+
+def square(x):
+    return x * x
+
+
+def test_create_executor_single_job_is_serial():
+    assert_is_instance(create_executor('thread', 1), SerialExecutor)
+    assert_is_instance(create_executor('process', 1), SerialExecutor)
+
+
+@raises(ValueError)
+def test_create_executor_no_jobs():
+    create_executor('thread', 0)
+
+
+@raises(ValueError)
+def test_create_executor_unknown_kind():
+    create_executor('fibre', 2)
+
+
+def test_executors_preserve_order():
+    expected = [square(x) for x in range(100)]
+
+    for kind in ('thread', 'process'):
+        with running(create_executor(kind, 4)) as executor:
+            assert_equals(expected, executor.map(square, range(100)))
+            assert_equals(expected, list(executor.imap(square, range(100))))
+
+
+def test_imap_bounded():
+    expected = [square(x) for x in range(100)]
+
+    with running(create_executor('thread', 4)) as executor:
+        assert_equals(expected, list(imap_bounded(executor, square, range(100), 3)))
+
+    assert_equals(expected, list(imap_bounded(SerialExecutor(), square, range(100), 3)))
+
+
+def test_imap_bounded_window():
+    consumed = []
+
+    def items():
+        for i in range(10):
+            consumed.append(i)
+            yield i
+
+    results = imap_bounded(SerialExecutor(), square, items(), 3)
+    next(results)
+    assert_equals([0, 1, 2], consumed)
+
+
+@raises(IOError)
+def test_imap_bounded_error():
+    def explode(x):
+        raise IOError("boom")
+
+    list(imap_bounded(SerialExecutor(), explode, range(3), 2))
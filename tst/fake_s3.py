@@ -0,0 +1,198 @@
+"""An in-process stand-in for the parts of a boto S3 bucket tardis uses."""
+import re
+import hashlib
+import itertools
+import threading
+from cStringIO import StringIO
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self._stream = None
+        self.metadata = dict(bucket.metadata.get(name, {}))
+
+    @property
+    def key(self):
+        return self.name
+
+    @key.setter
+    def key(self, name):
+        self.name = name
+
+    @property
+    def size(self):
+        return len(self.bucket.objects[self.name])
+
+    @property
+    def etag(self):
+        return '"{}"'.format(hashlib.md5(self.bucket.objects[self.name]).hexdigest())
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_string(self, contents, encrypt_key=False):
+        self.bucket._request('PUT', self.name)
+        with self.bucket.lock:
+            self.bucket.objects[self.name] = contents
+            self.bucket.metadata[self.name] = dict(self.metadata)
+
+    def set_contents_from_filename(self, filename, encrypt_key=False):
+        with open(filename, 'rb') as f:
+            self.set_contents_from_string(f.read(), encrypt_key)
+
+    def get_contents_as_string(self, headers=None):
+        self.bucket._request('GET', self.name)
+        contents = self.bucket.objects[self.name]
+        self.metadata = dict(self.bucket.metadata.get(self.name, {}))
+
+        byte_range = (headers or {}).get('Range')
+        if byte_range:
+            start, end = byte_range[len('bytes='):].split('-')
+            return contents[int(start):int(end) + 1]
+
+        return contents
+
+    def get_contents_to_file(self, fp):
+        fp.write(self.get_contents_as_string())
+
+    def get_contents_to_filename(self, filename):
+        with open(filename, 'wb') as f:
+            self.get_contents_to_file(f)
+
+    def read(self, size):
+        if self._stream is None:
+            self._stream = StringIO(self.get_contents_as_string())
+        return self._stream.read(size)
+
+    def close(self):
+        self._stream = None
+
+    def __repr__(self):
+        return "<FakeKey({!r})>".format(self.name)
+
+
+class FakePrefix(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakePart(object):
+    def __init__(self, part_number, contents):
+        self.part_number = part_number
+        self.etag = '"{}"'.format(hashlib.md5(contents).hexdigest())
+        self.size = len(contents)
+
+
+class FakeMultiPartUpload(object):
+    _ids = itertools.count()
+
+    def __init__(self, bucket, key_name, metadata=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.metadata = dict(metadata or {})
+        self.id = str(next(self._ids))
+        self.parts = {}
+
+    def __iter__(self):
+        self.bucket._request('LIST', self.key_name)
+        return iter([FakePart(n, self.parts[n]) for n in sorted(self.parts)])
+
+    def upload_part_from_file(self, fp, part_num):
+        self.bucket._request('PUT', self.key_name)
+        contents = fp.read()
+        with self.bucket.lock:
+            self.parts[part_num] = contents
+
+    def cancel_upload(self):
+        self.bucket._request('DELETE', self.key_name)
+        with self.bucket.lock:
+            self.bucket.uploads.remove(self)
+
+
+class FakeBucket(object):
+    """Stores objects in a dict, counting requests by method.
+
+    fail(method, times, after) makes 'times' requests using that method
+    raise an IOError, once 'after' more have succeeded, to exercise retries.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.metadata = {}
+        self.uploads = []
+        self.requests = {}
+        self.failures = {}
+        self.lock = threading.RLock()
+
+    def _request(self, method, name):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+            after, times = self.failures.get(method, (0, 0))
+            if after > 0:
+                self.failures[method] = (after - 1, times)
+            elif times > 0:
+                self.failures[method] = (0, times - 1)
+                raise IOError("Injected failure for {} {}".format(method, name))
+
+    def fail(self, method, times=1, after=0):
+        with self.lock:
+            self.failures[method] = (after, times)
+
+    def new_key(self, name=None):
+        return FakeKey(self, name)
+
+    def get_key(self, name):
+        self._request('HEAD', name)
+        if name in self.objects:
+            return FakeKey(self, name)
+        return None
+
+    def list(self, prefix='', delimiter='', marker=''):
+        self._request('LIST', prefix)
+
+        results = []
+        for name in sorted(self.objects):
+            if not name.startswith(prefix) or name <= marker:
+                continue
+
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                common_prefix = prefix + rest[:rest.index(delimiter) + len(delimiter)]
+                if not results or results[-1].name != common_prefix:
+                    results.append(FakePrefix(common_prefix))
+            else:
+                results.append(FakeKey(self, name))
+
+        return results
+
+    def initiate_multipart_upload(self, key_name, metadata=None, encrypt_key=False):
+        self._request('POST', key_name)
+        upload = FakeMultiPartUpload(self, key_name, metadata)
+        with self.lock:
+            self.uploads.append(upload)
+        return upload
+
+    def complete_multipart_upload(self, key_name, upload_id, xml_body):
+        self._request('POST', key_name)
+        with self.lock:
+            upload = next(upload for upload in self.uploads if upload.id == upload_id)
+            part_numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)</PartNumber>', xml_body)]
+            self.objects[key_name] = ''.join(upload.parts[n] for n in part_numbers)
+            self.metadata[key_name] = upload.metadata
+            self.uploads.remove(upload)
+
+    def get_all_multipart_uploads(self, prefix=''):
+        self._request('LIST', prefix)
+        with self.lock:
+            return [upload for upload in self.uploads if upload.key_name.startswith(prefix)]
+
+    def delete_key(self, name):
+        self._request('DELETE', name)
+        with self.lock:
+            self.objects.pop(name, None)
+            self.metadata.pop(name, None)
@@ -0,0 +1,46 @@
+from nose.tools import *
+
+from fake_s3 import FakeBucket
+
+from tardis.util import sha1sum
+from tardis.index import ObjectIndex
+
+
+def object_id(name, content):
+    return "data/{}/{}".format(sha1sum([name]), sha1sum([content]))
+
+
+def test_index_contains():
+    index = ObjectIndex([object_id('a', 'content a'), 'manifest/odd/key'])
+
+    assert_in(object_id('a', 'content a'), index)
+    assert_in('manifest/odd/key', index)
+    assert_not_in(object_id('b', 'content a'), index)
+    assert_equals(2, len(index))
+
+
+def test_index_add():
+    index = ObjectIndex()
+    index.add("chunk/{}".format(sha1sum(['chunk'])))
+
+    assert_in("chunk/{}".format(sha1sum(['chunk'])), index)
+
+
+def test_index_is_compact():
+    index = ObjectIndex([object_id('a', 'content a')])
+    assert_equals([len('data/') + 40], [len(o) for o in index._objects])
+
+
+def test_index_from_bucket():
+    bucket = FakeBucket()
+    for name in ('a', 'b', 'c'):
+        bucket.objects[object_id(name, name)] = name
+    bucket.objects["chunk/{}".format(sha1sum(['x']))] = 'x'
+    bucket.objects["manifest/hostname/username/2013-03-18T15:33:50.122018"] = ''
+
+    index = ObjectIndex.from_bucket(lambda: bucket)
+
+    assert_equals(4, len(index))
+    assert_in(object_id('b', 'b'), index)
+    assert_not_in("manifest/hostname/username/2013-03-18T15:33:50.122018", index)
+    assert_equals(2, bucket.requests['LIST'])
@@ -0,0 +1,211 @@
+import os
+import os.path
+import tempfile
+import shutil
+
+from nose.tools import *
+from mock import patch
+
+from tardis.util import makedirs
+from tardis.manifest import Manifest
+from tardis.journal import Journal, Changes, stream_changes
+from tardis import scan
+
+
+temp_dir = None
+def setup_func():
+    global temp_dir
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+
+
+def teardown_func():
+    global temp_dir
+    shutil.rmtree(temp_dir)
+    temp_dir = None
+
+
+def journal():
+    return Journal(os.path.join(temp_dir, 'cache', 'journal'))
+
+
+@with_setup(setup_func, teardown_func)
+def test_journal_is_overflowed_unless_watched():
+    j = journal()
+    j.record(['/a'], ['/b'])
+
+    assert_equals(Changes(True, set(['/a']), set(['/b']), set()), j.claim())
+
+
+@with_setup(setup_func, teardown_func)
+def test_journal_claim_and_release():
+    j = journal()
+    with j.watching(['/', '/odd\nroot']):
+        assert_true(j.is_watched())
+
+        j.record(['/a', '/odd\nname'], ['/b'])
+        j.record(['/a', '/c'])
+        assert_equals(Changes(False, set(['/a', '/c', '/odd\nname']), set(['/b']), set(['/', '/odd\nroot'])),
+                      j.claim())
+
+        # Until released the claimed changes are claimed again
+        j.record(trees=['/d'])
+        assert_equals(Changes(False, set(['/a', '/c', '/odd\nname']), set(['/b', '/d']), set(['/', '/odd\nroot'])),
+                      j.claim())
+
+        j.release()
+        assert_equals(Changes(False, set(), set(), set(['/', '/odd\nroot'])), j.claim())
+
+        j.record(overflow=True)
+        assert_true(j.claim().overflowed)
+
+    assert_false(j.is_watched())
+
+
+@raises(ValueError)
+@with_setup(setup_func, teardown_func)
+def test_journal_only_one_watcher():
+    j = journal()
+    with j.watching():
+        with journal().watching():
+            pass
+
+
+@with_setup(setup_func, teardown_func)
+def test_journal_without_records_is_overflowed():
+    j = journal()
+    with j.watching():
+        assert_true(j.claim().overflowed)
+
+
+def write(path, content):
+    makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def stream(previous, changes, paths):
+    with patch("tardis.manifest.iso8601") as iso8601:
+        iso8601.return_value = '2013-03-18T15:33:50.122018'
+        streaming = stream_changes(previous, changes, 'hostname', 'username', paths)
+        return Manifest('manifest/hostname/username/2013-03-18T15:33:50.122018',
+                        ((entry.path, entry) for entry in streaming.entries()))
+
+
+def scanned(paths):
+    with patch("tardis.manifest.iso8601") as iso8601:
+        iso8601.return_value = '2013-03-18T15:33:50.122018'
+        return Manifest.from_filesystem('hostname', 'username', paths)
+
+
+@with_setup(setup_func, teardown_func)
+def test_stream_changes():
+    root = os.path.join(temp_dir, 'root')
+    for path in ['1', 'a/2', 'a/b/3', 'a/b/4', 'c/5', 'd/6', 'e.txt', 'e/7']:
+        write(os.path.join(root, path), path)
+
+    previous = scanned([root])
+
+    write(os.path.join(root, 'a', '2'), 'changed')
+    write(os.path.join(root, 'a', '8'), 'new')
+    os.unlink(os.path.join(root, 'a', 'b', '3'))
+    shutil.rmtree(os.path.join(root, 'c'))
+    write(os.path.join(root, 'f', 'g', '9'), 'new tree')
+    write(os.path.join(root, 'e', '7'), 'changed')
+    write(os.path.join(root, '.hidden', '10'), 'hidden')
+
+    changes = Changes(False,
+                      set([os.path.join(root, d) for d in ['a', 'a/b', 'e', '.hidden']] + ['/elsewhere']),
+                      set([os.path.join(root, d) for d in ['c', 'f']]),
+                      set([root]))
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        object_id_for.side_effect = lambda path, algorithm, mmap_threshold: "data/{}".format(os.path.relpath(path, root))
+        actual = stream(previous, changes, [root])
+
+    expected = scanned([root])
+    assert_equals(sorted(expected), list(actual))
+
+    # Only the changed directories were checksummed
+    for path in expected:
+        rescanned = os.path.relpath(path, root) in ['a/2', 'a/8', 'a/b/4', 'e/7', 'f/g/9']
+        assert_equals(rescanned, actual[path].object_id == "data/" + os.path.relpath(path, root))
+        if not rescanned:
+            assert_equals(expected[path], actual[path])
+
+
+@with_setup(setup_func, teardown_func)
+def test_stream_changes_new_root():
+    write(os.path.join(temp_dir, 'root', '1'), '1')
+    previous = scanned([os.path.join(temp_dir, 'root')])
+
+    write(os.path.join(temp_dir, 'other', '2'), '2')
+    paths = [os.path.join(temp_dir, 'root'), os.path.join(temp_dir, 'other')]
+
+    assert_equals(scanned(paths), stream(previous, Changes(False, set(), set(), set([temp_dir])), paths))
+
+
+@with_setup(setup_func, teardown_func)
+def test_stream_changes_overflowed():
+    root = os.path.join(temp_dir, 'root')
+    write(os.path.join(root, '1'), '1')
+    previous = scanned([root])
+
+    write(os.path.join(root, 'a', '2'), '2')
+
+    assert_equals(scanned([root]), stream(previous, Changes(True, set(), set(), set([root])), [root]))
+    assert_equals(scanned([root]), stream(Manifest("", {}), Changes(False, set(), set(), set([root])), [root]))
+
+
+@with_setup(setup_func, teardown_func)
+def test_stream_changes_unwatched_root():
+    for name in ['watched', 'unwatched']:
+        write(os.path.join(temp_dir, name, '1'), '1')
+    paths = [os.path.join(temp_dir, 'watched'), os.path.join(temp_dir, 'unwatched')]
+    previous = scanned(paths)
+
+    for name in ['watched', 'unwatched']:
+        write(os.path.join(temp_dir, name, '1'), 'changed')
+    changes = Changes(False, set([os.path.join(temp_dir, 'watched')]), set(), set([os.path.join(temp_dir, 'watched')]))
+
+    assert_equals(scanned(paths), stream(previous, changes, paths))
+
+
+@with_setup(setup_func, teardown_func)
+def test_stream_changes_root_wider_than_previous():
+    root = os.path.join(temp_dir, 'root')
+    write(os.path.join(root, 'a', '1'), '1')
+    write(os.path.join(root, 'b', '2'), '2')
+    previous = scanned([os.path.join(root, 'a')])
+
+    # Only what the previous backup covered can be carried over
+    assert_equals(scanned([root]), stream(previous, Changes(False, set(), set(), set([temp_dir])), [root]))
+
+
+@with_setup(setup_func, teardown_func)
+def test_stream_changes_directory_gone_before_scanned():
+    root = os.path.join(temp_dir, 'root')
+    for path in ['1', 'a/2', 'a/b/3', 'c/4', 'c/d/5', 'c/z']:
+        write(os.path.join(root, path), path)
+    previous = scanned([root])
+
+    for path in ['c/4', 'c/d/5', 'c/z']:
+        write(os.path.join(root, path), 'changed')
+    changes = Changes(False, set([os.path.join(root, d) for d in ['a', 'c', 'c/d']]), set(), set([root]))
+
+    # Nothing's scanned until the entries are consumed, by which time a has gone
+    with patch("tardis.manifest.iso8601") as iso8601, \
+         patch('tardis.scan.scan_directory', wraps=scan.scan_directory) as scan_directory:
+        iso8601.return_value = '2013-03-18T15:33:50.122018'
+        streaming = stream_changes(previous, changes, 'hostname', 'username', [root])
+        assert_false(scan_directory.called)
+
+        shutil.rmtree(os.path.join(root, 'a'))
+        entries = list(streaming.entries())
+
+    # The changed directories' files are interleaved in path order
+    paths = [entry.path for entry in entries]
+    assert_equals(sorted(paths), paths)
+
+    actual = Manifest('manifest/hostname/username/2013-03-18T15:33:50.122018',
+                      ((entry.path, entry) for entry in entries))
+    assert_equals(scanned([root]), actual)
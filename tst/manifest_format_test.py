@@ -0,0 +1,121 @@
+from cStringIO import StringIO
+
+from nose.tools import *
+
+from tardis.manifest_format import ManifestWriter, ManifestFormatError, read_header, iter_entries, is_binary
+from tardis.manifest_format import read_index, read_block, Header, diff, patch, removed
+
+
+def fields_for(i):
+    return ("/home/user/directory/{:05d}".format(i), "data/{}/{}".format(i, i), "user", "group",
+            0644, 1363621000 + i, 1363620000 + i, i * 1000, "", 0, 0)
+
+
+def write_manifest(entries, block_entries=3, **kwargs):
+    stream = StringIO()
+    writer = ManifestWriter(stream, "manifest/hostname/username/now", block_entries, **kwargs)
+    for fields in entries:
+        writer.write(fields)
+    writer.close()
+    return stream.getvalue()
+
+
+class ReadOnly(object):
+    """Only supports read, like a network stream"""
+    def __init__(self, data):
+        self._stream = StringIO(data)
+
+    def read(self, size):
+        return self._stream.read(size)
+
+
+def test_round_trip():
+    entries = [fields_for(i) for i in range(10)]
+    stream = ReadOnly(write_manifest(entries))
+
+    assert_equals(Header("manifest/hostname/username/now", "", 0), read_header(stream))
+    assert_equals(entries, list(iter_entries(stream)))
+
+
+def test_empty_round_trip():
+    stream = ReadOnly(write_manifest([]))
+
+    assert_equals(Header("manifest/hostname/username/now", "", 0), read_header(stream))
+    assert_equals([], list(iter_entries(stream)))
+
+
+def test_is_binary():
+    assert_true(is_binary(write_manifest([])))
+    assert_false(is_binary('"manifest/hostname/username/now"\n'))
+
+
+def test_paths_are_prefix_compressed():
+    entries = [fields_for(i) for i in range(1000)]
+    data = write_manifest(entries, block_entries=1000)
+
+    assert_true(len(data) < sum(len(":".join(str(f) for f in fields)) for fields in entries) / 4)
+
+
+@raises(ValueError)
+def test_entries_must_be_sorted():
+    write_manifest([fields_for(1), fields_for(0)])
+
+
+@raises(ManifestFormatError)
+def test_truncated():
+    data = write_manifest([fields_for(i) for i in range(10)])
+    stream = ReadOnly(data[:len(data) / 2])
+    read_header(stream)
+    list(iter_entries(stream))
+
+
+@raises(ManifestFormatError)
+def test_unsupported_version():
+    data = write_manifest([])
+    read_header(ReadOnly(data[:8] + "\x00\xff" + data[10:]))
+
+
+def test_read_index():
+    data = write_manifest([fields_for(i) for i in range(10)], block_entries=3)
+    header, index = read_index(data)
+
+    assert_equals(Header("manifest/hostname/username/now", "", 0), header)
+    assert_equals([fields_for(i)[0] for i in (0, 3, 6, 9)], [first_path for _, first_path in index])
+    assert_equals([fields_for(i) for i in (3, 4, 5)], list(read_block(data, index[1][0])))
+
+
+@raises(ManifestFormatError)
+def test_read_index_incomplete():
+    read_index(write_manifest([fields_for(0)])[:-1])
+
+
+def test_delta_round_trip():
+    data = write_manifest([fields_for(0), removed(fields_for(1)[0])], parent="manifest/hostname/username/then",
+                          depth=3, roots=("/home/user/directory", "/srv"))
+
+    expected = Header("manifest/hostname/username/now", "manifest/hostname/username/then", 3,
+                      ("/home/user/directory", "/srv"))
+    assert_equals(expected, read_header(ReadOnly(data)))
+    assert_equals(expected, read_index(data)[0])
+
+
+def test_pack_fields_round_trip():
+    entries = [fields_for(i)[:8] + ("pack/{}".format(i), i * 100, 2**40 + i) for i in range(10)]
+    stream = ReadOnly(write_manifest(entries))
+
+    read_header(stream)
+    assert_equals(entries, list(iter_entries(stream)))
+
+
+def test_diff_and_patch():
+    old = [fields_for(i) for i in range(10)]
+    new = [fields_for(i) for i in range(10) if i % 3] + [fields_for(10)]
+    new[0] = new[0][:7] + (1,) + new[0][8:]
+
+    delta = list(diff(old, new))
+    assert_equals([removed(fields_for(0)[0]), new[0], removed(fields_for(3)[0]), removed(fields_for(6)[0]),
+                   removed(fields_for(9)[0]), fields_for(10)], delta)
+    assert_equals(new, list(patch(old, [delta])))
+
+    newer = [fields_for(0)] + new[1:]
+    assert_equals(newer, list(patch(old, [delta, diff(new, newer)])))
@@ -1,4 +1,6 @@
 import os.path
+import mmap
+import hashlib
 import tempfile
 import shutil
 import functools
@@ -11,9 +13,12 @@ from mock import patch
 
 from utilities import assert_really_equal, assert_really_not_equal
 
-from tardis.util import sha1sum, makedirs
-from tardis.tree import Tree
-from tardis.manifest import StatInfo, FileEntry, DirectoryEntry, Manifest
+from tardis.util import sha1sum, makedirs, checksum, checksum_algorithm
+from tardis.manifest import StatInfo, FileEntry, NullFileEntry, DirectoryEntry, Manifest, MappedManifest
+from tardis.manifest import Location, manifest_time
+from tardis import manifest_format
+from tardis.executor import SerialExecutor, create_executor, running
+from tardis.cache import StatCache
 
 
 
@@ -56,6 +61,20 @@ def expected_file_entry_for(i):
 
 
 
+@with_setup(setup_func, teardown_func)
+def test_stat_info_apply_to_without_owner():
+    path = os.path.join(temp_dir, '0')
+    os.chmod(path, 0600)
+    stat_info = StatInfo.for_file(path)._replace(mode=0644, mtime=1363620000)
+
+    with patch('os.chown') as chown:
+        chown.side_effect = OSError(1, "Operation not permitted")
+        assert_raises(OSError, stat_info.apply_to, path)
+
+    # Everything but the owner is still applied
+    assert_equals(stat_info._replace(ctime=0), StatInfo.for_file(path)._replace(ctime=0))
+
+
 @raises(ValueError)
 @with_setup(setup_func, teardown_func)
 def test_file_entry_no_path():
@@ -121,6 +140,20 @@ def test_file_entry_as_fields():
     assert_really_equal(expected, entry.as_fields())
 
 
+@with_setup(setup_func, teardown_func)
+def test_file_entry_as_binary_fields():
+    filename = os.path.join(temp_dir, '0')
+    object_id = "data/{}/{}".format(sha1sum('0'), sha1sum("This is content number 0"))
+    stat_info = StatInfo.for_file(filename)
+
+    entry = FileEntry(filename, object_id, stat_info)
+    assert_really_equal((filename, object_id) + stat_info + ("", 0, 0), entry.as_binary_fields())
+
+    packed = FileEntry(filename, object_id, stat_info, Location("pack/abc", 10, 20))
+    assert_really_equal((filename, object_id) + stat_info + ("pack/abc", 10, 20), packed.as_binary_fields())
+    assert_equals(packed, FileEntry.from_fields(packed.as_binary_fields()))
+
+
 @with_setup(setup_func, teardown_func)
 def test_file_entry_from_fields_wrong_fields():
     filename = os.path.join(temp_dir, '0')
@@ -145,13 +178,13 @@ def test_directory_entry_for_directory_not_dir(isdir_mock):
     DirectoryEntry.for_directory(temp_dir)
 
 
-@patch('os.path.isfile')
 @with_setup(setup_func, teardown_func)
-def test_directory_entry_for_directory_no_files(isfile_mock):
-    isfile_mock.return_value = False
+def test_directory_entry_for_directory_no_files():
+    empty = os.path.join(temp_dir, 'empty')
+    makedirs(empty)
 
-    expected = DirectoryEntry(temp_dir, [])
-    assert_really_equal(expected, DirectoryEntry.for_directory(temp_dir))
+    expected = DirectoryEntry(empty, [])
+    assert_really_equal(expected, DirectoryEntry.for_directory(empty))
 
 
 @with_setup(setup_func, teardown_func)
@@ -162,13 +195,135 @@ def test_directory_entry_for_directory():
     assert_really_equal(expected, DirectoryEntry.for_directory(temp_dir))
 
 
+@with_setup(setup_func, teardown_func)
+def test_directory_entry_for_directory_with_executor():
+    expected = DirectoryEntry.for_directory(temp_dir)
+
+    for kind in ('thread', 'process'):
+        with running(create_executor(kind, 4)) as executor:
+            assert_really_equal(expected, DirectoryEntry.for_directory(temp_dir, executor))
+
+
+@with_setup(setup_func, teardown_func)
+def test_directory_entry_for_directory_mmap_threshold():
+    expected = DirectoryEntry.for_directory(temp_dir)
+
+    with patch('mmap.mmap', wraps=mmap.mmap) as mapped:
+        assert_really_equal(expected, DirectoryEntry.for_directory(temp_dir, mmap_threshold=1))
+        assert_equals(10, mapped.call_count)
+
+
+@with_setup(setup_func, teardown_func)
+def test_directory_entry_for_directory_with_cache():
+    cache = StatCache(':memory:')
+    expected = DirectoryEntry.for_directory(temp_dir, cache=cache)
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        assert_really_equal(expected, DirectoryEntry.for_directory(temp_dir, cache=cache))
+        assert_false(object_id_for.called)
+
+    with open(os.path.join(temp_dir, '3'), 'wb') as f:
+        f.write("This is new content")
+    os.utime(os.path.join(temp_dir, '3'), (0, 0))
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        object_id_for.side_effect = lambda path, algorithm, mmap_threshold: path
+        actual = DirectoryEntry.for_directory(temp_dir, cache=cache)
+
+    assert_equals([os.path.join(temp_dir, '3')], [e.object_id for e in actual if e.object_id == e.path])
+
+
+@with_setup(setup_func, teardown_func)
+def test_directory_entry_checksum_algorithm():
+    entries = DirectoryEntry.for_directory(temp_dir, algorithm='sha256').entries
+
+    for entry in entries:
+        content = "This is content number {}".format(os.path.basename(entry.path))
+        assert_equals("data/{}/sha256-{}".format(sha1sum(os.path.basename(entry.path)),
+                                                 hashlib.sha256(content).hexdigest()), entry.object_id)
+        assert_equals('sha256', checksum_algorithm(entry.checksum))
+
+
+@with_setup(setup_func, teardown_func)
+def test_directory_entry_cache_ignores_other_algorithms():
+    cache = StatCache(':memory:')
+    sha1_entries = DirectoryEntry.for_directory(temp_dir, cache=cache).entries
+
+    sha256_entries = DirectoryEntry.for_directory(temp_dir, cache=cache, algorithm='sha256').entries
+    assert_true(all(a.checksum_differs(b) for a, b in zip(sha1_entries, sha256_entries)))
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        assert_equals(sha256_entries, DirectoryEntry.for_directory(temp_dir, cache=cache, algorithm='sha256').entries)
+        assert_false(object_id_for.called)
+
+
+@with_setup(setup_func, teardown_func)
+def test_directory_entry_previous_manifest():
+    with patch("tardis.manifest.iso8601") as iso8601:
+        iso8601.return_value = '2100-01-01T00:00:00.000000'
+        previous = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        actual = DirectoryEntry.for_directory(temp_dir, previous=previous).entries
+        assert_false(object_id_for.called)
+    assert_equals([previous[e.path] for e in actual], actual)
+
+    # The same size, but a different mtime
+    path = os.path.join(temp_dir, '3')
+    with open(path, 'wb') as f:
+        f.write("This is CONTENT number 3")
+    os.utime(path, (1363620000, 1363620000))
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        object_id_for.side_effect = lambda path, algorithm, mmap_threshold: path
+        actual = DirectoryEntry.for_directory(temp_dir, previous=previous)
+    assert_equals([path], [e.object_id for e in actual if e.object_id == e.path])
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        object_id_for.side_effect = lambda path, algorithm, mmap_threshold: path
+        actual = DirectoryEntry.for_directory(temp_dir, previous=previous, algorithm='sha256')
+    assert_equals(10, object_id_for.call_count)
+
+
+@with_setup(setup_func, teardown_func)
+def test_directory_entry_previous_manifest_racy():
+    # Files changed in the second the manifest was named might have changed
+    # again since without it showing
+    previous = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        object_id_for.side_effect = lambda path, algorithm, mmap_threshold: path
+        DirectoryEntry.for_directory(temp_dir, previous=previous)
+    assert_equals(10, object_id_for.call_count)
+
+    with patch('tardis.manifest.object_id_for') as object_id_for:
+        object_id_for.side_effect = lambda path, algorithm, mmap_threshold: path
+        DirectoryEntry.for_directory(temp_dir, previous=Manifest("", {}))
+    assert_equals(10, object_id_for.call_count)
+
+
+def test_manifest_time():
+    assert_equals(1363620830, manifest_time('manifest/hostname/username/2013-03-18T15:33:50.122018'))
+    assert_equals(1363620830, manifest_time('manifest/hostname/username/2013-03-18T15:33:50'))
+    assert_equals(None, manifest_time(''))
+
+
+def test_checksum():
+    assert_equals(sha1sum(["ab", "c"]), checksum(["ab", "c"]))
+    assert_equals('sha1', checksum_algorithm(checksum(["abc"])))
+    assert_equals("sha512-" + hashlib.sha512("abc").hexdigest(), checksum(["ab", "c"], 'sha512'))
+    assert_equals('sha512', checksum_algorithm(checksum(["abc"], 'sha512')))
+
+    with assert_raises(ValueError):
+        checksum(["abc"], 'crc32')
+
+
 ##################
 # Manifest Tests #
 ##################
 @with_setup(setup_func, teardown_func)
 def test_manifest_equality():
-    tree = Tree(DirectoryEntry.for_directory(temp_dir), [])
-    expected_entries = { e.path: e for d in tree for e in d }
+    expected_entries = { e.path: e for e in DirectoryEntry.for_directory(temp_dir) }
     expected_name = 'manifest/hostname/username/2013-03-18T15:33:50.122018'
     expected = Manifest(expected_name, expected_entries)
 
@@ -184,6 +339,49 @@ def test_manifest_equality():
     assert_equal(NotImplemented, expected.__ne__(1))
 
 
+@with_setup(setup_func, teardown_func)
+def test_manifest_from_filesystem_with_executor():
+    subdirectory = os.path.join(temp_dir, 'subdirectory')
+    makedirs(subdirectory)
+    with open(os.path.join(subdirectory, 'a'), 'wb') as f:
+        f.write("This is nested content")
+
+    with patch("tardis.manifest.iso8601") as iso8601:
+        iso8601.return_value = '2013-03-18T15:33:50.122018'
+        expected = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+
+        with running(create_executor('thread', 4)) as executor:
+            actual = Manifest.from_filesystem('hostname', 'username', [temp_dir], executor=executor)
+
+    assert_really_equal(expected, actual)
+
+
+@with_setup(setup_func, teardown_func)
+def test_manifest_iter_filesystem_checksums_across_directories():
+    for i in range(3):
+        subdirectory = os.path.join(temp_dir, 'subdirectory{}'.format(i))
+        makedirs(subdirectory)
+        with open(os.path.join(subdirectory, 'a'), 'wb') as f:
+            f.write("This is nested content {}".format(i))
+
+    cache = StatCache(':memory:')
+    list(Manifest.iter_filesystem([os.path.join(temp_dir, 'subdirectory0')], cache=cache))
+
+    executor = SerialExecutor()
+    with patch.object(executor, 'apply_async', wraps=executor.apply_async) as apply_async:
+        entries = Manifest.iter_filesystem([temp_dir], executor=executor, cache=cache)
+        first = next(entries)
+
+        # Every uncached file is submitted before the first is consumed
+        submitted = [args[1][0] for args, _ in apply_async.call_args_list]
+        assert_equals(12, len(submitted))
+        assert_not_in(os.path.join(temp_dir, 'subdirectory0', 'a'), submitted)
+
+    assert_equals(list(Manifest.iter_filesystem([temp_dir])), [first] + list(entries))
+    assert_equals(10, len(cache.for_directory(temp_dir)))
+    assert_equals(1, len(cache.for_directory(os.path.join(temp_dir, 'subdirectory2'))))
+
+
 @raises(ValueError)
 @with_setup(setup_func, teardown_func)
 def test_manifest_from_filesystem_no_hostname():
@@ -210,8 +408,7 @@ def test_manifest_from_filesystem_path_is_not_directory():
 
 @with_setup(setup_func, teardown_func)
 def test_manifest_from_filesystem():
-    tree = Tree(DirectoryEntry.for_directory(temp_dir), [])
-    expected_entries = { e.path: e for d in tree for e in d }
+    expected_entries = { e.path: e for e in DirectoryEntry.for_directory(temp_dir) }
     expected_name = 'manifest/hostname/username/2013-03-18T15:33:50.122018'
     expected = Manifest(expected_name, expected_entries)
 
@@ -221,6 +418,84 @@ def test_manifest_from_filesystem():
         assert_really_equal(expected, Manifest.from_filesystem('hostname', 'username', [temp_dir]))
 
 
+@with_setup(setup_func, teardown_func)
+def test_manifest_iter_filesystem_is_in_path_order():
+    for path in ['a.txt', 'a/b', 'a0']:
+        path = os.path.join(temp_dir, 'nested', path)
+        makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(path)
+
+    # The nested root is only walked once
+    paths = [entry.path for entry in Manifest.iter_filesystem([temp_dir, os.path.join(temp_dir, 'nested')])]
+
+    assert_equals(sorted(paths), paths)
+    assert_equals(13, len(paths))
+
+
+@raises(ValueError)
+@with_setup(setup_func, teardown_func)
+def test_manifest_iter_filesystem_checks_paths_up_front():
+    Manifest.iter_filesystem([temp_dir, temp_dir + '-missing'])
+
+
+@with_setup(setup_func, teardown_func)
+def test_streaming_manifest():
+    with patch("tardis.manifest.iso8601") as iso8601:
+        iso8601.return_value = '2013-03-18T15:33:50.122018'
+        expected = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+        streaming = Manifest.stream_filesystem('hostname', 'username', [temp_dir])
+
+    entries = streaming.entries()
+    assert_equals(expected['{}/0'.format(temp_dir)], next(entries))
+
+    # Writing the manifest out consumes the rest of the entries
+    with closing(StringIO()) as stream:
+        streaming.to_binary(stream)
+        stream.seek(0)
+        assert_really_equal(expected, Manifest.load(stream))
+
+    assert_equals([], list(entries))
+    assert_equals([], list(streaming.entries()))
+
+
+@with_setup(setup_func, teardown_func)
+def test_manifest_from_chain():
+    base = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+
+    with open(os.path.join(temp_dir, '3'), 'wb') as f:
+        f.write("This is new content")
+    os.unlink(os.path.join(temp_dir, '4'))
+    expected = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+
+    chain_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        base_path = os.path.join(chain_dir, 'base')
+        delta_path = os.path.join(chain_dir, 'delta')
+
+        # Deltas can apply to legacy csv manifests
+        with open(base_path, 'wb') as f:
+            base.to_csv(f)
+
+        with open(delta_path, 'wb') as f:
+            writer = manifest_format.ManifestWriter(f, expected._name, parent=base._name, depth=1)
+            for fields in manifest_format.diff((e.as_binary_fields() for e in base.entries()),
+                                               (e.as_binary_fields() for e in expected.entries())):
+                writer.write(fields)
+            writer.close()
+
+        with assert_raises(manifest_format.ManifestFormatError):
+            Manifest.from_file(delta_path)
+
+        actual = Manifest.from_chain([base_path, delta_path])
+    finally:
+        shutil.rmtree(chain_dir)
+
+    assert_equals(expected._name, actual._name)
+    assert_equals(1, actual.depth)
+    assert_equals(list(expected.entries()), list(actual.entries()))
+
+
 @with_setup(setup_func, teardown_func)
 def test_manifest_to_csv():
     def csv_row_for(i):
@@ -242,3 +517,119 @@ def test_manifest_to_csv():
     expected += [csv_row_for(i) for i in range(10)]
 
     assert_equals(sorted(expected), sorted(contents.splitlines()))
+
+
+@with_setup(setup_func, teardown_func)
+def test_manifest_load():
+    manifest = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+
+    with closing(StringIO()) as csvfile:
+        manifest.to_csv(csvfile)
+        csvfile.seek(0)
+        assert_really_equal(manifest, Manifest.load(csvfile))
+
+    with closing(StringIO()) as binaryfile:
+        manifest.to_binary(binaryfile)
+        binaryfile.seek(0)
+        assert_really_equal(manifest, Manifest.load(binaryfile))
+
+
+@with_setup(setup_func, teardown_func)
+def test_manifest_iter_stream():
+    manifest = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+
+    with closing(StringIO()) as binaryfile:
+        manifest.to_binary(binaryfile)
+        binaryfile.seek(0)
+
+        header, entries = Manifest.iter_stream(binaryfile)
+        assert_equals(manifest._name, header.name)
+        assert_equals((temp_dir,), header.roots)
+        assert_equals(sorted(manifest), [entry.path for entry in entries])
+
+
+def write_binary_manifest(path, count):
+    entries = {}
+    for i in range(count):
+        file_path = "/home/user/{:03d}/{:03d}".format(i / 100, i % 100)
+        entries[file_path] = FileEntry(file_path, "data/{}/{}".format(i, i),
+                                       StatInfo('user', 'group', 0644, 1363621000, 1363620000, i))
+    manifest = Manifest('manifest/hostname/username/now', entries)
+
+    with open(path, 'wb') as f:
+        writer = manifest_format.ManifestWriter(f, manifest._name, block_entries=64)
+        for file_path in manifest:
+            writer.write(manifest[file_path].as_binary_fields())
+        writer.close()
+
+    return manifest
+
+
+@with_setup(setup_func, teardown_func)
+def test_mapped_manifest():
+    path = os.path.join(temp_dir, 'manifest')
+    expected = write_binary_manifest(path, 1000)
+
+    manifest = Manifest.from_file(path)
+    try:
+        assert_is_instance(manifest, MappedManifest)
+        assert_equals(expected._name, manifest._name)
+        assert_equals(list(expected), list(manifest))
+
+        for file_path in expected:
+            assert_in(file_path, manifest)
+            assert_really_equal(expected[file_path], manifest[file_path])
+
+        for missing in ("/aaa", "/home/user/000/0000", "/home/user/005/050x", "/zzz"):
+            assert_not_in(missing, manifest)
+            assert_is_instance(manifest[missing], NullFileEntry)
+    finally:
+        manifest.close()
+
+
+@with_setup(setup_func, teardown_func)
+def test_manifest_from_file_csv():
+    path = os.path.join(temp_dir, 'manifest')
+    manifest = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+    with open(path, 'wb') as f:
+        manifest.to_csv(f)
+
+    assert_really_equal(manifest, Manifest.from_file(path))
+
+
+def under_fixture():
+    paths = ["/home/a/1", "/home/a/sub/2", "/home/a-b/3", "/home/ab/4", "/home/a.txt", "/home/b/5"]
+    stat_info = StatInfo('user', 'group', 0644, 1363621000, 1363620000, 10)
+    return Manifest('manifest/hostname/username/now',
+                    { path: FileEntry(path, "data/x/y", stat_info) for path in paths })
+
+
+def assert_under(manifest):
+    assert_equals(["/home/a/1", "/home/a/sub/2"], [e.path for e in manifest.under("/home/a")])
+    assert_equals(["/home/a/1", "/home/a/sub/2"], [e.path for e in manifest.under("/home/a/")])
+    assert_equals(["/home/ab/4"], [e.path for e in manifest.under("/home/ab")])
+    assert_equals(list(manifest), [e.path for e in manifest.under("/")])
+    assert_equals([], list(manifest.under("/home/c")))
+    assert_equals([], list(manifest.under("/home/a/1")))
+
+
+def test_manifest_under():
+    assert_under(under_fixture())
+
+
+@with_setup(setup_func, teardown_func)
+def test_mapped_manifest_under():
+    path = os.path.join(temp_dir, 'manifest')
+    manifest = under_fixture()
+
+    with open(path, 'wb') as f:
+        writer = manifest_format.ManifestWriter(f, manifest._name, block_entries=2)
+        for file_path in manifest:
+            writer.write(manifest[file_path].as_binary_fields())
+        writer.close()
+
+    mapped = Manifest.from_file(path)
+    try:
+        assert_under(mapped)
+    finally:
+        mapped.close()
@@ -0,0 +1,143 @@
+import os
+import json
+import pstats
+import shutil
+import tempfile
+import threading
+
+from nose.tools import *
+
+from tardis.metrics import Metrics, BUCKETS, profiling
+from tardis import metrics, transfer
+from fake_s3 import FakeBucket
+
+
+def test_timed_and_counted():
+    m = Metrics()
+    with m.timed('hash'):
+        pass
+    assert_equals(["abc", "de"], list(m.counted('hash_bytes', ["abc", "de"])))
+
+    snapshot = m.snapshot()
+    assert_equals({ 'hash_bytes': 5 }, snapshot['counters'])
+    assert_equals(1, snapshot['timings']['hash']['count'])
+    assert_equals(1, sum(snapshot['timings']['hash']['buckets']))
+
+
+def test_timing():
+    m = Metrics()
+
+    @m.timing('check')
+    def check(x):
+        return x * 2
+
+    assert_equals(4, check(2))
+    assert_equals(1, m.snapshot()['timings']['check']['count'])
+
+
+def test_timed_parts():
+    m = Metrics()
+    parts = m.timed_parts('download', iter(["abc", "defg"]))
+
+    # Nothing's recorded until the parts are exhausted
+    assert_equals("abc", next(parts))
+    assert_equals({}, m.snapshot()['timings'])
+
+    assert_equals(["defg"], list(parts))
+    assert_equals(1, m.snapshot()['timings']['download']['count'])
+    assert_equals(7, m.snapshot()['counters']['download_bytes'])
+
+
+def test_thread_safe():
+    m = Metrics()
+
+    def count():
+        for _ in xrange(1000):
+            m.count('requests')
+
+    threads = [threading.Thread(target=count) for _ in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_equals(4000, m.snapshot()['counters']['requests'])
+
+
+def test_summary():
+    m = Metrics()
+    m.observe('upload', 2.0)
+    m.count('upload_bytes', 4 * 2**20)
+    m.count('retries', 3)
+
+    lines = m.summary().splitlines()
+    assert_equals(3, len(lines))
+    assert_equals(['upload', '1', '2.000', '2000.000', '5000', '2.0'], lines[1].split())
+    assert_equals(['retries', '3'], lines[2].split())
+
+
+def test_prometheus():
+    m = Metrics()
+    m.observe('scan', 0.002)
+    m.count('scan_bytes', 10)
+
+    lines = m.prometheus().splitlines()
+    assert_in("# TYPE tardis_scan_bytes_total counter", lines)
+    assert_in("tardis_scan_bytes_total 10", lines)
+    assert_in("# TYPE tardis_scan_seconds histogram", lines)
+    assert_in('tardis_scan_seconds_bucket{le="0.001"} 0', lines)
+    assert_in('tardis_scan_seconds_bucket{le="0.005"} 1', lines)
+    assert_in('tardis_scan_seconds_bucket{le="+Inf"} 1', lines)
+    assert_in("tardis_scan_seconds_count 1", lines)
+    assert_equals(len(BUCKETS), len([line for line in lines if '_bucket' in line]))
+
+
+def test_write():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        m = Metrics()
+        m.count('requests', 2)
+
+        m.write(os.path.join(temp_dir, "metrics.json"))
+        with open(os.path.join(temp_dir, "metrics.json")) as f:
+            assert_equals({ 'requests': 2 }, json.load(f)['counters'])
+
+        m.write(os.path.join(temp_dir, "metrics.prom"))
+        with open(os.path.join(temp_dir, "metrics.prom")) as f:
+            assert_in("tardis_requests_total 2", f.read())
+
+        assert_equals(["metrics.json", "metrics.prom"], sorted(os.listdir(temp_dir)))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_transfer_recorded():
+    metrics.METRICS.reset()
+    bucket = FakeBucket()
+
+    transfer.upload(lambda: bucket, "key", ["content"])
+    assert_equals("content", ''.join(transfer.download(lambda: bucket, "key")))
+
+    snapshot = metrics.METRICS.snapshot()
+    assert_equals(1, snapshot['timings']['upload']['count'])
+    assert_equals(1, snapshot['timings']['download']['count'])
+    assert_equals(7, snapshot['counters']['upload_bytes'])
+    assert_equals(7, snapshot['counters']['download_bytes'])
+
+
+def test_profiling():
+    def work():
+        return sum(xrange(1000))
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with profiling(path):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+
+        profiled = [function for _, _, function in pstats.Stats(path).stats]
+        assert_in('work', profiled)
+    finally:
+        os.unlink(path)
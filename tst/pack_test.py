@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+from nose.tools import *
+
+from fake_s3 import FakeBucket
+
+from tardis import create_archive
+from tardis.manifest import FileEntry, Location, Manifest
+from tardis.pack import Packer, PackCache, read_index, read_member, get_member, located
+
+
+StatInfo = namedtuple('StatInfo', ['size'])
+
+
+temp_dir = None
+bucket = None
+put = None
+def setup_func():
+    global temp_dir, bucket, put
+
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    bucket = FakeBucket()
+    put = []
+
+
+def teardown_func():
+    global temp_dir, bucket, put
+    shutil.rmtree(temp_dir)
+    temp_dir = bucket = put = None
+
+
+def file_entry(name, content):
+    path = os.path.join(temp_dir, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return FileEntry(path, "data/{}".format(name), StatInfo(len(content)))
+
+
+def create_packer(**kwargs):
+    return Packer(lambda: bucket, put.append, create_archive, **kwargs)
+
+
+def pack_names():
+    return sorted(name for name in bucket.objects if name.startswith('pack/'))
+
+
+@with_setup(setup_func, teardown_func)
+def test_small_files_are_packed():
+    packer = create_packer(threshold=1000, pack_size=2000)
+    entries = [file_entry(str(i), os.urandom(500)) for i in range(10)]
+    large = file_entry('large', os.urandom(1000))
+
+    for entry in entries + [large]:
+        packer.put(entry)
+    assert_equals([large], put)
+    assert_true(pack_names())
+
+    packer.flush()
+    packs = pack_names()
+    assert_true(1 < len(packs) < 10)
+    assert_equals(['pack'], list(set(bucket.metadata[name]['codec'] for name in packs)))
+
+    for entry in entries:
+        location = packer.locations[entry.object_id]
+        with open(entry.path, 'rb') as f:
+            assert_equals(f.read(), read_member(get_member(lambda: bucket, location)))
+
+    indexed = dict((object_id, Location(name, offset, length))
+                   for name in packs for object_id, offset, length in read_index(bucket.objects[name]))
+    assert_equals(packer.locations, indexed)
+
+
+@with_setup(setup_func, teardown_func)
+def test_failed_pack_is_put_again():
+    packer = create_packer(threshold=1000, pack_size=1)
+    bucket.fail('PUT')
+
+    entry = file_entry('0', "Small file")
+    with assert_raises(IOError):
+        packer.put(entry)
+    assert_equals({}, packer.locations)
+
+    # Retrying doesn't pack the file twice
+    packer.put(entry)
+    name, = pack_names()
+    assert_equals([entry.object_id], [object_id for object_id, _, _ in read_index(bucket.objects[name])])
+    assert_in(entry.object_id, packer.locations)
+
+
+@with_setup(setup_func, teardown_func)
+def test_located():
+    packer = create_packer(threshold=1000)
+    entry = file_entry('0', "Small file")
+    packer.put(entry)
+    packer.flush()
+
+    fields = ('/a/0', 'data/0', 'user', 'group', 0644, 1, 1, 10, "", 0, 0)
+    location = packer.locations['data/0']
+    assert_equals(fields[:8] + location, located(fields, packer.locations, None))
+
+    old_location = Location('pack/old', 10, 20)
+    previous = Manifest('previous', { '/a/1': FileEntry('/a/1', 'data/1', StatInfo(10), old_location)
+                                    , '/a/2': FileEntry('/a/2', 'data/2', StatInfo(10), old_location)
+                                    })
+    unchanged = ('/a/1', 'data/1') + fields[2:]
+    changed = ('/a/2', 'data/changed') + fields[2:]
+    assert_equals(unchanged[:8] + old_location, located(unchanged, packer.locations, previous))
+    assert_equals(changed, located(changed, packer.locations, previous))
+
+
+@with_setup(setup_func, teardown_func)
+def test_pack_cache_fetches_each_pack_once():
+    packer = create_packer(threshold=1000)
+    entries = [file_entry(str(i), "Small file {}".format(i)) for i in range(10)]
+    for entry in entries:
+        packer.put(entry)
+    packer.flush()
+
+    cache = PackCache(lambda: bucket)
+    for entry in entries:
+        member = cache.member(packer.locations[entry.object_id])
+        assert_equals("Small file {}".format(os.path.basename(entry.path)), read_member(member))
+
+    assert_equals(1, bucket.requests['GET'])
+
+
+@with_setup(setup_func, teardown_func)
+def test_known_locations_and_on_pack():
+    known = { 'data/known': Location('pack/x', 0, 10) }
+    packed = []
+    packer = create_packer(threshold=1000, known_locations=known, on_pack=packed.append)
+
+    entry = file_entry('new', os.urandom(500))
+    packer.put(entry)
+    packer.put(FileEntry(entry.path, 'data/known', StatInfo(500)))
+    packer.flush()
+
+    assert_equals(1, len(pack_names()))
+    assert_equals([['data/new']], [locations.keys() for locations in packed])
+    assert_equals(known['data/known'], packer.locations['data/known'])
@@ -0,0 +1,103 @@
+import threading
+
+from nose.tools import *
+from mock import Mock
+
+from tardis.pipeline import Pipeline, PipelineError, Stage, retrying
+
+
+def test_pipeline_runs_stages_in_order():
+    results = []
+    lock = threading.Lock()
+
+    def record(x):
+        with lock:
+            results.append(x)
+
+    pipeline = Pipeline([ Stage('double', lambda x: x * 2, 3)
+                        , Stage('increment', lambda x: x + 1, 2)
+                        , Stage('record', record, 1)
+                        ])
+    pipeline.run(range(50))
+
+    assert_equals([x * 2 + 1 for x in range(50)], sorted(results))
+
+
+def test_pipeline_none_drops_item():
+    results = []
+
+    pipeline = Pipeline([ Stage('evens', lambda x: x if x % 2 == 0 else None, 2)
+                        , Stage('record', results.append, 1)
+                        ])
+    pipeline.run(range(10))
+
+    assert_equals([0, 2, 4, 6, 8], sorted(results))
+
+
+def test_pipeline_failures_raised_after_draining():
+    results = []
+
+    def explode_on_three(x):
+        if x == 3:
+            raise IOError("boom")
+        return x
+
+    pipeline = Pipeline([ Stage('explode', explode_on_three, 2)
+                        , Stage('record', results.append, 1)
+                        ])
+
+    with assert_raises(PipelineError) as cm:
+        pipeline.run(range(6))
+
+    assert_equals([0, 1, 2, 4, 5], sorted(results))
+    assert_equals(1, len(cm.exception.failures))
+    assert_equals(('explode', 3), cm.exception.failures[0][:2])
+
+
+def test_pipeline_backpressure():
+    consumed = threading.Event()
+    produced = []
+
+    def items():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    def slow(x):
+        consumed.wait()
+
+    thread = threading.Thread(target=Pipeline([Stage('slow', slow, 1)], queue_size=2).run, args=(items(),))
+    thread.start()
+
+    # One item in the worker, two queued and one blocked in put()
+    thread.join(0.2)
+    assert_true(len(produced) <= 4)
+
+    consumed.set()
+    thread.join()
+    assert_equals(10, len(produced))
+
+
+@raises(ValueError)
+def test_pipeline_no_stages():
+    Pipeline([])
+
+
+@raises(ValueError)
+def test_pipeline_no_workers():
+    Pipeline([Stage('idle', lambda x: x, 0)])
+
+
+def test_retrying():
+    f = Mock(side_effect=[IOError(), IOError(), 'ok'])
+    sleep = Mock()
+
+    assert_equals('ok', retrying(f, 3, 0.5, sleep)('arg'))
+    assert_equals(3, f.call_count)
+    assert_equals([((0.5,),), ((1.0,),)], sleep.call_args_list)
+
+
+@raises(IOError)
+def test_retrying_gives_up():
+    f = Mock(side_effect=IOError())
+    retrying(f, 2, 0, Mock())()
@@ -0,0 +1,101 @@
+import threading
+
+from nose.tools import *
+from mock import Mock
+
+from tardis.pool import BucketPool
+
+
+def connections():
+    made = []
+
+    def connect():
+        connection = Mock()
+        made.append(connection)
+        return connection, "bucket{}".format(len(made))
+
+    return made, connect
+
+
+def in_thread(f):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(f()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_reuses_connection():
+    made, connect = connections()
+    pool = BucketPool(connect)
+
+    assert_equals(["bucket1"] * 3, [pool() for _ in xrange(3)])
+    assert_equals(1, len(made))
+    assert_equals((3, 1, 0, 0, 1, 1), tuple(pool.stats()))
+
+
+def test_recycles_after_max_requests():
+    made, connect = connections()
+    pool = BucketPool(connect, max_requests=2)
+
+    assert_equals(["bucket1", "bucket1", "bucket2"], [pool() for _ in xrange(3)])
+    assert made[0].close.called
+    assert not made[1].close.called
+    assert_equals(1, pool.stats().recycled)
+
+
+def test_threads_get_their_own_connection():
+    made, connect = connections()
+    pool = BucketPool(connect)
+
+    pool()
+    thread_bucket = in_thread(pool)
+
+    assert_equals("bucket2", thread_bucket)
+    assert_equals(2, pool.stats().peak_open)
+
+
+def test_finished_threads_connections_are_reused():
+    made, connect = connections()
+    pool = BucketPool(connect)
+
+    assert_equals("bucket1", in_thread(pool))
+    assert_equals("bucket1", in_thread(pool))
+    assert_equals(1, len(made))
+
+
+def test_keeps_at_most_max_idle():
+    made, connect = connections()
+    pool = BucketPool(connect, max_idle=0)
+
+    in_thread(pool)
+    assert_equals("bucket2", in_thread(pool))
+    assert made[0].close.called
+
+
+def test_recycling_discards_on_error():
+    made, connect = connections()
+    pool = BucketPool(connect)
+
+    def fail():
+        pool()
+        raise IOError("Connection reset")
+
+    assert_raises(IOError, pool.recycling(fail))
+    assert made[0].close.called
+    assert_equals("bucket2", pool())
+    assert_equals(1, pool.stats().discarded)
+
+    assert_equals("bucket2", pool.recycling(pool)())
+
+
+def test_close():
+    made, connect = connections()
+    pool = BucketPool(connect)
+
+    pool()
+    in_thread(pool)
+    pool.close()
+
+    assert all(connection.close.called for connection in made)
+    assert_equals(0, pool.stats().open)
@@ -0,0 +1,33 @@
+from nose.tools import *
+from mock import Mock, patch
+
+from tardis.progress import Progress
+
+
+def test_progress_counts():
+    clock = Mock(return_value=100.0)
+    progress = Progress("Restored", 10, 10 * 2**20, interval=60, clock=clock)
+
+    progress.update(2, 2**20)
+    progress.update(3, 2 * 2**20)
+    clock.return_value = 110.0
+
+    assert_equals(5, progress.files)
+    assert_equals(3 * 2**20, progress.bytes)
+    assert_equals("Restored 5 of 10 files, 3.0 of 10.0 MiB in 10.0s (0.5 files/s, 0.30 MiB/s)", progress.summary())
+
+
+def test_progress_reports_periodically():
+    clock = Mock(return_value=100.0)
+    progress = Progress("Put", interval=10, clock=clock)
+
+    with patch('tardis.progress.logging') as logging:
+        progress.update()
+        assert_false(logging.info.called)
+
+        clock.return_value = 111.0
+        progress.update()
+        assert_equals(1, logging.info.call_count)
+
+        progress.update()
+        assert_equals(1, logging.info.call_count)
@@ -0,0 +1,152 @@
+import os
+import os.path
+import tempfile
+import shutil
+
+from nose.tools import *
+from mock import patch
+
+from tardis.util import makedirs
+from tardis.cache import StatCache
+from tardis import scan
+
+
+temp_dir = None
+def setup_func():
+    global temp_dir
+
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+
+    for path in ['b/2', 'b/1', 'a/c/3', '.hidden/4', 'skipped/5', '6', '.tardis_manifest']:
+        path = os.path.join(temp_dir, path)
+        makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(path)
+
+    os.symlink(os.path.join(temp_dir, 'missing'), os.path.join(temp_dir, 'broken'))
+
+
+def teardown_func():
+    global temp_dir
+    shutil.rmtree(temp_dir)
+    temp_dir = None
+
+
+def file_names(directory_scan):
+    return [os.path.relpath(f, temp_dir) for f, _ in directory_scan.files]
+
+
+def expected_walk():
+    return ['6', 'a/c/3', 'b/1', 'b/2']
+
+
+@with_setup(setup_func, teardown_func)
+def test_walk():
+    walked = list(scan.walk(temp_dir, file_names, [os.path.join(temp_dir, 'skipped')]))
+    assert_equals(expected_walk(), walked)
+
+
+@with_setup(setup_func, teardown_func)
+def test_walk_without_scandir():
+    with patch('tardis.scan.scandir', None):
+        walked = list(scan.walk(temp_dir, file_names, [os.path.join(temp_dir, 'skipped')]))
+
+    assert_equals(expected_walk(), walked)
+
+
+@with_setup(setup_func, teardown_func)
+def test_walk_is_in_path_order():
+    for path in ['a.txt', 'a/b', 'a0', 'b.c/1', 'b0']:
+        path = os.path.join(temp_dir, 'order', path)
+        makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(path)
+
+    walked = list(scan.walk(temp_dir, file_names, [os.path.join(temp_dir, 'skipped')]))
+    assert_equals(sorted(walked), walked)
+    assert_equals(9, len(walked))
+
+
+@with_setup(setup_func, teardown_func)
+def test_walk_scans_each_directory_once():
+    scanned = []
+    def f(directory_scan):
+        scanned.append(directory_scan.path)
+        return file_names(directory_scan)
+
+    list(scan.walk(temp_dir, f))
+    assert_equals(sorted(set(scanned)), sorted(scanned))
+    assert_equals(5, len(scanned))
+
+
+@with_setup(setup_func, teardown_func)
+def test_scan_directory():
+    directory_scan = scan.scan_directory(temp_dir)
+
+    assert_equals(['.hidden', 'a', 'b', 'skipped'], directory_scan.subdirectories)
+    assert_equals(['6'], file_names(directory_scan))
+    assert_equals(os.stat(os.path.join(temp_dir, '6')), directory_scan.files[0][1])
+
+
+@raises(ValueError)
+@with_setup(setup_func, teardown_func)
+def test_walk_not_directory():
+    scan.walk(os.path.join(temp_dir, '6'), file_names)
+
+
+def age(path):
+    """Make path look as if it hasn't changed since before the scan started"""
+    os.utime(path, (1363620000, 1363620000))
+
+
+@with_setup(setup_func, teardown_func)
+def test_scan_directory_reuses_cached_listing():
+    cache = StatCache(':memory:')
+    age(temp_dir)
+    expected = scan.scan_directory(temp_dir, cache)
+
+    with patch('tardis.scan._read_directory') as read_directory:
+        assert_equals(expected, scan.scan_directory(temp_dir, cache))
+        assert_false(read_directory.called)
+
+    # Writing to a file doesn't change its directory, it's still stat'd again
+    with open(os.path.join(temp_dir, '6'), 'ab') as f:
+        f.write("more content")
+    os.utime(os.path.join(temp_dir, '6'), (0, 0))
+
+    actual = scan.scan_directory(temp_dir, cache)
+    assert_equals(0, actual.files[0][1].st_mtime)
+
+
+@with_setup(setup_func, teardown_func)
+def test_scan_directory_reads_changed_directory():
+    cache = StatCache(':memory:')
+    age(temp_dir)
+    scan.scan_directory(temp_dir, cache)
+
+    with open(os.path.join(temp_dir, '7'), 'wb') as f:
+        f.write("new file")
+    os.utime(temp_dir, (0, 0))
+
+    assert_equals(['6', '7'], [os.path.basename(f) for f, _ in scan.scan_directory(temp_dir, cache).files])
+
+
+@with_setup(setup_func, teardown_func)
+def test_scan_directory_does_not_cache_directory_changed_since_scan_started():
+    cache = StatCache(':memory:')
+    mtime = 1363620000.5
+    os.utime(temp_dir, (mtime, mtime))
+    scan.scan_directory(temp_dir, cache, started=mtime)
+
+    # A file created in the same tick leaves the directory's mtime as it was
+    with open(os.path.join(temp_dir, '7'), 'wb') as f:
+        f.write("new file")
+    os.utime(temp_dir, (mtime, mtime))
+
+    directory_scan = scan.scan_directory(temp_dir, cache, started=mtime + 1)
+    assert_equals(['6', '7'], [os.path.basename(f) for f, _ in directory_scan.files])
+
+    # Only once the directory's older than the scan is its listing cached
+    with patch('tardis.scan._read_directory', wraps=scan._read_directory) as read_directory:
+        scan.scan_directory(temp_dir, cache, started=mtime + 1)
+        assert_false(read_directory.called)
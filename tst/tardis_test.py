@@ -1,9 +1,31 @@
+import os
+import random
+import shutil
+import binascii
+import tempfile
+import functools
 from collections import namedtuple
+from cStringIO import StringIO
 
 from nose.tools import *
-from mock import Mock
+from mock import Mock, patch
 
-from tardis import list_manifest_keys
+from fake_s3 import FakeBucket
+
+from tardis import list_manifest_keys, latest_manifest, needs_put, put_archive, create_archive, put_manifest
+from tardis import backup, restore, get_archive, restore_archive, put_chunked_archive, compact_manifest
+from tardis import latest_manifest_key
+from tardis.compression import Policy
+from tardis.transfer import compressed
+from tardis.cache import ManifestCache
+from tardis import manifest_format
+from tardis.util import makedirs
+from tardis.manifest import Manifest, FileEntry
+from tardis.pipeline import PipelineError
+from tardis.index import ObjectIndex
+from tardis.pack import Packer, PackCache
+from tardis.journal import Journal, stream_changes
+from tardis import scan
 
 
 MockManifestKey = namedtuple("MockManifestKey", ['name'])
@@ -25,3 +47,581 @@ def test_list_manifest_keys():
                ]
 
     assert_equals(expected, list_manifest_keys(bucket, 'hostname', 'username'))
+
+
+def test_latest_manifest_key():
+    bucket = FakeBucket()
+    names = ["manifest/hostname/username/{}-{:02d}-{:02d}T12:00:00.000000".format(year, month, day)
+             for year in (2012, 2013) for month in range(1, 13) for day in (1, 15, 28)]
+    for name in names + ["manifest/hostname/other/2014-01-01T00:00:00.000000"]:
+        bucket.objects[name] = name
+
+    assert_equals(names[-1], latest_manifest_key(lambda: bucket, 'hostname', 'username').name)
+    # years, months, days and then that day's manifests
+    assert_equals(4, bucket.requests['LIST'])
+
+    assert_equals(names[-1], latest_manifest_key(lambda: bucket, 'hostname', 'username', after=names[-3]).name)
+    assert_equals(names[-1], latest_manifest_key(lambda: bucket, 'hostname', 'username', after=names[-1]).name)
+    assert_is_none(latest_manifest_key(lambda: FakeBucket(), 'hostname', 'username'))
+
+
+def backup_fixture():
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    for i in range(10):
+        with open(os.path.join(temp_dir, str(i)), 'wb') as f:
+            f.write("This is content number {}".format(i))
+    return temp_dir
+
+
+def run_backup(bucket, roots, put=None, create_manifest=None, packer=None, **kwargs):
+    get_bucket = lambda: bucket
+    backup(roots,
+           [],
+           put or functools.partial(put_archive, get_bucket, create_archive),
+           functools.partial(needs_put, get_bucket),
+           functools.partial(put_manifest, get_bucket, packer=packer),
+           functools.partial(latest_manifest, get_bucket, 'hostname', 'username'),
+           create_manifest or functools.partial(Manifest.from_filesystem, 'hostname', 'username'),
+           **kwargs)
+
+
+def test_backup_puts_every_file_then_manifest():
+    temp_dir = backup_fixture()
+    try:
+        bucket = FakeBucket()
+        run_backup(bucket, [temp_dir], workers=4, backoff=0)
+
+        manifest = latest_manifest(lambda: bucket, 'hostname', 'username')
+        assert_equals(10, len(list(manifest)))
+        for path in manifest:
+            assert_in(manifest[path].object_id, bucket.objects)
+
+        # Nothing changed so nothing is put second time around
+        run_backup(bucket, [temp_dir], workers=4, backoff=0)
+        assert_equals(10, bucket.requests['PUT'] - 2)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_backup_streaming_manifest():
+    temp_dir = backup_fixture()
+    try:
+        created = []
+        def create_manifest(roots, skip_directories):
+            created.append(Manifest.stream_filesystem('hostname', 'username', roots, skip_directories))
+            return created[-1]
+
+        bucket = FakeBucket()
+        run_backup(bucket, [temp_dir], workers=4, backoff=0, create_manifest=create_manifest)
+
+        manifest = latest_manifest(lambda: bucket, 'hostname', 'username')
+        assert_equals(10, len(list(manifest)))
+        for path in manifest:
+            assert_in(manifest[path].object_id, bucket.objects)
+
+        # The spooled entries are removed once the manifest is put
+        assert_true(created[0]._spool.closed)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_backup_from_journal_twice():
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        root = os.path.join(temp_dir, 'root')
+        for name in ['a', 'b', 'c']:
+            makedirs(os.path.join(root, name))
+            with open(os.path.join(root, name, '1'), 'wb') as f:
+                f.write("This is content in {}".format(name))
+
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        journal = Journal(os.path.join(temp_dir, 'cache', 'journal'))
+
+        def create_manifest(roots, skip_directories):
+            previous = latest_manifest(get_bucket, 'hostname', 'username')
+            return stream_changes(previous, journal.claim(), 'hostname', 'username', roots, skip_directories)
+
+        def backup_from_journal(changed):
+            with open(os.path.join(root, changed, '1'), 'wb') as f:
+                f.write("This is new content in {}".format(changed))
+            journal.record([os.path.join(root, changed)])
+
+            with patch('tardis.scan.scan_directory', wraps=scan.scan_directory) as scan_directory:
+                run_backup(bucket, [root], backoff=0, create_manifest=create_manifest)
+            journal.release()
+
+            return [call[0][0] for call in scan_directory.call_args_list]
+
+        with journal.watching([root]):
+            run_backup(bucket, [root], backoff=0)
+
+            # Each backup carries the roots on, so the next only rescans what
+            # the journal recorded
+            assert_equals([os.path.join(root, 'a')], backup_from_journal('a'))
+            assert_equals([os.path.join(root, 'b')], backup_from_journal('b'))
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        assert_equals((root,), manifest.roots)
+        expected = Manifest.from_filesystem('hostname', 'username', [root])
+        assert_equals([(path, expected[path].object_id) for path in expected],
+                      [(path, manifest[path].object_id) for path in manifest])
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_backup_packs_small_files():
+    temp_dir = backup_fixture()
+    restore_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        with open(os.path.join(temp_dir, 'large'), 'wb') as f:
+            f.write(os.urandom(2000))
+
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        put = functools.partial(put_archive, get_bucket, create_archive)
+
+        packer = Packer(get_bucket, put, create_archive, threshold=1000)
+        run_backup(bucket, [temp_dir], put=packer.put, packer=packer, workers=4, backoff=0)
+
+        # One pack, the large file and the manifest
+        assert_equals(3, bucket.requests['PUT'])
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        packs = set(manifest[path].location.pack for path in manifest if not path.endswith('large'))
+        assert_equals(1, len(packs))
+        assert_is_none(manifest[os.path.join(temp_dir, 'large')].location)
+
+        # Unchanged files keep their locations
+        with open(os.path.join(temp_dir, '3'), 'wb') as f:
+            f.write("This is new content")
+
+        packer = Packer(get_bucket, put, create_archive, threshold=1000)
+        run_backup(bucket, [temp_dir], put=packer.put, packer=packer, backoff=0)
+        assert_equals(5, bucket.requests['PUT'])
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        assert_not_equal(packs, set([manifest[os.path.join(temp_dir, '3')].location.pack]))
+        assert_equals(packs, set(manifest[os.path.join(temp_dir, str(i))].location.pack for i in (0, 1, 2, 4)))
+
+        for packs in (PackCache(get_bucket), None):
+            for path in manifest:
+                entry = manifest[path]
+                entry.path = os.path.join(restore_dir, os.path.basename(path))
+                restore_archive(entry, get_archive(get_bucket, entry, packs=packs))
+
+            for i in range(10):
+                with open(os.path.join(restore_dir, str(i)), 'rb') as f:
+                    expected = "This is new content" if i == 3 else "This is content number {}".format(i)
+                    assert_equals(expected, f.read())
+    finally:
+        shutil.rmtree(temp_dir)
+        shutil.rmtree(restore_dir)
+
+
+def test_backup_without_packing_keeps_packed_locations():
+    temp_dir = backup_fixture()
+    try:
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        put = functools.partial(put_archive, get_bucket, create_archive)
+
+        packer = Packer(get_bucket, put, create_archive, threshold=1000)
+        run_backup(bucket, [temp_dir], put=packer.put, packer=packer, backoff=0)
+
+        with open(os.path.join(temp_dir, '3'), 'wb') as f:
+            f.write("This is new content")
+        run_backup(bucket, [temp_dir], backoff=0)
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        assert_is_none(manifest[os.path.join(temp_dir, '3')].location)
+        assert_true(all(manifest[path].location for path in manifest if not path.endswith('3')))
+
+        shutil.rmtree(temp_dir)
+        restore([temp_dir],
+                functools.partial(get_archive, get_bucket, packs=PackCache(get_bucket)),
+                restore_archive,
+                functools.partial(latest_manifest, get_bucket, 'hostname', 'username'),
+                backoff=0)
+
+        for i in range(10):
+            with open(os.path.join(temp_dir, str(i)), 'rb') as f:
+                expected = "This is new content" if i == 3 else "This is content number {}".format(i)
+                assert_equals(expected, f.read())
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_put_manifest_retries_the_last_pack():
+    temp_dir = backup_fixture()
+    try:
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        put = functools.partial(put_archive, get_bucket, create_archive)
+
+        packer = Packer(get_bucket, put, create_archive, threshold=1000)
+        manifest = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+        for entry in manifest.entries():
+            packer.put(entry)
+
+        bucket.fail('PUT', 1)
+        put_manifest(get_bucket, manifest, packer=packer, backoff=0)
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        assert_equals(1, len(set(manifest[path].location.pack for path in manifest)))
+        assert_equals(3, bucket.requests['PUT'])
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def manifest_headers(bucket):
+    return [manifest_format.read_header(StringIO(bucket.objects[key.name]))
+            for key in sorted(list_manifest_keys(lambda: bucket, 'hostname', 'username'), key=lambda k: k.name)]
+
+
+def test_backup_puts_manifest_deltas():
+    temp_dir = backup_fixture()
+    try:
+        for i in range(10, 30):
+            with open(os.path.join(temp_dir, str(i)), 'wb') as f:
+                f.write("This is content number {}".format(i))
+
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        run_backup(bucket, [temp_dir], backoff=0)
+
+        with open(os.path.join(temp_dir, '3'), 'wb') as f:
+            f.write("This is new content")
+        os.unlink(os.path.join(temp_dir, '4'))
+        run_backup(bucket, [temp_dir], backoff=0)
+
+        full, delta = manifest_headers(bucket)
+        assert_equals(("", 0), full[1:3])
+        assert_equals((full.name, 1), delta[1:3])
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        expected = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+        assert_equals(delta.name, manifest._name)
+        assert_equals(1, manifest.depth)
+        assert_equals((temp_dir,), manifest.roots)
+        assert_equals(list(expected), list(manifest))
+        for path in expected:
+            assert_equals(expected[path], manifest[path])
+
+        # Compacting puts the same manifest in full
+        compact_manifest(get_bucket, 'hostname', 'username')
+        compacted = latest_manifest(get_bucket, 'hostname', 'username')
+        assert_equals(("", 0), manifest_headers(bucket)[-1][1:3])
+        assert_equals((temp_dir,), compacted.roots)
+        assert_equals([(e.path, e.object_id) for e in manifest.entries()],
+                      [(e.path, e.object_id) for e in compacted.entries()])
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_put_manifest_limits_delta_depth():
+    temp_dir = backup_fixture()
+    try:
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+
+        manifest = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+        put_manifest(get_bucket, manifest)
+
+        for _ in range(3):
+            previous = latest_manifest(get_bucket, 'hostname', 'username')
+            put_manifest(get_bucket, Manifest.from_filesystem('hostname', 'username', [temp_dir]), previous,
+                         max_depth=2)
+
+        assert_equals([0, 1, 2, 0], [header.depth for header in manifest_headers(bucket)])
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_latest_manifest_is_cached():
+    temp_dir = backup_fixture()
+    cache_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        for i in range(10, 30):
+            with open(os.path.join(temp_dir, str(i)), 'wb') as f:
+                f.write("This is content number {}".format(i))
+
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        cache = ManifestCache(cache_dir)
+
+        put_manifest(get_bucket, Manifest.from_filesystem('hostname', 'username', [temp_dir]), cache=cache)
+        previous = latest_manifest(get_bucket, 'hostname', 'username', cache)
+
+        with open(os.path.join(temp_dir, '3'), 'wb') as f:
+            f.write("This is new content")
+        expected = Manifest.from_filesystem('hostname', 'username', [temp_dir])
+        put_manifest(get_bucket, expected, previous)
+
+        # Only the new delta is fetched
+        bucket.requests.clear()
+        manifest = latest_manifest(get_bucket, 'hostname', 'username', cache)
+        assert_equals(1, bucket.requests['GET'])
+        assert_equals([(e.path, e.object_id) for e in expected.entries()],
+                      [(e.path, e.object_id) for e in manifest.entries()])
+
+        bucket.requests.clear()
+        latest_manifest(get_bucket, 'hostname', 'username', cache)
+        assert_not_in('GET', bucket.requests)
+        assert_equals(2, len(cache.names()))
+
+        # A changed manifest is fetched again
+        key_name = manifest_headers(bucket)[-1].name
+        bucket.objects[key_name] = bucket.objects[manifest_headers(bucket)[0].name]
+        assert_equals(0, latest_manifest(get_bucket, 'hostname', 'username', cache).depth)
+        assert_equals([key_name], cache.names())
+    finally:
+        shutil.rmtree(temp_dir)
+        shutil.rmtree(cache_dir)
+
+
+def test_backup_retries_failed_puts():
+    temp_dir = backup_fixture()
+    try:
+        bucket = FakeBucket()
+        bucket.fail('PUT', 2)
+        run_backup(bucket, [temp_dir], workers=2, attempts=3, backoff=0)
+
+        assert_equals(11, len(bucket.objects))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_backup_no_manifest_if_put_fails():
+    temp_dir = backup_fixture()
+    try:
+        bucket = FakeBucket()
+        bucket.fail('PUT', 2)
+
+        with assert_raises(PipelineError):
+            run_backup(bucket, [temp_dir], workers=2, attempts=1, backoff=0)
+
+        assert_equals([], list_manifest_keys(lambda: bucket, 'hostname', 'username'))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_archives_record_their_codec():
+    temp_dir = backup_fixture()
+    restore_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        with open(os.path.join(temp_dir, 'photo.jpg'), 'wb') as f:
+            f.write("This is content number 10")
+
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        create = functools.partial(create_archive, policy=Policy.from_spec('zlib:9'))
+        run_backup(bucket, [temp_dir], put=functools.partial(put_archive, get_bucket, create), backoff=0)
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        codecs = dict((os.path.basename(path), bucket.metadata[manifest[path].object_id]['codec'])
+                      for path in manifest)
+        assert_equals('none', codecs.pop('photo.jpg'))
+        assert_equals(set(['zlib']), set(codecs.values()))
+
+        for path in manifest:
+            entry = manifest[path]
+            entry.path = os.path.join(restore_dir, os.path.basename(path))
+            restore_archive(entry, get_archive(get_bucket, entry))
+
+        for i in range(10):
+            with open(os.path.join(restore_dir, str(i)), 'rb') as f:
+                assert_equals("This is content number {}".format(i), f.read())
+    finally:
+        shutil.rmtree(temp_dir)
+        shutil.rmtree(restore_dir)
+
+
+def test_get_archive_without_codec_is_gzip():
+    bucket = FakeBucket()
+    bucket.objects['data/thing'] = ''.join(compressed(["old content"]))
+    entry = Mock(object_id='data/thing', location=None)
+
+    assert_equals("old content", ''.join(get_archive(lambda: bucket, entry)))
+
+
+def test_restore_round_trip():
+    temp_dir = backup_fixture()
+    restore_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        bucket = FakeBucket()
+        run_backup(bucket, [temp_dir], backoff=0)
+
+        get_bucket = lambda: bucket
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+
+        # Restore by pointing every entry somewhere else
+        for path in manifest:
+            entry = manifest[path]
+            entry.path = os.path.join(restore_dir, os.path.basename(path))
+            restore_archive(entry, get_archive(get_bucket, entry))
+
+        for i in range(10):
+            with open(os.path.join(restore_dir, str(i)), 'rb') as f:
+                assert_equals("This is content number {}".format(i), f.read())
+    finally:
+        shutil.rmtree(temp_dir)
+        shutil.rmtree(restore_dir)
+
+
+def test_chunked_backup_only_puts_changed_chunks():
+    temp_dir = tempfile.mkdtemp(suffix="tardis_test")
+    restore_dir = tempfile.mkdtemp(suffix="tardis_test")
+    try:
+        # Seeded, so the chunk boundaries are always the same
+        rng = random.Random(2)
+        content = binascii.unhexlify('{:0{}x}'.format(rng.getrandbits(8 * 2 * 2**20), 4 * 2**20)) * 2
+        path = os.path.join(temp_dir, 'large')
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        bucket = FakeBucket()
+        get_bucket = lambda: bucket
+        chunked_put = functools.partial(put_chunked_archive, get_bucket, create_archive, threshold=2**20)
+
+        run_backup(bucket, [temp_dir], put=chunked_put, backoff=0)
+        chunks = [name for name in bucket.objects if name.startswith('chunk/')]
+
+        # The second half repeats the first, so 2 of its 7 chunks are deduplicated
+        assert_equals(5, len(chunks))
+
+        with open(path, 'r+b') as f:
+            f.seek(2**20)
+            f.write('changed')
+        os.utime(path, (0, 0))
+
+        run_backup(bucket, [temp_dir], put=chunked_put, backoff=0)
+        new_chunks = [name for name in bucket.objects if name.startswith('chunk/') and name not in chunks]
+        assert_equals(1, len(new_chunks))
+
+        manifest = latest_manifest(get_bucket, 'hostname', 'username')
+        entry = manifest[path]
+        entry.path = os.path.join(restore_dir, 'large')
+        restore_archive(entry, get_archive(get_bucket, entry))
+
+        with open(entry.path, 'rb') as f:
+            assert_equals(content[:2**20] + 'changed' + content[2**20 + len('changed'):], f.read())
+    finally:
+        shutil.rmtree(temp_dir)
+        shutil.rmtree(restore_dir)
+
+
+def test_needs_put_consults_index():
+    bucket = FakeBucket()
+    get_bucket = lambda: bucket
+
+    old = Mock(checksum='old')
+    old.checksum_differs.return_value = True
+    new = Mock(checksum='new', object_id='data/a/new')
+    new.checksum_differs.return_value = True
+
+    index = ObjectIndex(['data/a/new'])
+    assert_false(needs_put(get_bucket, new, old, index=index))
+    assert_not_in('HEAD', bucket.requests)
+
+    # Objects missing from the index need putting without checking the bucket
+    index = ObjectIndex()
+    assert_true(needs_put(get_bucket, new, old, index=index))
+    assert_not_in('HEAD', bucket.requests)
+
+    assert_true(needs_put(get_bucket, new, old, index=index, head_fallback=True))
+    assert_equals(1, bucket.requests['HEAD'])
+
+
+def test_restore_in_parallel():
+    temp_dir = backup_fixture()
+    try:
+        for subdirectory in ('a', 'b'):
+            makedirs(os.path.join(temp_dir, subdirectory))
+            with open(os.path.join(temp_dir, subdirectory, 'same'), 'wb') as f:
+                f.write("The same content")
+        os.utime(os.path.join(temp_dir, '3'), (1363620000, 1363620000))
+
+        bucket = FakeBucket()
+        run_backup(bucket, [temp_dir], backoff=0)
+
+        shutil.rmtree(temp_dir)
+        bucket.requests.clear()
+
+        get_bucket = lambda: bucket
+        restore([temp_dir],
+                functools.partial(get_archive, get_bucket),
+                restore_archive,
+                functools.partial(latest_manifest, get_bucket, 'hostname', 'username'),
+                workers=4,
+                backoff=0)
+
+        for i in range(10):
+            with open(os.path.join(temp_dir, str(i)), 'rb') as f:
+                assert_equals("This is content number {}".format(i), f.read())
+
+        for subdirectory in ('a', 'b'):
+            with open(os.path.join(temp_dir, subdirectory, 'same'), 'rb') as f:
+                assert_equals("The same content", f.read())
+
+        assert_equals(1363620000, os.path.getmtime(os.path.join(temp_dir, '3')))
+
+        # One for the manifest and one per distinct object
+        assert_equals(12, bucket.requests['GET'])
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_restore_with_unknown_owner():
+    temp_dir = backup_fixture()
+    try:
+        os.utime(os.path.join(temp_dir, '3'), (1363620000, 1363620000))
+
+        bucket = FakeBucket()
+        run_backup(bucket, [temp_dir], backoff=0)
+        shutil.rmtree(temp_dir)
+
+        get_bucket = lambda: bucket
+        latest = latest_manifest(get_bucket, 'hostname', 'username')
+        manifest = Manifest(latest._name, ((entry.path, FileEntry(entry.path, entry.object_id,
+                                                                  entry.stat_info._replace(owner='tardis-nobody')))
+                                           for entry in latest.entries()))
+
+        restore([temp_dir],
+                functools.partial(get_archive, get_bucket),
+                restore_archive,
+                lambda: manifest,
+                backoff=0)
+
+        for i in range(10):
+            with open(os.path.join(temp_dir, str(i)), 'rb') as f:
+                assert_equals("This is content number {}".format(i), f.read())
+
+        assert_equals(1363620000, os.path.getmtime(os.path.join(temp_dir, '3')))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_restore_reports_failures():
+    temp_dir = backup_fixture()
+    try:
+        bucket = FakeBucket()
+        run_backup(bucket, [temp_dir], backoff=0)
+        shutil.rmtree(temp_dir)
+
+        bucket.fail('GET', 2, after=1)
+
+        get_bucket = lambda: bucket
+        with assert_raises(PipelineError) as cm:
+            restore([temp_dir],
+                    functools.partial(get_archive, get_bucket),
+                    restore_archive,
+                    functools.partial(latest_manifest, get_bucket, 'hostname', 'username'),
+                    workers=1,
+                    attempts=1,
+                    backoff=0)
+
+        assert_equals(2, len(cm.exception.failures))
+        assert_equals(8, len(os.listdir(temp_dir)))
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,278 @@
+import gzip
+import random
+import threading
+from contextlib import closing
+from cStringIO import StringIO
+
+from nose.tools import *
+
+from fake_s3 import FakeBucket
+
+from tardis.transfer import compressed, decompressed, buffered, upload, download
+from tardis.executor import create_executor, running
+
+
+def random_content(size):
+    rng = random.Random(size)
+    return ''.join(chr(rng.randint(0, 255)) for _ in xrange(size))
+
+
+def test_compressed_is_gzip():
+    content = random_content(100000)
+    data = ''.join(compressed([content[:5000], content[5000:]]))
+
+    with closing(gzip.GzipFile(fileobj=StringIO(data))) as f:
+        assert_equals(content, f.read())
+
+
+def test_decompressed_reads_gzip():
+    content = "The same thing over and over " * 10000
+
+    buf = StringIO()
+    with closing(gzip.GzipFile(fileobj=buf, mode='wb')) as f:
+        f.write(content)
+    data = buf.getvalue()
+
+    parts = list(decompressed([data[:100], data[100:]], max_length=4096))
+
+    assert_equals(content, ''.join(parts))
+    assert_true(all(len(part) <= 4096 for part in parts))
+
+
+def test_buffered():
+    parts = ['a' * 3, 'b' * 10, 'c' * 1, 'd' * 7]
+    chunks = list(buffered(parts, 5))
+
+    assert_equals(''.join(parts), ''.join(chunks))
+    assert_equals([5, 5, 5, 5, 1], [len(c) for c in chunks])
+
+
+def test_buffered_empty():
+    assert_equals([], list(buffered([], 5)))
+
+
+def test_upload_single_request():
+    bucket = FakeBucket()
+    upload(lambda: bucket, 'data/small', ['abc', 'def'], part_size=100)
+
+    assert_equals('abcdef', bucket.objects['data/small'])
+    assert_equals(1, bucket.requests['PUT'])
+    assert_not_in('POST', bucket.requests)
+
+
+def test_upload_empty():
+    bucket = FakeBucket()
+    upload(lambda: bucket, 'data/empty', [], part_size=100)
+
+    assert_equals('', bucket.objects['data/empty'])
+
+
+def test_upload_multipart():
+    bucket = FakeBucket()
+    content = random_content(1050)
+    upload(lambda: bucket, 'data/large', [content[i:i + 64] for i in range(0, len(content), 64)], part_size=100,
+           threshold=100)
+
+    assert_equals(content, bucket.objects['data/large'])
+    assert_equals(11, bucket.requests['PUT'])
+    assert_equals([], bucket.uploads)
+
+
+def test_upload_below_threshold():
+    bucket = FakeBucket()
+    content = random_content(1050)
+    upload(lambda: bucket, 'data/large', [content], part_size=100, threshold=2000)
+
+    assert_equals(content, bucket.objects['data/large'])
+    assert_equals(1, bucket.requests['PUT'])
+
+
+def test_upload_multipart_parallel():
+    bucket = FakeBucket()
+    content = random_content(5000)
+
+    with running(create_executor('thread', 4)) as executor:
+        upload(lambda: bucket, 'data/large', [content], part_size=100, threshold=100, executor=executor)
+
+    assert_equals(content, bucket.objects['data/large'])
+    assert_equals(50, bucket.requests['PUT'])
+
+
+def test_upload_multipart_parallel_bucket_per_thread():
+    bucket = FakeBucket()
+    callers = []
+
+    def get_bucket():
+        callers.append(threading.current_thread())
+        return bucket
+
+    with running(create_executor('thread', 4)) as executor:
+        upload(get_bucket, 'data/large', [random_content(5000)], part_size=100, threshold=100, executor=executor)
+
+    # One to start the upload, one for each part from the thread putting it,
+    # then one to complete it
+    assert_equals(1 + 50 + 1, len(callers))
+    assert_not_in(threading.current_thread(), callers[1:-1])
+
+
+def test_upload_multipart_resumes():
+    bucket = FakeBucket()
+    content = random_content(1000)
+    bucket.fail('PUT', 1, after=4)
+
+    with assert_raises(IOError):
+        upload(lambda: bucket, 'data/large', [content], part_size=100, threshold=100)
+
+    assert_not_in('data/large', bucket.objects)
+    assert_equals(1, len(bucket.uploads))
+
+    upload(lambda: bucket, 'data/large', [content], part_size=100, threshold=100)
+
+    assert_equals(content, bucket.objects['data/large'])
+    assert_equals([], bucket.uploads)
+    # 4 parts first time, 1 failure, then the remaining 6 parts
+    assert_equals(11, bucket.requests['PUT'])
+
+
+def test_upload_multipart_changed_content_started_again():
+    bucket = FakeBucket()
+    bucket.fail('PUT', 1, after=9)
+
+    with assert_raises(IOError):
+        upload(lambda: bucket, 'data/large', [random_content(1000)], part_size=100, threshold=100)
+
+    content = random_content(500)
+    upload(lambda: bucket, 'data/large', [content], part_size=100, threshold=100)
+
+    assert_equals(content, bucket.objects['data/large'])
+    assert_equals([], bucket.uploads)
+    assert_equals(1, bucket.requests['DELETE'])
+
+
+def test_upload_multipart_stale_parts_dropped():
+    bucket = FakeBucket()
+    content = random_content(1000)
+    bucket.fail('PUT', 1, after=9)
+
+    with assert_raises(IOError):
+        upload(lambda: bucket, 'data/large', [content], part_size=100, threshold=100)
+
+    # The same content, only shorter, its parts are all already put
+    upload(lambda: bucket, 'data/large', [content[:500]], part_size=100, threshold=100)
+
+    assert_equals(content[:500], bucket.objects['data/large'])
+    assert_equals([], bucket.uploads)
+    assert_equals(9 + 1, bucket.requests['PUT'])
+
+
+def test_upload_metadata():
+    bucket = FakeBucket()
+    upload(lambda: bucket, 'data/small', ['content'], metadata={'codec': 'zlib'})
+    upload(lambda: bucket, 'data/large', [random_content(1000)], part_size=100, threshold=100,
+           metadata={'codec': 'zlib'})
+
+    assert_equals({'codec': 'zlib'}, bucket.metadata['data/small'])
+    assert_equals({'codec': 'zlib'}, bucket.metadata['data/large'])
+
+
+def test_upload_multipart_with_metadata_different_content_started_again():
+    bucket = FakeBucket()
+    bucket.fail('PUT', 1, after=4)
+
+    with assert_raises(IOError):
+        upload(lambda: bucket, 'data/large', [random_content(1000)], part_size=100, threshold=100,
+               metadata={'codec': 'gzip'})
+
+    # Content that's changed could have been compressed differently
+    content = random_content(2000)
+    upload(lambda: bucket, 'data/large', [content], part_size=100, threshold=100, metadata={'codec': 'none'})
+
+    assert_equals(content, bucket.objects['data/large'])
+    assert_equals({'codec': 'none'}, bucket.metadata['data/large'])
+    assert_equals([], bucket.uploads)
+
+
+def test_download_metadata():
+    bucket = FakeBucket()
+    upload(lambda: bucket, 'data/thing', [random_content(1000)], metadata={'codec': 'zlib'})
+
+    metadata = {}
+    parts = download(lambda: bucket, 'data/thing', 300, metadata=metadata)
+    next(parts)
+    assert_equals({'codec': 'zlib'}, metadata)
+
+    with running(create_executor('thread', 4)) as executor:
+        metadata = {}
+        list(download(lambda: bucket, 'data/thing', part_size=300, threshold=500, executor=executor,
+                      metadata=metadata))
+        assert_equals({'codec': 'zlib'}, metadata)
+
+
+def test_download():
+    bucket = FakeBucket()
+    bucket.objects['data/thing'] = random_content(1000)
+
+    parts = list(download(lambda: bucket, 'data/thing', 300))
+
+    assert_equals(bucket.objects['data/thing'], ''.join(parts))
+    assert_equals([300, 300, 300, 100], [len(p) for p in parts])
+
+
+def test_download_ranged():
+    bucket = FakeBucket()
+    bucket.objects['data/thing'] = random_content(1000)
+
+    with running(create_executor('thread', 4)) as executor:
+        parts = list(download(lambda: bucket, 'data/thing', part_size=300, threshold=500, executor=executor))
+
+    assert_equals(bucket.objects['data/thing'], ''.join(parts))
+    assert_equals([300, 300, 300, 100], [len(p) for p in parts])
+    assert_equals(4, bucket.requests['GET'])
+
+
+def test_download_ranged_bucket_per_thread():
+    bucket = FakeBucket()
+    bucket.objects['data/thing'] = random_content(1000)
+    callers = []
+
+    def get_bucket():
+        callers.append(threading.current_thread())
+        return bucket
+
+    with running(create_executor('thread', 4)) as executor:
+        list(download(get_bucket, 'data/thing', part_size=300, threshold=500, executor=executor))
+
+    assert_equals(1 + 4, len(callers))
+    assert_not_in(threading.current_thread(), callers[1:])
+
+
+def test_download_ranged_below_threshold():
+    bucket = FakeBucket()
+    bucket.objects['data/thing'] = random_content(1000)
+
+    with running(create_executor('thread', 4)) as executor:
+        parts = list(download(lambda: bucket, 'data/thing', part_size=300, threshold=5000, executor=executor))
+
+    assert_equals(bucket.objects['data/thing'], ''.join(parts))
+    assert_equals(1, bucket.requests['GET'])
+
+
+def test_download_serial_executor_single_request():
+    bucket = FakeBucket()
+    bucket.objects['data/thing'] = random_content(1000)
+
+    # As with --transfers 1, there's nothing to gain from finding the size
+    for executor, window in [(create_executor('thread', 1), 4), (create_executor('thread', 4), 1)]:
+        with running(executor):
+            bucket.requests = {}
+            parts = list(download(lambda: bucket, 'data/thing', part_size=300, threshold=500, executor=executor,
+                                  window=window))
+
+            assert_equals(bucket.objects['data/thing'], ''.join(parts))
+            assert_equals({'GET': 1}, bucket.requests)
+
+
+@raises(LookupError)
+def test_download_ranged_missing():
+    with running(create_executor('thread', 4)) as executor:
+        list(download(lambda: FakeBucket(), 'data/thing', executor=executor))
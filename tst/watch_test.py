@@ -0,0 +1,90 @@
+import os
+import os.path
+import tempfile
+import shutil
+
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+
+from tardis.util import makedirs
+from tardis.watch import Watcher
+
+
+temp_dir = None
+watcher = None
+def setup_func():
+    global temp_dir, watcher
+
+    temp_dir = os.path.realpath(tempfile.mkdtemp(suffix="tardis_test"))
+    makedirs(os.path.join(temp_dir, 'a', 'b'))
+    makedirs(os.path.join(temp_dir, '.hidden'))
+    makedirs(os.path.join(temp_dir, 'ignored'))
+
+    try:
+        watcher = Watcher([temp_dir], [os.path.join(temp_dir, 'ignored')])
+    except OSError:
+        shutil.rmtree(temp_dir)
+        raise SkipTest("inotify isn't available")
+
+
+def teardown_func():
+    global temp_dir, watcher
+    watcher.close()
+    shutil.rmtree(temp_dir)
+    temp_dir = None
+    watcher = None
+
+
+def changes():
+    """Every change so far"""
+    directories, trees = set(), set()
+    while True:
+        changed_directories, changed_trees = watcher.changes(0.1)
+        if not changed_directories and not changed_trees:
+            return directories, trees
+        directories.update(changed_directories)
+        trees.update(changed_trees)
+
+
+def write(*path):
+    with open(os.path.join(temp_dir, *path), 'wb') as f:
+        f.write("content")
+
+
+@with_setup(setup_func, teardown_func)
+def test_watcher_records_file_changes():
+    write('1')
+    write('a', 'b', '2')
+    write('.hidden', '3')
+    write('ignored', '4')
+
+    assert_equals((set([temp_dir, os.path.join(temp_dir, 'a', 'b')]), set()), changes())
+
+
+@with_setup(setup_func, teardown_func)
+def test_watcher_records_new_trees():
+    makedirs(os.path.join(temp_dir, 'c'))
+    makedirs(os.path.join(temp_dir, '.other'))
+    assert_equals((set(), set([os.path.join(temp_dir, 'c')])), changes())
+
+    # New directories are watched too
+    write('c', '1')
+    assert_equals((set([os.path.join(temp_dir, 'c')]), set()), changes())
+
+
+@with_setup(setup_func, teardown_func)
+def test_watcher_follows_moved_directories():
+    os.rename(os.path.join(temp_dir, 'a'), os.path.join(temp_dir, 'd'))
+    assert_equals((set(), set([os.path.join(temp_dir, 'a'), os.path.join(temp_dir, 'd')])), changes())
+
+    write('d', 'b', '1')
+    assert_equals((set([os.path.join(temp_dir, 'd', 'b')]), set()), changes())
+
+
+@with_setup(setup_func, teardown_func)
+def test_watcher_records_removed_trees():
+    shutil.rmtree(os.path.join(temp_dir, 'a'))
+
+    _, trees = changes()
+    assert_in(os.path.join(temp_dir, 'a'), trees)
+    assert_false(watcher.overflowed)